@@ -0,0 +1,3 @@
+"""
+Benchmarks of legi.py, run them with `python -m benchmarks.<name>`
+"""
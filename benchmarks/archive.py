@@ -0,0 +1,404 @@
+"""
+Generates synthetic LEGI archives, so that the benchmarks can run offline
+
+    python -m benchmarks.archive DIRECTORY [--texts N] [--articles N] [--daily N]
+
+The archives mimic the real ones: same paths, same XML shapes, duplicate files
+in several folders, and daily archives with a `liste_suppression_legi.dat`
+file. The output only depends on the arguments.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+from argparse import ArgumentParser
+from datetime import date, timedelta
+import io
+import os
+import random
+import tarfile
+
+from legi.utils import id_to_path
+
+
+WORDS = """
+    article loi décret code dispositions présent alinéa application conditions
+    prévues sous réserve ministre chargé autorité compétente délai jours mois
+    personne morale physique être peut doit lorsque dans les des aux par pour
+    avec selon conformément modifié abrogé vigueur publication journal officiel
+""".split()
+
+SUBJECTS = """
+    protection de l'environnement|sécurité sociale|fonction publique|santé publique|
+    organisation judiciaire|commerce|propriété intellectuelle|transports|énergie|
+    éducation|collectivités territoriales|travail|assurances|consommation|défense
+""".replace('\n', '').split('|')
+
+MONTHS = """
+    janvier février mars avril mai juin juillet août septembre octobre novembre décembre
+""".split()
+
+NATURES = ('LOI', 'DECRET', 'ARRETE', 'ORDONNANCE')
+
+GLOBAL_DATE = date(2018, 1, 1)
+GLOBAL_MTIME = 1514764800  # 2018-01-01
+
+
+def sentence(rand, n_words):
+    words = [rand.choice(WORDS) for i in range(n_words)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraphs(rand, n):
+    r = []
+    for i in range(n):
+        p = ' '.join(sentence(rand, rand.randint(8, 30)) for j in range(rand.randint(1, 4)))
+        if rand.random() < 0.2:
+            p = '<font size="2">%s</font>' % p
+        r.append('<p>%s</p>' % p if i % 2 else p + '<br/>')
+    return '\n'.join(r)
+
+
+def lien(rand):
+    return (
+        '<LIEN cidtexte="JORFTEXT%012i" datesignatexte="2000-01-01" id="JORFTEXT%012i" '
+        'naturetexte="LOI" nortexte="" num="2000-1" numtexte="2000-1" sens="source" '
+        'typelien="%s">Loi n° 2000-1 du 1 janvier 2000</LIEN>'
+    ) % (rand.randint(1, 10**6), rand.randint(1, 10**6), rand.choice(('CITATION', 'MODIFIE', 'CREE')))
+
+
+def article_xml(rand, article, text):
+    id, num, etat, date_debut, date_fin = (
+        article['id'], article['num'], article['etat'], article['date_debut'], article['date_fin'],
+    )
+    cid, nature, titre, section = text['cid'], text['nature'], text['titre'], article['section']
+    content = paragraphs(rand, rand.randint(1, 6))
+    liens = '\n'.join(lien(rand) for i in range(rand.randint(0, 4)))
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<ARTICLE>
+<META>
+<META_COMMUN><ID>{id}</ID><ANCIEN_ID/><ORIGINE>LEGI</ORIGINE><URL>article/{id}.xml</URL><NATURE>Article</NATURE></META_COMMUN>
+<META_SPEC>
+<META_ARTICLE>
+<NUM>{num}</NUM>
+<ETAT>{etat}</ETAT>
+<DATE_DEBUT>{date_debut}</DATE_DEBUT>
+<DATE_FIN>{date_fin}</DATE_FIN>
+<TYPE>AUTONOME</TYPE>
+</META_ARTICLE>
+</META_SPEC>
+</META>
+<CONTEXTE>
+<TEXTE autorite="" cid="{cid}" date_publi="2999-01-01" date_signature="2999-01-01" ministere="" nature="{nature}" nor="" num="">
+<TITRE_TXT c_titre_court="{titre}" debut="2002-01-01" fin="2999-01-01" id_txt="{cid}">{titre}</TITRE_TXT>
+<TM><TITRE_TM debut="2002-01-01" fin="2999-01-01" id="{section}">Titre Ier</TITRE_TM></TM>
+</TEXTE>
+</CONTEXTE>
+<VERSIONS>
+<VERSION etat="{etat}"><LIEN_ART debut="{date_debut}" etat="{etat}" fin="{date_fin}" id="{id}" num="{num}" origine="LEGI"/></VERSION>
+</VERSIONS>
+<NOTA><CONTENU/></NOTA>
+<BLOC_TEXTUEL>
+<CONTENU>
+{content}
+</CONTENU>
+</BLOC_TEXTUEL>
+<LIENS>
+{liens}
+</LIENS>
+</ARTICLE>
+'''.format(**locals())
+
+
+def section_xml(section, text):
+    id, cid, titre = section['id'], text['cid'], text['titre']
+    liens = '\n'.join(
+        '<LIEN_ART debut="%(date_debut)s" etat="%(etat)s" fin="%(date_fin)s" id="%(id)s" '
+        'num="%(num)s" origine="LEGI"/>' % a
+        for a in section['articles']
+    )
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<SECTION_TA>
+<ID>{id}</ID>
+<TITRE_TA>Titre Ier : Dispositions générales</TITRE_TA>
+<COMMENTAIRE/>
+<CONTEXTE>
+<TEXTE cid="{cid}"><TITRE_TXT c_titre_court="{titre}" id_txt="{cid}">{titre}</TITRE_TXT></TEXTE>
+</CONTEXTE>
+<STRUCTURE_TA>
+{liens}
+</STRUCTURE_TA>
+</SECTION_TA>
+'''.format(**locals())
+
+
+def struct_xml(version, text):
+    id, nature = version['id'], text['nature']
+    versions = '\n'.join(
+        '<VERSION etat="%(etat)s"><LIEN_TXT debut="%(date_debut)s" fin="%(date_fin)s" id="%(id)s" num=""/></VERSION>' % v
+        for v in text['versions']
+    )
+    liens = '\n'.join(
+        '<LIEN_SECTION_TA debut="2002-01-01" etat="VIGUEUR" fin="2999-01-01" id="%s" niv="1">Titre %i</LIEN_SECTION_TA>'
+        % (s['id'], i)
+        for i, s in enumerate(text['sections'], 1)
+    )
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<TEXTELR>
+<META>
+<META_COMMUN><ID>{id}</ID><NATURE>{nature}</NATURE></META_COMMUN>
+</META>
+<VERSIONS>
+{versions}
+</VERSIONS>
+<STRUCT>
+{liens}
+</STRUCT>
+</TEXTELR>
+'''.format(**locals())
+
+
+def version_xml(rand, version, text):
+    id, etat, date_debut, date_fin = version['id'], version['etat'], version['date_debut'], version['date_fin']
+    cid, nature, num, nor, date_texte = text['cid'], text['nature'], text['num'], text['nor'], text['date_texte']
+    titre, titrefull = text['titre'], text['titrefull']
+    num = '<NUM>%s</NUM>' % num if num else '<NUM/>'
+    nor = '<NOR>%s</NOR>' % nor if nor else '<NOR/>'
+    visas = paragraphs(rand, 3)
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<TEXTE_VERSION>
+<META>
+<META_COMMUN><ID>{id}</ID><NATURE>{nature}</NATURE></META_COMMUN>
+<META_SPEC>
+<META_TEXTE_CHRONICLE>
+<CID>{cid}</CID>
+{num}
+<NUM_SEQUENCE>0</NUM_SEQUENCE>
+{nor}
+<DATE_PUBLI>{date_texte}</DATE_PUBLI>
+<DATE_TEXTE>{date_texte}</DATE_TEXTE>
+<DERNIERE_MODIFICATION>2018-01-01</DERNIERE_MODIFICATION>
+<ORIGINE_PUBLI>JORF</ORIGINE_PUBLI>
+<PAGE_DEB_PUBLI>0</PAGE_DEB_PUBLI>
+<PAGE_FIN_PUBLI>0</PAGE_FIN_PUBLI>
+</META_TEXTE_CHRONICLE>
+<META_TEXTE_VERSION>
+<TITRE>{titre}</TITRE>
+<TITREFULL>{titrefull}</TITREFULL>
+<ETAT>{etat}</ETAT>
+<DATE_DEBUT>{date_debut}</DATE_DEBUT>
+<DATE_FIN>{date_fin}</DATE_FIN>
+<AUTORITE/>
+<MINISTERE/>
+<LIENS/>
+</META_TEXTE_VERSION>
+</META_SPEC>
+</META>
+<VISAS><CONTENU>{visas}</CONTENU></VISAS>
+<SIGNATAIRES><CONTENU/></SIGNATAIRES>
+<TP><CONTENU/></TP>
+<NOTA><CONTENU/></NOTA>
+<ABRO><CONTENU/></ABRO>
+<RECT><CONTENU/></RECT>
+</TEXTE_VERSION>
+'''.format(**locals())
+
+
+def file_path(dossier, cid, sous_dossier, id, extension='.xml'):
+    x = 'en' if dossier.endswith('_en_vigueur') else 'non'
+    if id[4:8] != 'TEXT':
+        id = id_to_path(id)
+    return '/'.join((
+        'legi/global/code_et_TNC_%s_vigueur' % x, dossier, id_to_path(cid), sous_dossier, id + extension
+    ))
+
+
+def generate_texts(n_texts=10, n_articles=1000, articles_per_section=20, duplicate_ratio=0.01, seed=0):
+    """Returns the metadata of synthetic texts, as a list of dicts.
+    """
+    rand = random.Random(seed)
+    next_id = [6000000]
+
+    def new_id(prefix):
+        next_id[0] += 1
+        return prefix + '%012i' % next_id[0]
+
+    texts = []
+    for t in range(n_texts):
+        subject = rand.choice(SUBJECTS)
+        if t % 5 == 0:
+            nature, num, nor, date_texte = 'CODE', None, None, '2999-01-01'
+            titre = titrefull = 'Code de la ' + subject
+            dossier = 'code_en_vigueur'
+        else:
+            nature = rand.choice(NATURES)
+            d = date(rand.randint(1950, 2017), rand.randint(1, 12), rand.randint(1, 28))
+            date_texte = d.isoformat()
+            num = '%i-%i' % (d.year, rand.randint(1, 1500)) if nature != 'ARRETE' else None
+            nor = 'XXXX%02i%05iX' % (d.year % 100, rand.randint(1, 99999)) if rand.random() < 0.7 else None
+            day = '1er' if d.day == 1 else str(d.day)
+            titre = '%s%s du %s %s %i' % (
+                {'LOI': 'Loi', 'DECRET': 'Décret', 'ARRETE': 'Arrêté', 'ORDONNANCE': 'Ordonnance'}[nature],
+                ' n° ' + num if num else '', day, MONTHS[d.month - 1], d.year,
+            )
+            titrefull = titre + ' relatif à la ' + subject
+            if rand.random() < 0.1:
+                # Some titles aren't normalized
+                titrefull = titrefull.replace('n° ', 'n°')
+            dossier = 'TNC_en_vigueur'
+        cid = new_id('LEGITEXT' if nature == 'CODE' else 'JORFTEXT')
+        versions = [{'id': cid if nature == 'CODE' else new_id('LEGITEXT')}]
+        if nature != 'CODE' and rand.random() < 0.3:
+            versions.append({'id': new_id('LEGITEXT')})
+        dates = ['2002-01-01', '2010-01-01', '2999-01-01']
+        for i, v in enumerate(versions):
+            last = i == len(versions) - 1
+            v['etat'] = 'VIGUEUR' if last else 'MODIFIE'
+            v['date_debut'] = dates[i]
+            v['date_fin'] = '2999-01-01' if last else dates[i + 1]
+        articles = []
+        for i in range(n_articles):
+            a = {'id': new_id('LEGIARTI'), 'num': str(i + 1)}
+            if rand.random() < 0.1:
+                a['etat'], a['date_debut'], a['date_fin'] = 'ABROGE', '2002-01-01', '2010-01-01'
+            else:
+                a['etat'], a['date_debut'], a['date_fin'] = 'VIGUEUR', '2002-01-01', '2999-01-01'
+            a['duplicate'] = rand.random() < duplicate_ratio
+            articles.append(a)
+        sections = []
+        for i in range(0, n_articles, articles_per_section):
+            section = {'id': new_id('LEGISCTA'), 'articles': articles[i:i+articles_per_section]}
+            for a in section['articles']:
+                a['section'] = section['id']
+            sections.append(section)
+        texts.append(dict(
+            cid=cid, nature=nature, num=num, nor=nor, date_texte=date_texte, titre=titre,
+            titrefull=titrefull, dossier=dossier, versions=versions, sections=sections,
+            articles=articles,
+        ))
+    return texts
+
+
+def iter_text_files(rand, text, mtime):
+    """Yields the `(path, mtime, xml)` tuples of a text, in archive order.
+    """
+    cid, dossier = text['cid'], text['dossier']
+    for version in text['versions']:
+        yield file_path(dossier, cid, 'texte/struct', version['id']), mtime, struct_xml(version, text)
+        yield file_path(dossier, cid, 'texte/version', version['id']), mtime, version_xml(rand, version, text)
+    for section in text['sections']:
+        yield file_path(dossier, cid, 'section_ta', section['id']), mtime, section_xml(section, text)
+        for article in section['articles']:
+            yield file_path(dossier, cid, 'article', article['id']), mtime, article_xml(rand, article, text)
+
+
+def generate_files(n_texts=10, n_articles=1000, duplicate_ratio=0.01, seed=0):
+    """Yields the `(path, mtime, xml)` tuples of a synthetic global archive.
+
+    A fraction `duplicate_ratio` of the articles also appears in the folder of
+    another text, with a different mtime.
+    """
+    texts = generate_texts(n_texts, n_articles, duplicate_ratio=duplicate_ratio, seed=seed)
+    rand = random.Random(seed + 1)
+    for text in texts:
+        for f in iter_text_files(rand, text, GLOBAL_MTIME):
+            yield f
+    # The duplicates are in the non-vigueur folder of another text
+    for i, text in enumerate(texts):
+        other = texts[(i + 1) % len(texts)]
+        for article in text['articles']:
+            if article['duplicate']:
+                mtime = GLOBAL_MTIME + rand.choice((-86400, 86400))
+                path = file_path('TNC_non_vigueur', other['cid'], 'article', article['id'])
+                yield path, mtime, article_xml(rand, article, other)
+
+
+def generate_daily_files(day, n_texts=10, n_articles=1000, changes=100, deletions=10,
+                         duplicate_ratio=0.01, seed=0):
+    """Yields the `(path, mtime, content)` tuples of the daily archive of `day`.
+
+    `day` is the number of days since the global archive. The archive contains
+    `changes` modified articles (and their sections), and `deletions` deleted
+    articles listed in `liste_suppression_legi.dat`.
+    """
+    texts = generate_texts(n_texts, n_articles, duplicate_ratio=duplicate_ratio, seed=seed)
+    rand = random.Random(seed * 1000 + day)
+    prefix = daily_archive_date(day) + '/'
+    mtime = GLOBAL_MTIME + day * 86400
+    articles = [(text, article) for text in texts for article in text['articles']]
+    changed = rand.sample(articles, min(changes + deletions, len(articles)))
+    changed, deleted = changed[:changes], changed[changes:]
+    sections = {}
+    for text, article in changed:
+        sections[article['section']] = text
+        path = file_path(text['dossier'], text['cid'], 'article', article['id'])
+        yield prefix + path, mtime, article_xml(rand, article, text)
+    for text in texts:
+        for section in text['sections']:
+            if section['id'] in sections:
+                path = file_path(text['dossier'], text['cid'], 'section_ta', section['id'])
+                yield prefix + path, mtime, section_xml(section, text)
+    liste_suppression = ''.join(
+        file_path(text['dossier'], text['cid'], 'article', article['id'], extension='') + '\n'
+        for text, article in deleted
+    )
+    yield prefix + 'liste_suppression_legi.dat', mtime, liste_suppression
+
+
+def daily_archive_date(day):
+    return (GLOBAL_DATE + timedelta(days=day)).strftime('%Y%m%d') + '-210000'
+
+
+def make_archive(path, files):
+    """Writes the `(path, mtime, content)` tuples in `files` into a tar.gz archive.
+    """
+    with tarfile.open(path, 'w:gz', compresslevel=6) as tar:
+        for name, mtime, content in files:
+            data = content.encode('utf8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def make_archives(directory, n_texts=10, n_articles=1000, n_daily=2, changes=100, deletions=10,
+                  duplicate_ratio=0.01, seed=0):
+    """Writes a global archive and `n_daily` daily archives into `directory`.
+
+    Returns the paths of the archives, in chronological order.
+    """
+    kw = dict(n_texts=n_texts, n_articles=n_articles, duplicate_ratio=duplicate_ratio, seed=seed)
+    paths = [make_archive(
+        os.path.join(directory, 'Freemium_legi_global_%s-000000.tar.gz' % GLOBAL_DATE.strftime('%Y%m%d')),
+        generate_files(**kw),
+    )]
+    for day in range(1, n_daily + 1):
+        paths.append(make_archive(
+            os.path.join(directory, 'legi_%s.tar.gz' % daily_archive_date(day)),
+            generate_daily_files(day, changes=changes, deletions=deletions, **kw),
+        ))
+    return paths
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('directory', help="where to write the archives")
+    p.add_argument('--texts', type=int, default=10)
+    p.add_argument('--articles', type=int, default=1000, help="number of articles per text")
+    p.add_argument('--duplicates', type=float, default=0.01, help="ratio of duplicated articles")
+    p.add_argument('--daily', type=int, default=2, help="number of daily archives")
+    p.add_argument('--changes', type=int, default=100, help="number of modified articles per daily archive")
+    p.add_argument('--deletions', type=int, default=10, help="number of deleted articles per daily archive")
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+    if not os.path.isdir(args.directory):
+        os.mkdir(args.directory)
+    paths = make_archives(
+        args.directory, args.texts, args.articles, args.daily, args.changes, args.deletions,
+        args.duplicates, args.seed,
+    )
+    print(*paths, sep='\n')
+
+
+if __name__ == '__main__':
+    main()
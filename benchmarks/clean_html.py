@@ -0,0 +1,126 @@
+"""
+Compares the speed of `HTMLCleaner` to the reference implementation
+
+    python -m benchmarks.clean_html [--db PATH] [--fragments N]
+
+By default the fragments are synthetic. With `--db` they're read from a LEGI
+database, and the outputs of the two cleaners are compared for every fragment
+of the DB before the timing starts.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+from argparse import ArgumentParser
+from random import Random
+import sys
+import timeit
+
+from legi.html import HTML_COLUMNS, HTMLCleaner, clean_html
+from legi.utils import connect_db
+
+from .archive import paragraphs, sentence
+from .html_reference import HTMLCleaner as ReferenceHTMLCleaner
+
+
+CLEANERS = [
+    ('reference', ReferenceHTMLCleaner),
+    ('current', HTMLCleaner),
+]
+
+
+def random_fragment(rand):
+    """Returns a fragment of messy HTML, similar to the content of LEGI.
+    """
+    r = []
+    for i in range(rand.randint(1, 6)):
+        x = rand.random()
+        if x < 0.4:
+            r.append(paragraphs(rand, rand.randint(1, 3)))
+        elif x < 0.55:
+            r.append('<p align="%s"> <span>%s</span> <br/>\n %s </p>' % (
+                rand.choice(('left', 'center')), sentence(rand, 6), sentence(rand, 8),
+            ))
+        elif x < 0.7:
+            r.append('<table border="1"><tr><td> %s </td><td></td></tr><tr> </tr></table>' %
+                     sentence(rand, 5))
+        elif x < 0.8:
+            r.append('<div dir="ltr"><font color="black" size="%i"> %s <i> %s</i> </font></div>' % (
+                rand.randint(0, 5), sentence(rand, 4), sentence(rand, 3),
+            ))
+        elif x < 0.9:
+            r.append('<pre>  %s\n   %s  </pre>' % (sentence(rand, 5), sentence(rand, 5)))
+        else:
+            r.append("L' <b>article %i</b> , <p id=\"x\"> </p>" % rand.randint(1, 100))
+    return '\n'.join(r)
+
+
+def iter_db_fragments(db):
+    for table, columns in HTML_COLUMNS:
+        q = db.all("SELECT {0} FROM {1}".format(', '.join(columns), table))
+        for row in q:
+            for html in row:
+                if html:
+                    yield html
+
+
+def compare(fragments):
+    """Checks that both cleaners return the same output, returns the number of mismatches.
+    """
+    reference, current = ReferenceHTMLCleaner(), HTMLCleaner()
+    mismatches = 0
+    for i, html in enumerate(fragments):
+        expected, actual = clean_html(html, reference), clean_html(html, current)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print("Mismatch for fragment #%i:" % i, html, expected, actual, sep='\n    ')
+    return mismatches
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--db', help="the LEGI database to read the fragments from")
+    p.add_argument('--fragments', type=int, default=2000,
+                   help="number of fragments used for the timing")
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+
+    if args.db:
+        db = connect_db(args.db)
+        print("Comparing the outputs of the cleaners...")
+        n = compare(iter_db_fragments(db))
+        if n:
+            print("%i fragments aren't cleaned identically" % n)
+            sys.exit(1)
+        fragments = []
+        for html in iter_db_fragments(db):
+            fragments.append(html)
+            if len(fragments) == args.fragments:
+                break
+    else:
+        rand = Random(args.seed)
+        fragments = [random_fragment(rand) for i in range(args.fragments)]
+        n = compare(fragments)
+        if n:
+            print("%i fragments aren't cleaned identically" % n)
+            sys.exit(1)
+
+    size = sum(map(len, fragments)) / len(fragments)
+    print("%i fragments, %i characters on average" % (len(fragments), size))
+    print("%-12s %14s" % ('cleaner', 'per fragment'))
+    times = {}
+    for name, cls in CLEANERS:
+        cleaner = cls()
+
+        def clean_all():
+            for html in fragments:
+                clean_html(html, cleaner)
+
+        times[name] = min(timeit.repeat(clean_all, number=1, repeat=args.repeat))
+        print("%-12s %12.1fus" % (name, times[name] / len(fragments) * 1e6))
+    print("speedup: %.2fx" % (times['reference'] / times['current']))
+
+
+if __name__ == '__main__':
+    main()
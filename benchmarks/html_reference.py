@@ -0,0 +1,213 @@
+"""
+The `HTMLCleaner` of legi.html before the rework of its hot path
+
+It's kept as a reference: `benchmarks.clean_html` measures the speed of the
+current cleaner against this one, and checks that their outputs are identical.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+from collections import namedtuple
+
+from legi.html import (
+    ASCII_SPACES, COLORS_MAP, DEFAULT_STYLE, KEEP_EMPTY, TRIM_AROUND_ELEMENTS,
+    USELESS_ATTRIBUTES, USELESS_WITHOUT_ATTRIBUTES, VOID_ELEMENTS,
+    bad_space_re, drop_bad_space, escape, quoteattr, unescape,
+)
+from legi.utils import ascii_spaces_re, group_by_2
+
+
+# An immutable type representing the opening of an HTML element
+StartTag = namedtuple('StartTag', 'tag void style dropped parent')
+
+# A fake StartTag which holds the default styles
+INVISIBLE_ROOT_TAG = StartTag(None, None, DEFAULT_STYLE, True, None)
+
+
+def is_start_of(s, tag):
+    x = tag.__len__()
+    return s[0] == '<' and s[1:x+1] == tag and s[x+1] in ' >' and s[-2] != '/'
+
+
+class HTMLCleaner(object):
+    """A parser target which returns cleaned HTML (as a string, not a tree).
+
+    Doc: http://lxml.de/parsing.html#the-target-parser-interface
+    """
+
+    def __init__(self):
+        self.at_segment_start = True
+        self.drop_line_breaks = True
+        self.last_trimmable_node = None
+        self.out = []
+        self.current_tag = INVISIBLE_ROOT_TAG
+        self.text_chunks = []
+
+    def start(self, tag, attrs):
+        # Add start tag to stack and output
+        void = tag in VOID_ELEMENTS
+        attrs_str = ''
+        parent = self.current_tag
+        parent_styles = parent.style
+        new_styles = {}
+        if attrs:
+            is_list_tag = tag in {'ul', 'ol'}
+            for k, v in group_by_2(attrs):
+                # Skip useless attributes
+                if k in USELESS_ATTRIBUTES:
+                    continue
+                # Skip obsolete list style attribute
+                if is_list_tag and k == 'type':
+                    continue
+                # Normalize the value
+                v = v.strip()
+                if k[-5:] == 'color':
+                    v = v.lower()
+                    if v[:4] == 'rgb(':
+                        v = '#%02x%02x%02x' % tuple(int(s.strip()) for s in v[4:-1].split(','))
+                    elif v.__len__() == 6 and v.isdigit():
+                        v = '#' + v
+                    else:
+                        v = COLORS_MAP.get(v, v)
+                # Skip redundant styles
+                parent_style = parent_styles.get(k)
+                if parent_style == v:
+                    continue
+                if parent_style:
+                    if k == 'size':
+                        size = int(v)
+                        # Skip 0 (invalid) and 4 through 7 (enlarged text)
+                        if size == 0 or size > 3:
+                            continue
+                    new_styles[k] = v
+                # Add to output
+                attrs_str += ' %s=%s' % (k, quoteattr(v))
+        if tag == 'pre':
+            new_styles['.collapse-spaces'] = False
+        styles = dict(parent_styles, **new_styles) if new_styles else parent_styles
+        if self.drop_line_breaks and ''.join(self.text_chunks).strip(ASCII_SPACES):
+            self.drop_line_breaks = False
+        dropped = (
+            not attrs_str and tag in USELESS_WITHOUT_ATTRIBUTES or
+            tag == 'br' and self.drop_line_breaks
+        )
+        start_tag = StartTag(tag, void, styles, dropped, parent)
+        if not dropped:
+            # Process queued text chunks
+            if self.text_chunks:
+                self.handle_text(next_tag=start_tag)
+            # Add start tag to output
+            self.out.append('<' + tag + attrs_str + ('/>' if void else '>'))
+        self.current_tag = start_tag
+
+    def end(self, tag):
+        start_tag = self.current_tag
+        # Don't add an end tag if the start tag was self-closed or skipped
+        if start_tag.void or start_tag.dropped:
+            self.current_tag = start_tag.parent
+            return
+        # Clean up empty elements
+        collapsed = False
+        if is_start_of(self.out[-1], tag):
+            if not ''.join(self.text_chunks).strip(ASCII_SPACES):
+                tag_has_attributes = self.out[-1].__len__() > tag.__len__() + 2
+                if tag_has_attributes or tag in KEEP_EMPTY:
+                    # Drop the whitespace chunks, if any
+                    self.text_chunks = []
+                    # Collapse the element
+                    self.out[-1] = self.out[-1][:-1] + '/>'
+                    collapsed = True
+                else:
+                    # Drop the element entirely
+                    self.out.pop()
+                    if self.out and self.out[-1][0] != '<':
+                        # Previous output element was a text node, put it back
+                        # in the chunks queue
+                        self.text_chunks.insert(0, unescape(self.out.pop()))
+                        # Reset last_trimmable_node (we don't need to restore
+                        # its previous value)
+                        self.last_trimmable_node = None
+                    self.current_tag = start_tag.parent
+                    return
+        # Process queued text chunks
+        if self.text_chunks:
+            self.handle_text()
+        # Handle whitespace collapsing
+        if tag in TRIM_AROUND_ELEMENTS:
+            # Drop tail space
+            if self.last_trimmable_node:
+                i, self.last_trimmable_node = self.last_trimmable_node, None
+                self.out[i] = self.out[i][:-1]
+            # Enable dropping the next space
+            self.at_segment_start = True
+        # Update current_tag
+        self.current_tag = start_tag.parent
+        # Add end tag to output
+        if not collapsed:
+            self.out.append('</%s>' % tag)
+
+    def data(self, text):
+        # We can't always get a single string for a text node, so we store
+        # chunks in a list and assemble them when we're ready
+        self.text_chunks.append(text)
+
+    def handle_text(self, next_tag=None):
+        text = ''.join(self.text_chunks)
+        self.text_chunks = []
+        if not text:
+            return
+        # Collapse spaces, unless we're inside a <pre>
+        # https://www.w3.org/TR/css-text-3/#white-space-processing
+        if self.current_tag.style['.collapse-spaces']:
+            text = ascii_spaces_re.sub(' ', text)
+            # Handle spaces around closing tags
+            i = self.last_trimmable_node
+            if i and not next_tag and self.out[i - 1][:2] == '</':
+                # `</i> foo </b>bar` → `</i> foo</b> bar`
+                trimmed = self.out[i][:-1]
+                if trimmed:
+                    self.out[i] = trimmed
+                else:
+                    self.out.pop(i)
+                i = self.last_trimmable_node = None
+                if text[0] != ' ':
+                    text = ' ' + text
+            # Drop leading space if the previous text node has a trailing space
+            # or if we're at the beginning of a "segment"
+            if text[0] == ' ' and (self.last_trimmable_node or self.at_segment_start):
+                text = text[1:]
+                if not text:
+                    return
+            # French-specific dropping of bad spaces, e.g. "l' article" → "l'article"
+            text = bad_space_re.sub(drop_bad_space, text)
+            # Are we about to open a new non-inline element?
+            if next_tag and next_tag.tag in TRIM_AROUND_ELEMENTS:
+                self.at_segment_start = True
+                # Drop tail space
+                if text[-1] == ' ':
+                    text = text[:-1]
+                    if not text:
+                        return
+            else:
+                self.at_segment_start = False
+            # Does the trimmable text node we're adding have a tail space?
+            if text[-1] == ' ':
+                self.last_trimmable_node = self.out.__len__()
+            else:
+                self.last_trimmable_node = None
+        else:
+            self.last_trimmable_node = None
+        # Stop dropping <br> tags
+        if self.drop_line_breaks:
+            self.drop_line_breaks = False
+        # Add to output
+        self.out.append(escape(text))
+
+    def close(self):
+        if self.text_chunks:
+            self.out.append(''.join(self.text_chunks).rstrip(ASCII_SPACES))
+        # Join the output into a single string, then reset the parser before
+        # returning so that it can be reused
+        r = ''.join(self.out)
+        self.__init__()
+        return r
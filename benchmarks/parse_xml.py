@@ -0,0 +1,78 @@
+"""
+Measures the time spent in `parse_xml`, per table
+
+    python -m benchmarks.parse_xml [--archive PATH] [--texts N]
+
+The time spent building the lxml trees is reported separately, the rest is
+the cost of extracting the data from the trees.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+from argparse import ArgumentParser
+import os
+import shutil
+import tempfile
+import timeit
+
+from lxml import etree
+
+from legi.tar2sqlite import get_file_info, parse_xml, read_files, split_path
+
+from .archive import generate_files, make_archive
+from .utils import quiet
+
+
+def load_files(archive_path):
+    """Returns the XML files of the archive, grouped by table.
+    """
+    files = {}
+    for path, mtime, read in read_files(archive_path):
+        parts = split_path(path)
+        if not parts[2].startswith('code_et_TNC_') or parts[-1][-4:] != '.xml':
+            continue
+        table, dossier, text_cid, text_id = get_file_info(parts)
+        files.setdefault(table, []).append((read(), table, text_id, text_cid))
+    return files
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--archive', help="the archive to read, by default a synthetic one is generated")
+    p.add_argument('--texts', type=int, default=5, help="size of the synthetic archive")
+    p.add_argument('--repeat', type=int, default=5)
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        archive_path = args.archive
+        if not archive_path:
+            archive_path = os.path.join(tmpdir, 'legi_global_20180101-000000.tar.gz')
+            make_archive(archive_path, generate_files(n_texts=args.texts))
+        with quiet():
+            files = load_files(archive_path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    xml = etree.XMLParser(remove_blank_text=True)
+
+    def build_trees(jobs):
+        for data, table, text_id, text_cid in jobs:
+            xml.feed(data)
+            xml.close()
+
+    def parse(jobs):
+        for job in jobs:
+            parse_xml(xml, *job)
+
+    print("%-16s %8s %12s %12s" % ('table', 'files', 'lxml tree', 'parse_xml'))
+    for table, jobs in sorted(files.items()):
+        times = [
+            min(timeit.repeat(lambda: f(jobs), number=1, repeat=args.repeat)) / len(jobs) * 1e6
+            for f in (build_trees, parse)
+        ]
+        print("%-16s %8i %10.1fus %10.1fus" % ((table, len(jobs)) + tuple(times)))
+
+
+if __name__ == '__main__':
+    main()
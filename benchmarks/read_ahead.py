@@ -0,0 +1,64 @@
+"""
+Compares the import of an archive with and without the reader thread
+
+    python -m benchmarks.read_ahead [--archive PATH] [--texts N] [--workers N]
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+from argparse import ArgumentParser
+import os
+import shutil
+import tempfile
+import time
+
+from legi.tar2sqlite import process_archive
+from legi.utils import connect_db
+
+from .archive import generate_files, make_archive
+from .utils import quiet
+
+
+def time_import(archive_path, tmpdir, **kw):
+    db_path = os.path.join(tmpdir, 'legi.sqlite')
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+    db = connect_db(db_path)
+    with quiet():
+        start = time.time()
+        with db:
+            process_archive(db, archive_path, **kw)
+        duration = time.time() - start
+    db.close()
+    return duration
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--archive', help="the archive to import, by default a synthetic one is generated")
+    p.add_argument('--texts', type=int, default=20, help="size of the synthetic archive")
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=3)
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        archive_path = args.archive
+        if not archive_path:
+            archive_path = os.path.join(tmpdir, 'legi_global_20180101-000000.tar.gz')
+            print("Generating a synthetic archive of %i texts..." % args.texts)
+            make_archive(archive_path, generate_files(n_texts=args.texts))
+        results = {}
+        for i in range(args.repeat):
+            for read_ahead in (False, True):
+                duration = time_import(archive_path, tmpdir, workers=args.workers, read_ahead=read_ahead)
+                results[read_ahead] = min(results.get(read_ahead, duration), duration)
+        for read_ahead, duration in sorted(results.items()):
+            print("read_ahead=%-5s  %.2fs" % (read_ahead, duration))
+        print("speedup: %.2fx" % (results[False] / results[True]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
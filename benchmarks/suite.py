@@ -0,0 +1,148 @@
+"""
+Times the main operations of legi.py on synthetic archives
+
+    python -m benchmarks.suite [--texts N] [--articles N] [--json PATH] [--baseline PATH]
+
+The archives are generated by `benchmarks.archive`, so the suite runs offline.
+Each operation works on the DB produced by the previous ones, the whole
+pipeline is run `--repeat` times on a new DB and the best time of each
+operation is kept.
+
+To catch a performance regression, save the results of a run with `--json`,
+then pass that file as `--baseline` to a later run: the exit status is 1 if an
+operation is slower than the baseline by more than `--tolerance`.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import tempfile
+
+from legi.anomalies import detect_anomalies
+from legi.export import iterate_cid
+from legi.factorize import main as factorize
+from legi.html import clean_all_html_in_db
+from legi.normalize import main as normalize
+from legi.tar2sqlite import process_archive
+from legi.utils import connect_db, perf_counter
+
+from .archive import make_archives
+from .utils import quiet
+
+
+def import_archive(db, archive_path):
+    with db:
+        process_archive(db, archive_path)
+        archive_date = os.path.basename(archive_path).split('_')[-1].split('.')[0]
+        db.insert('db_meta', dict(key='last_update', value=archive_date), replace=True)
+
+
+def import_global_archive(db, archives):
+    import_archive(db, archives[0])
+
+
+def import_daily_archives(db, archives):
+    for archive_path in archives[1:]:
+        import_archive(db, archive_path)
+
+
+def export_all_texts(db, archives):
+    for cid in [r[0] for r in db.all("SELECT DISTINCT cid FROM textes_versions")]:
+        for e in iterate_cid(db, cid):
+            pass
+
+
+def find_anomalies(db, archives):
+    with open(os.devnull, 'w') as devnull:
+        detect_anomalies(db, devnull)
+
+
+BENCHMARKS = [
+    ('tar2sqlite.global', import_global_archive),
+    ('tar2sqlite.daily', import_daily_archives),
+    ('normalize', lambda db, archives: normalize(db)),
+    ('factorize', lambda db, archives: factorize(db)),
+    ('clean_html', lambda db, archives: clean_all_html_in_db(db, check=False)),
+    ('anomalies', find_anomalies),
+    ('export', export_all_texts),
+]
+
+
+def run(archives, tmpdir):
+    """Runs the benchmarks on a new DB, returns the duration of each one.
+    """
+    db_path = os.path.join(tmpdir, 'legi.sqlite')
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+    db = connect_db(db_path)
+    results = {}
+    for name, f in BENCHMARKS:
+        with quiet():
+            start = perf_counter()
+            f(db, archives)
+            db.commit()
+            results[name] = perf_counter() - start
+    db.close()
+    return results
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--texts', type=int, default=20)
+    p.add_argument('--articles', type=int, default=500, help="number of articles per text")
+    p.add_argument('--duplicates', type=float, default=0.01, help="ratio of duplicated articles")
+    p.add_argument('--daily', type=int, default=2, help="number of daily archives")
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--json', metavar='PATH', help="save the results in a JSON file")
+    p.add_argument('--baseline', metavar='PATH', help="compare the results to a previous run")
+    p.add_argument('--tolerance', type=float, default=1.2,
+                   help="the maximum ratio between the new and the baseline durations")
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print("Generating the synthetic archives...")
+        archives = make_archives(
+            tmpdir, args.texts, args.articles, n_daily=args.daily, duplicate_ratio=args.duplicates,
+        )
+        results = {}
+        for i in range(args.repeat):
+            for name, duration in run(archives, tmpdir).items():
+                results[name] = min(results.get(name, duration), duration)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    params = dict(texts=args.texts, articles=args.articles, duplicates=args.duplicates,
+                  daily=args.daily)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print("Warning: the baseline was measured with different parameters:", baseline['params'])
+        baseline = baseline['results']
+    regressions = []
+    print("%-20s %10s %10s %8s" % ('benchmark', 'seconds', 'baseline', 'ratio'))
+    for name, f in BENCHMARKS:
+        duration = results[name]
+        line = "%-20s %10.3f" % (name, duration)
+        if name in baseline:
+            ratio = duration / baseline[name] if baseline[name] else 1
+            line += " %10.3f %7.2fx" % (baseline[name], ratio)
+            if ratio > args.tolerance:
+                line += "  regression"
+                regressions.append(name)
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=4, sort_keys=True)
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+Helpers shared by the benchmarks
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+from contextlib import contextmanager
+import os
+import sys
+
+
+@contextmanager
+def quiet():
+    """Silences the output of the code being measured (prints, progress bars).
+    """
+    with open(os.devnull, 'w') as devnull:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
@@ -3,6 +3,8 @@
 from __future__ import division, print_function, unicode_literals
 
 from argparse import ArgumentParser
+import gzip
+import json
 from math import ceil
 import os
 import re
@@ -10,6 +12,7 @@ from string import Template
 
 
 self_dir = os.path.dirname(os.path.abspath(__file__))
+index_fname = 'anomalies-index.jsonl'
 
 
 def columns(l, height=100):
@@ -34,7 +37,19 @@ def main():
     # Collect stats
     fname_re = re.compile(r'^anomalies-([0-9]{8})-[0-9]{6}.txt$')
     stats = []
-    files = sorted(os.listdir('.'))
+    all_files = set(os.listdir('.'))
+    # The index written by tar2sqlite contains the number of anomalies of each
+    # run, the files of a run are only read if it isn't in the index
+    counts = {}
+    if index_fname in all_files:
+        with open(index_fname, 'rb') as f:
+            for line in f:
+                header = json.loads(line.decode('utf8'))
+                counts['anomalies-' + header['date'] + '.txt'] = header['count']
+    files = sorted(
+        fname for fname in all_files
+        if not fname.endswith('.jsonl.gz') and fname != index_fname
+    )
     for fname in files:
         m = fname_re.match(fname)
         if not m:
@@ -42,8 +57,16 @@ def main():
             continue
         day = m.group(1)
         isodate = day[:4] + '-' + day[4:6] + '-' + day[6:]
-        with open(fname, 'r') as f:
-            n_lines = f.read().count('\n')
+        delta_fname = fname[:-4] + '.jsonl.gz'
+        if fname in counts:
+            n_lines = counts[fname]
+        elif delta_fname in all_files:
+            # The first line of the delta file contains the number of anomalies
+            with gzip.open(delta_fname, 'rb') as f:
+                n_lines = json.loads(f.readline().decode('utf8'))['count']
+        else:
+            with open(fname, 'r') as f:
+                n_lines = f.read().count('\n')
         stats.append({'key': isodate, 'value': n_lines, 'href': 'logs/' + fname})
 
     # Render report
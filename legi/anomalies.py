@@ -3,22 +3,44 @@
 from __future__ import division, print_function, unicode_literals
 
 from argparse import ArgumentParser
+from collections import Counter
 from datetime import date, timedelta
+import gzip
+import json
+from multiprocessing import Pool
 import sys
 
 from .titles import NATURE_MAP_R, parse_titre, spaces_re
-from .utils import connect_db, reconstruct_path, strip_down
+from .utils import (
+    connect_db, get_processed_until, reconstruct_path, set_processed_until, strip_down,
+)
 
 
-def anomalies_date_fin_etat(db, err):
-    a = [('articles', 'article'), ('textes_versions', 'texte/version')]
-    last_update = db.one("SELECT value FROM db_meta WHERE key = 'last_update'")
+def get_dates(last_update):
+    """Returns the current day and the "near future" (5 days later) of a
+    `last_update` value, as ISO dates.
+    """
     day, heure = last_update.split('-')
     assert len(day) == 8
     annee, mois, jour = day[:4], day[4:6], day[6:]
     current_day = annee + '-' + mois + '-' + jour
     near_future = date(int(annee), int(mois), int(jour)) + timedelta(days=5)
-    near_future = near_future.isoformat()
+    return current_day, near_future.isoformat()
+
+
+def in_scope(column, scope):
+    """Returns an SQL condition limiting a check to the IDs of the `scope` table,
+    or an always true condition if `scope` is `None`.
+    """
+    if scope is None:
+        return '1'
+    return '{0} IN (SELECT id FROM {1})'.format(column, scope)
+
+
+def anomalies_date_fin_etat(db, err, scope=None):
+    a = [('articles', 'article'), ('textes_versions', 'texte/version')]
+    last_update = db.one("SELECT value FROM db_meta WHERE key = 'last_update'")
+    current_day, near_future = get_dates(last_update)
     for table, sous_dossier in a:
         q = db.all("""
             SELECT dossier, cid, id, date_fin, etat
@@ -27,7 +49,8 @@ def anomalies_date_fin_etat(db, err):
                AND ( etat LIKE 'VIGUEUR%' AND date_fin < '{1}' OR
                      etat NOT LIKE 'VIGUEUR%' AND etat <> 'ABROGE_DIFF' AND date_fin > '{2}'
                    )
-        """.format(table, current_day, near_future))
+               AND {3}
+        """.format(table, current_day, near_future, in_scope('id', scope)))
         for row in q:
             dossier, cid, id, date_fin, etat = row
             path = reconstruct_path(dossier, cid, sous_dossier, id)
@@ -35,30 +58,44 @@ def anomalies_date_fin_etat(db, err):
             err(path, 'la date de fin "', date_fin, '" est dans le ', x, ' mais l\'état est "', etat, '"')
 
 
-def anomalies_element_sommaire(db, err):
+def anomalies_element_sommaire(db, err, scope=None):
+    if scope is None:
+        source_in_scope = '1'
+    else:
+        # The anomalies are reported on the source of the summary, which is in
+        # the same text, so the `cid` index can be used
+        source_in_scope = """
+            so.cid IN (SELECT cid FROM {0})
+            AND ( so._source = 'section_ta_liens' AND so.parent IN (SELECT id FROM {0}) OR
+                  so._source IN (SELECT 'struct/' || id FROM {0})
+                )
+        """.format(scope)
     q = db.all("""
-        SELECT cid, parent, _source, element, position
+        SELECT so.cid, so.parent, so._source, so.element, so.position,
+               coalesce(s.dossier, ts.dossier)
           FROM sommaires so
-         WHERE ( CASE WHEN substr(so.element, 5, 4) = 'ARTI'
-                           THEN (SELECT count(*) FROM articles a WHERE a.id = so.element)
-                      WHEN substr(so.element, 5, 4) = 'SCTA'
-                           THEN (SELECT count(*) FROM sections s WHERE s.id = so.element)
-                      ELSE 1
-                 END ) = 0
-    """)
-    for cid, parent, _source, element, position in q:
+     LEFT JOIN sections s ON so._source = 'section_ta_liens' AND s.id = so.parent
+     LEFT JOIN textes_structs ts ON substr(so._source, 1, 7) = 'struct/'
+                                AND ts.id = substr(so._source, 8)
+         WHERE ( substr(so.element, 5, 4) = 'ARTI' AND NOT EXISTS (
+                     SELECT 1 FROM articles a WHERE a.id = so.element
+                 ) OR
+                 substr(so.element, 5, 4) = 'SCTA' AND NOT EXISTS (
+                     SELECT 1 FROM sections s2 WHERE s2.id = so.element
+                 )
+               )
+           AND {0}
+    """.format(source_in_scope))
+    for cid, parent, _source, element, position, dossier in q:
         if _source == 'section_ta_liens':
             source_id = parent
-            dossier = db.one("SELECT dossier FROM sections WHERE id = ?", (source_id,))
-            assert dossier
             sous_dossier = 'section_ta'
         elif _source.startswith('struct/'):
             source_id = _source[7:]
-            dossier = db.one("SELECT dossier FROM textes_structs WHERE id = ?", (source_id,))
-            assert dossier
             sous_dossier = 'texte/struct'
         else:
             raise Exception('unexpected `_source` value')
+        assert dossier
         path = reconstruct_path(dossier, cid, sous_dossier, source_id)
         element_type = element[4:8]
         if element_type == 'ARTI':
@@ -67,37 +104,45 @@ def anomalies_element_sommaire(db, err):
             err(path, "la section %s référencée en position %i est introuvable" % (element, position + 1))
 
 
-def anomalies_orphans(db, err):
-    db.run("CREATE INDEX IF NOT EXISTS sommaires_element_idx ON sommaires (element)")
+def anomalies_orphans(db, err, scope=None):
     q = db.all("""
         SELECT dossier, cid, id
           FROM articles a
-         WHERE (SELECT count(*) FROM sommaires so WHERE so.element = a.id) = 0
-    """)
+         WHERE NOT EXISTS (SELECT 1 FROM sommaires so WHERE so.element = a.id)
+           AND {0}
+    """.format(in_scope('a.id', scope)))
     for dossier, cid, id in q:
         path = reconstruct_path(dossier, cid, 'article', id)
         err(path, "article orphelin, il n'apparaît dans aucun texte")
     q = db.all("""
         SELECT dossier, cid, id
           FROM sections s
-         WHERE (SELECT count(*) FROM sommaires so WHERE so.element = s.id) = 0
-    """)
+         WHERE NOT EXISTS (SELECT 1 FROM sommaires so WHERE so.element = s.id)
+           AND {0}
+    """.format(in_scope('s.id', scope)))
     for dossier, cid, id in q:
         path = reconstruct_path(dossier, cid, 'section_ta', id)
         err(path, "section orpheline, elle n'apparaît dans aucun texte")
-    db.run("DROP INDEX sommaires_element_idx")
 
 
-def anomalies_sections(db, err):
+def anomalies_sections(db, err, scope=None):
+    if scope is None:
+        section_in_scope = '1'
+    else:
+        # The summary of a section is in the same text, so the `cid` index can be used
+        section_in_scope = """
+            s.id IN (SELECT id FROM {0}) AND so.cid IN (SELECT cid FROM {0})
+        """.format(scope)
     q = db.all("""
         SELECT s.dossier, s.cid, s.id, num, debut, etat, count(*) as count
           FROM sommaires so
           JOIN sections s ON s.id = so.parent
          WHERE etat NOT LIKE 'MODIF%'
            AND lower(num) NOT LIKE 'annexe%'
+           AND {0}
       GROUP BY s.id, num, debut, etat
         HAVING count(*) > 1
-    """)
+    """.format(section_in_scope))
     for row in q:
         dossier, cid, section, num, debut, etat, count = row
         path = reconstruct_path(dossier, cid, 'section_ta', section)
@@ -110,7 +155,8 @@ def anomalies_sections(db, err):
           FROM sommaires so
           JOIN articles a ON a.id = so.element AND a.etat <> so.etat
           JOIN sections s ON s.id = so.parent
-    """)
+         WHERE {0}
+    """.format(section_in_scope))
     for row in q:
         dossier, cid, id, a_dossier, a_cid, a_id, sa_etat, a_etat = row
         path = reconstruct_path(dossier, cid, 'section_ta', id)
@@ -119,7 +165,7 @@ def anomalies_sections(db, err):
             '" dans le fichier ', a_path)
 
 
-def anomalies_textes_versions(db, err):
+def anomalies_textes_versions(db, err, scope=None):
     def normalize_title(path, col, title):
         if not title:
             return title
@@ -132,7 +178,8 @@ def anomalies_textes_versions(db, err):
     q = db.all("""
         SELECT dossier, cid, id, titre, titrefull, nature, num, date_texte
           FROM textes_versions_brutes_view
-    """)
+         WHERE {0}
+    """.format(in_scope('id', scope)))
     for row in q:
         dossier, cid, id, titre_o, titrefull_o, nature_o, num, date_texte = row
         path = reconstruct_path(dossier, cid, 'texte/version', id)
@@ -211,35 +258,302 @@ def anomalies_textes_versions(db, err):
                 get_key('calendar')
 
 
-def anomalies_textes_vides(db, err):
+def anomalies_textes_vides(db, err, scope=None):
     q = db.all("""
         SELECT dossier, cid, id
           FROM textes_structs ts
-         WHERE (SELECT count(*) FROM sommaires so WHERE so.cid = ts.cid AND so._source = 'struct/'||ts.id) = 0
-    """)
+         WHERE NOT EXISTS (
+                   SELECT 1 FROM sommaires so WHERE so.cid = ts.cid AND so._source = 'struct/'||ts.id
+               )
+           AND {0}
+    """.format(in_scope('ts.id', scope)))
     for dossier, cid, id in q:
         path = reconstruct_path(dossier, cid, 'texte/struct', id)
         err(path, 'texte vide')
 
 
-def detect_anomalies(db, out=sys.stdout):
-    count = [0]
+CHECKS = [
+    anomalies_date_fin_etat,
+    anomalies_element_sommaire,
+    anomalies_orphans,
+    anomalies_sections,
+    anomalies_textes_versions,
+    anomalies_textes_vides,
+]
+
+CHECK_INDEXES = {check.__name__[len('anomalies_'):]: i for i, check in enumerate(CHECKS)}
+
+
+def create_scope_table(db):
+    db.run("""
+        CREATE TEMP TABLE anomalies_scope
+        ( id    char(20)   not null
+        , cid   char(20)   not null
+        , UNIQUE (id, cid)
+        )
+    """)
+
+
+def get_scope(db, since):
+    """Fills the `anomalies_scope` temporary table with the IDs of the entities
+    whose anomalies may have changed since `since` (a `last_update` value).
+
+    An anomaly is always reported on one entity (article, section, struct or
+    version of a text), and the checks only look at the entity itself and at
+    its links in `sommaires`. So the entities in scope are:
+
+    - the ones listed in `changes_log`, including the elements removed from a
+      summary (logged under the `sommaires` pseudo-table);
+    - the parents in `sommaires` of the changed entities, because a missing
+      element or a state mismatch is reported on the summary's source;
+    - the elements of the changed summaries, because they can stop being orphans;
+    - the articles and versions of texts whose `date_fin` is between the day of
+      `since` and the near future of the current `last_update`, because the
+      anomalies detected by `anomalies_date_fin_etat` depend on the date.
+
+    Returns the set of IDs.
+    """
+    create_scope_table(db)
+    db.run("""
+        INSERT OR IGNORE INTO anomalies_scope (id, cid)
+             SELECT id, cid
+               FROM changes_log
+              WHERE archive_date > ?
+    """, (since,))
+    db.run("""
+        INSERT OR IGNORE INTO anomalies_scope (id, cid)
+             SELECT CASE WHEN so._source = 'section_ta_liens'
+                         THEN so.parent
+                         ELSE substr(so._source, 8)
+                    END, so.cid
+               FROM changes_log c
+               JOIN sommaires so ON so.element = c.id
+              WHERE c.archive_date > ?
+                AND c.tbl IN ('articles', 'sections', 'sommaires')
+    """, (since,))
+    for table, condition in (('sections', "so.parent = c.id AND so._source = 'section_ta_liens'"),
+                             ('textes_structs', "so._source = 'struct/' || c.id")):
+        db.run("""
+            INSERT OR IGNORE INTO anomalies_scope (id, cid)
+                 SELECT so.element, so.cid
+                   FROM changes_log c
+                   JOIN sommaires so ON so.cid = c.cid AND {0}
+                  WHERE c.archive_date > ?
+                    AND c.tbl = ?
+        """.format(condition), (since, table))
+    last_update = db.one("SELECT value FROM db_meta WHERE key = 'last_update'")
+    since_day = get_dates(since)[0]
+    near_future = get_dates(last_update)[1]
+    for table in ('articles', 'textes_versions'):
+        db.run("""
+            INSERT OR IGNORE INTO anomalies_scope (id, cid)
+                 SELECT id, cid
+                   FROM {0}
+                  WHERE date_fin >= ?
+                    AND date_fin <= ?
+        """.format(table), (since_day, near_future))
+    # The summaries are looked up by `cid`, so the current `cid` of the
+    # sections and structs in scope is needed
+    for table in ('sections', 'textes_structs'):
+        db.run("""
+            INSERT OR IGNORE INTO anomalies_scope (id, cid)
+                 SELECT t.id, t.cid
+                   FROM anomalies_scope sc
+                   JOIN {0} t ON t.id = sc.id
+        """.format(table))
+    return set(row[0] for row in db.all("SELECT id FROM anomalies_scope"))
+
+
+def get_entity_id(path):
+    """Returns the ID of the entity an anomaly is reported on, based on its path.
+    """
+    return path.rsplit('/', 1)[-1][:-4]
+
+
+def format_anomaly(path, args):
+    """Returns the line of the text report describing an anomaly.
+
+    `args` is the JSON array of the message parts passed to `err` by the check.
+    """
+    return ''.join('{0}'.format(x) for x in [path, ': '] + json.loads(args)) + '\n'
+
+
+def run_check(db, check, scope=None):
+    """Runs one of the `CHECKS`, returns the anomalies it has found.
+
+    An anomaly is a tuple `(path, check_name, id, args)`, see the `anomalies`
+    table.
+    """
+    check_name = check.__name__[len('anomalies_'):]
+    anomalies = []
     def err(path, *a):
-        print(path, ': ', *a, sep='', file=out)
-        out.flush()
-        count[0] += 1
+        anomalies.append((path, check_name, get_entity_id(path), json.dumps(a)))
+
+    check(db, err, scope=scope)
+    return anomalies
+
+
+worker_db = None
+
+
+def init_worker(address, scope_rows):
+    """Opens the read-only connection of a worker process.
+
+    The temporary `anomalies_scope` table of the parent process isn't visible
+    from other connections, so it's recreated from `scope_rows`.
+    """
+    global worker_db
+    worker_db = connect_db(address, create_schema=False, update_schema=False)
+    if scope_rows is not None:
+        create_scope_table(worker_db)
+        worker_db.executemany("INSERT INTO anomalies_scope (id, cid) VALUES (?, ?)", scope_rows)
+        worker_db.commit()
+    worker_db.run("PRAGMA query_only = ON")
+
+
+def run_check_in_worker(job):
+    i, scope = job
+    return run_check(worker_db, CHECKS[i], scope)
+
+
+def run_checks(db, scope=None, workers=1):
+    """Runs all the `CHECKS`, returns the anomalies they have found.
+
+    If `workers` is greater than 1, the checks are run concurrently in that
+    many processes, each with its own read-only connection to the DB. They only
+    see the data that has been committed, and the DB must not be modified in
+    the meantime, otherwise the checks could see different states of the data.
+    """
+    if workers == 1:
+        return [anomaly for check in CHECKS for anomaly in run_check(db, check, scope)]
+    if db.address == ':memory:':
+        raise ValueError("the anomalies of an in-memory DB can't be detected in several processes")
+    scope_rows = None
+    if scope:
+        scope_rows = list(db.all("SELECT id, cid FROM {0}".format(scope)))
+    pool = Pool(min(workers, len(CHECKS)), init_worker, (db.address, scope_rows))
+    try:
+        results = pool.map(run_check_in_worker, [(i, scope) for i in range(len(CHECKS))])
+    finally:
+        pool.terminate()
+        pool.join()
+    return [anomaly for anomalies in results for anomaly in anomalies]
+
+
+def write_delta(f, header, appeared, disappeared, index=None):
+    """Writes the changes of the anomalies of the DB into `f`, in JSON Lines.
+
+    The first line is the `header` object, which contains the total number of
+    anomalies (`count`) and the `last_update` of the DB before (`since`) and
+    after (`date`) the changes. It's followed by one line per anomaly that has
+    appeared (`"change": "+"`) or disappeared (`"change": "-"`), with the
+    `path` and `id` of the entity, the name of the `check`, and the `args` of
+    the message.
+
+    If `index` is provided, the header line is also appended to it, so that
+    the counts of all the runs can be read from a single file.
+
+    `f` and `index` must be opened in binary mode.
+    """
+    def write(obj, f=f):
+        f.write((json.dumps(obj, sort_keys=True) + '\n').encode('utf8'))
+
+    header = dict(header, appeared=len(appeared), disappeared=len(disappeared))
+    write(header)
+    if index:
+        write(header, index)
+        index.flush()
+    changes = [(a, '+') for a in appeared] + [(a, '-') for a in disappeared]
+    for (path, check_name, id, args), change in sorted(changes):
+        write(dict(change=change, path=path, check=check_name, id=id, args=json.loads(args)))
+
+
+def detect_anomalies(db, out=sys.stdout, full=False, workers=1, delta=None, index=None):
+    """Detects the anomalies of the DB and writes them into `out`, one per line.
+
+    The anomalies are listed in the order of the `CHECKS`, and sorted by path
+    within each check, so the reports of two identical DBs are identical, even
+    if the checks are run concurrently (see `run_checks`).
+
+    The anomalies are also stored in the `anomalies` table. When the table
+    holds the anomalies of a previous `last_update`, only the entities that
+    have changed since then are checked again (see `get_scope`), unless `full`
+    is true. The report is identical to the one a full detection would produce.
+
+    If `delta` is provided, the anomalies that have appeared or disappeared
+    since the previous detection are written into it, and the header of the
+    delta is appended to `index`, see `write_delta`.
 
-    anomalies_date_fin_etat(db, err)
-    anomalies_element_sommaire(db, err)
-    anomalies_orphans(db, err)
-    anomalies_sections(db, err)
-    anomalies_textes_versions(db, err)
-    anomalies_textes_vides(db, err)
-    return count[0]
+    Returns the number of anomalies.
+    """
+    since = get_processed_until(db, 'anomalies')
+    if full or since is None:
+        new = run_checks(db, workers=workers)
+        old = list(db.all("SELECT path, check_name, id, args FROM anomalies"))
+        db.run("DELETE FROM anomalies")
+    else:
+        scope = get_scope(db, since)
+        print("> Detecting the anomalies of %i entities that may have changed since %s" %
+              (len(scope), since), file=sys.stderr)
+        try:
+            new = run_checks(db, scope='anomalies_scope', workers=workers)
+            old = list(db.all("""
+                SELECT path, check_name, id, args
+                  FROM anomalies
+                 WHERE id IN (SELECT id FROM anomalies_scope)
+            """))
+            db.run("DELETE FROM anomalies WHERE id IN (SELECT id FROM anomalies_scope)")
+        finally:
+            db.run("DROP TABLE anomalies_scope")
+    db.executemany("""
+        INSERT INTO anomalies (path, check_name, id, args) VALUES (?, ?, ?, ?)
+    """, new)
+    lines = [format_anomaly(path, args) for _, path, args in sorted(
+        (CHECK_INDEXES[check_name], path, args) for path, check_name, args in db.all("""
+            SELECT path, check_name, args FROM anomalies
+        """)
+    )]
+    for line in lines:
+        out.write(line)
+    out.flush()
+    if delta:
+        old, new = Counter(old), Counter(new)
+        write_delta(delta, {
+            'count': len(lines),
+            'date': db.one("SELECT value FROM db_meta WHERE key = 'last_update'"),
+            'since': since,
+        }, list((new - old).elements()), list((old - new).elements()), index=index)
+        delta.flush()
+    set_processed_until(db, 'anomalies')
+    return len(lines)
 
 
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('db')
+    p.add_argument('--full', action='store_true', default=False,
+                   help="check all the entities, not just the ones that have changed since the "
+                        "previous detection")
+    p.add_argument('--delta', metavar='PATH',
+                   help="write the anomalies that have appeared or disappeared since the previous "
+                        "detection into a JSON Lines file (compressed if PATH ends with `.gz`)")
+    p.add_argument('--index', metavar='PATH',
+                   help="append the first line of the delta, which contains the number of "
+                        "anomalies, to this file (requires `--delta`)")
+    p.add_argument('--workers', type=int, default=1,
+                   help="number of processes used to run the checks concurrently")
     args = p.parse_args()
-    detect_anomalies(connect_db(args.db))
+    db = connect_db(args.db)
+    delta, index = None, None
+    if args.delta:
+        delta = (gzip.open if args.delta.endswith('.gz') else open)(args.delta, 'wb')
+    if args.index:
+        index = open(args.index, 'ab')
+    try:
+        detect_anomalies(db, full=args.full, workers=args.workers, delta=delta, index=index)
+    finally:
+        if delta:
+            delta.close()
+        if index:
+            index.close()
+    db.commit()
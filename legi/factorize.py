@@ -10,7 +10,19 @@ from .normalize import main as normalize
 from .utils import connect_db
 
 
-def connect_by_nature_num(db):
+def in_scope(column='id'):
+    """Returns the condition used to limit the work to the rows that need to be
+    factorized again, see `main`. `column` is the (possibly qualified) name of
+    the `textes_versions.id` column in the query.
+    """
+    return "AND {0} IN (SELECT id FROM factorize_scope)".format(column)
+
+
+# The columns of `textes_versions` that determine the factorization
+KEY_COLUMNS = ('texte_id', 'nature', 'num', 'nor', 'titrefull_s', 'cid')
+
+
+def connect_by_nature_num(db, scope=''):
     db.run("""
         UPDATE textes_versions
            SET texte_id = (
@@ -25,23 +37,25 @@ def connect_by_nature_num(db):
                      FROM textes t
                     WHERE t.nature = textes_versions.nature
                       AND t.num = textes_versions.num
-               );
-    """)
+               )
+           {0};
+    """.format(scope))
     print('connected %i rows of textes_versions based on (nature, num)' % db.changes())
 
 
-def connect_by_nor(db):
+def connect_by_nor(db, scope=''):
     db.run("""
         CREATE TEMP TABLE texte_by_nor AS
-            SELECT nor, min(texte_id)
+            SELECT nor, min(texte_id) AS texte_id
               FROM textes_versions
              WHERE nor IS NOT NULL
                AND texte_id IS NOT NULL
+               {0}
           GROUP BY nor
             HAVING min(nature) = max(nature)
                AND min(num) = max(num)
                AND min(texte_id) = max(texte_id);
-    """)
+    """.format(scope))
     db.run("CREATE UNIQUE INDEX texte_by_nor_index ON texte_by_nor (nor)")
     db.run("""
         UPDATE textes_versions
@@ -55,19 +69,26 @@ def connect_by_nor(db):
                    SELECT texte_id
                      FROM texte_by_nor t
                     WHERE t.nor = textes_versions.nor
-               );
-    """)
+               )
+           {0};
+    """.format(scope))
     print('connected %i rows of textes_versions based on nor' % db.changes())
     db.run("DROP TABLE texte_by_nor")
 
 
-def connect_by_titrefull_s(db):
+def connect_by_titrefull_s(db, scope=''):
+    # A title shared by rows that belong to different textes is ambiguous, it
+    # isn't used. The rows are connected later, once `factorize_by` has merged
+    # those textes.
     db.run("""
         CREATE TEMP TABLE texte_by_titrefull_s AS
-            SELECT DISTINCT titrefull_s, texte_id
+            SELECT titrefull_s, min(texte_id) AS texte_id
               FROM textes_versions
-             WHERE texte_id IS NOT NULL;
-    """)
+             WHERE texte_id IS NOT NULL
+               {0}
+          GROUP BY titrefull_s
+            HAVING min(texte_id) = max(texte_id);
+    """.format(scope))
     db.run("CREATE UNIQUE INDEX texte_by_titrefull_s_index ON texte_by_titrefull_s (titrefull_s)")
     db.run("""
         UPDATE textes_versions
@@ -81,25 +102,42 @@ def connect_by_titrefull_s(db):
                    SELECT texte_id
                      FROM texte_by_titrefull_s t
                     WHERE t.titrefull_s = textes_versions.titrefull_s
-               );
-    """)
+               )
+           {0};
+    """.format(scope))
     print('connected %i rows of textes_versions based on titrefull_s' % db.changes())
     db.run("DROP TABLE texte_by_titrefull_s")
 
 
-def factorize_by(db, key):
-    duplicates = db.all("""
+def factorize_by(db, key, scope=''):
+    # The duplicates are selected before any merge, otherwise SQLite can read
+    # the groups while the textes are being merged and the result depends on
+    # the query plan. A group that contains textes which have already been
+    # merged during this pass is applied to the textes they've been merged
+    # into, so the merges are transitive.
+    duplicates = list(db.all("""
         SELECT min(nature), {0}, group_concat(texte_id)
           FROM textes_versions
          WHERE texte_id IS NOT NULL
+           {1}
       GROUP BY {0}
         HAVING min(texte_id) <> max(texte_id)
            AND min(nature) = max(nature)
-    """.format(key))
+    """.format(key, scope)))
+    merged = {}
+
+    def current(texte_id):
+        while texte_id in merged:
+            texte_id = merged[texte_id]
+        return texte_id
+
     total = 0
     factorized = 0
     for row in duplicates:
-        ids = tuple(row[2].split(','))
+        rows_ids = row[2].split(',')
+        ids = sorted(set(current(int(i)) for i in rows_ids))
+        if len(ids) < 2:
+            continue
         uid = db.one("SELECT id FROM textes ORDER BY id DESC LIMIT 1") + 1
         if key == 'cid':
             db.run("INSERT INTO textes (id, nature) VALUES (?, ?)", (uid, row[0]))
@@ -110,14 +148,16 @@ def factorize_by(db, key):
             UPDATE textes_versions
                SET texte_id = %s
              WHERE texte_id IN (%s);
-        """ % (uid, row[2]))
-        total += len(ids)
+        """ % (uid, ','.join(map(str, ids))))
+        for texte_id in ids:
+            merged[texte_id] = uid
+        total += len(rows_ids)
         factorized += 1
     print('factorized %i duplicates into %i uniques based on %s' % (total, factorized, key))
 
 
-def main(db):
-    connect_by_nature_num(db)
+def factorize_in_sql(db, scope=''):
+    connect_by_nature_num(db, scope)
 
     db.run("""
         INSERT INTO textes (nature, num)
@@ -127,13 +167,14 @@ def main(db):
                 AND nature IS NOT NULL
                 AND nature <> 'DECISION'
                 AND num IS NOT NULL
+                {0}
            GROUP BY nature, num;
-    """)
+    """.format(scope))
     print('inserted %i rows in textes based on (nature, num)' % db.changes())
 
-    connect_by_nature_num(db)
-    connect_by_nor(db)
-    connect_by_titrefull_s(db)
+    connect_by_nature_num(db, scope)
+    connect_by_nor(db, scope)
+    connect_by_titrefull_s(db, scope)
 
     db.run("""
         INSERT INTO textes (nature, nor)
@@ -141,10 +182,11 @@ def main(db):
               FROM textes_versions
              WHERE texte_id IS NULL
                AND nor IS NOT NULL
+               {0}
           GROUP BY nor
             HAVING min(nature) = max(nature)
                AND min(titrefull_s) = max(titrefull_s);
-    """)
+    """.format(scope))
     print('inserted %i rows in textes based on nor' % db.changes())
 
     db.run("""
@@ -159,20 +201,30 @@ def main(db):
                    SELECT id
                      FROM textes t
                     WHERE t.nor = textes_versions.nor
-               );
-    """)
+               )
+           {0};
+    """.format(scope))
     print('connected %i rows of textes_versions based on nor' % db.changes())
 
-    factorize_by(db, 'titrefull_s')
-    connect_by_titrefull_s(db)
+    factorize_by(db, 'titrefull_s', scope)
+    connect_by_titrefull_s(db, scope)
 
+    # A title can already be in `textes` while some of its rows are still
+    # unconnected, when `factorize_by` has merged only some of the textes that
+    # share it. Those rows are connected to the existing texte below.
     db.run("""
         INSERT INTO textes (nature, titrefull_s)
             SELECT nature, titrefull_s
               FROM textes_versions
              WHERE texte_id IS NULL
+               AND NOT EXISTS (
+                       SELECT id
+                         FROM textes t
+                        WHERE t.titrefull_s = textes_versions.titrefull_s
+                   )
+               {0}
           GROUP BY titrefull_s;
-    """)
+    """.format(scope))
     print('inserted %i rows in textes based on titrefull_s' % db.changes())
 
     db.run("""
@@ -187,18 +239,224 @@ def main(db):
                    SELECT id
                      FROM textes t
                     WHERE t.titrefull_s = textes_versions.titrefull_s
-               );
-    """)
+               )
+           {0};
+    """.format(scope))
     print('connected %i rows of textes_versions based on titrefull_s' % db.changes())
 
-    factorize_by(db, 'cid')
+    factorize_by(db, 'cid', scope)
+
+
+class UnionFind(object):
+    """A disjoint-set forest over the IDs of `textes`.
+    """
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = x
+        while root in self.parent:
+            root = self.parent[root]
+        while x != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, xs, new_root):
+        """Merges the sets that contain `xs` into `new_root`.
+        """
+        for x in xs:
+            root = self.find(x)
+            if root != new_root:
+                self.parent[root] = new_root
+
+
+def factorize_in_memory(db, scope=''):
+    """Does the same work as `factorize_in_sql`, but in memory.
+
+    The keys of `textes_versions` and the rows of `textes` are loaded once, the
+    merges are recorded in a `UnionFind` instead of being applied immediately,
+    and the resulting assignments are written back in one bulk pass at the end.
+    """
+    versions = [list(row) for row in db.all("""
+        SELECT id, nature, num, nor, titrefull_s, cid, texte_id
+          FROM textes_versions
+         WHERE 1 {0}
+    """.format(scope))]
+    old_texte_ids = {row[0]: row[6] for row in versions}
+    textes = {row[0]: row[1:] for row in db.all("""
+        SELECT id, nature, num, nor, titrefull_s FROM textes
+    """)}
+    old_textes = set(textes)
+    by_nature_num, by_nor, by_titrefull_s = {}, {}, {}
+    for texte_id, (nature, num, nor, titrefull_s) in sorted(textes.items()):
+        if num is not None:
+            by_nature_num.setdefault((nature, num), texte_id)
+        if nor is not None:
+            by_nor.setdefault(nor, texte_id)
+        if titrefull_s is not None:
+            by_titrefull_s.setdefault(titrefull_s, texte_id)
+    uf = UnionFind()
+    last_id = [max(textes) if textes else 0]
+
+    def new_texte(nature, num=None, nor=None, titrefull_s=None):
+        last_id[0] += 1
+        textes[last_id[0]] = (nature, num, nor, titrefull_s)
+        return last_id[0]
+
+    def group_by(col, connected):
+        groups = {}
+        for row in versions:
+            if (row[6] is not None) == connected:
+                groups.setdefault(row[col], []).append(row)
+        return sorted(groups.items(), key=lambda t: (t[0] is not None, t[0]))
+
+    def unique(values):
+        # Equivalent of SQL's `min(x) = max(x)`
+        values = set(v for v in values if v is not None)
+        return values.pop() if len(values) == 1 else None
+
+    def connect(label, get_texte_id):
+        n = 0
+        for row in versions:
+            if row[6] is None:
+                texte_id = get_texte_id(row)
+                if texte_id is not None:
+                    row[6] = texte_id
+                    n += 1
+        print('connected %i rows of textes_versions based on %s' % (n, label))
+
+    def connect_by_nature_num():
+        connect('(nature, num)', lambda row: by_nature_num.get((row[1], row[2])))
+
+    def connect_by_nor():
+        texte_by_nor = {}
+        for nor, rows in group_by(3, connected=True):
+            if nor is None:
+                continue
+            if unique(r[1] for r in rows) and unique(r[2] for r in rows):
+                texte_ids = set(uf.find(r[6]) for r in rows)
+                if len(texte_ids) == 1:
+                    texte_by_nor[nor] = texte_ids.pop()
+        connect('nor', lambda row: texte_by_nor.get(row[3]))
+
+    def connect_by_titrefull_s():
+        texte_by_titrefull_s = {}
+        for titrefull_s, rows in group_by(4, connected=True):
+            texte_ids = set(uf.find(r[6]) for r in rows)
+            if titrefull_s is not None and len(texte_ids) == 1:
+                texte_by_titrefull_s[titrefull_s] = texte_ids.pop()
+        connect('titrefull_s', lambda row: texte_by_titrefull_s.get(row[4]))
+
+    def factorize_by(col, key):
+        # Like the SQL version the duplicates are selected before any merge,
+        # and the textes of a group are looked up again when it's merged, so
+        # that the merges done earlier in the pass are followed
+        duplicates = []
+        for value, rows in group_by(col, connected=True):
+            nature = unique(r[1] for r in rows)
+            if len(set(uf.find(r[6]) for r in rows)) > 1 and nature is not None:
+                duplicates.append((value, rows, nature))
+        total = 0
+        factorized = 0
+        for value, rows, nature in duplicates:
+            texte_ids = set(uf.find(r[6]) for r in rows)
+            if len(texte_ids) < 2:
+                continue
+            if key == 'cid':
+                uid = new_texte(nature)
+            else:
+                uid = new_texte(nature, titrefull_s=value)
+                if value is not None:
+                    by_titrefull_s[value] = uid
+            uf.union(texte_ids, uid)
+            total += len(rows)
+            factorized += 1
+        print('factorized %i duplicates into %i uniques based on %s' % (total, factorized, key))
+
+    connect_by_nature_num()
+
+    new_keys = sorted(set(
+        (row[1], row[2]) for row in versions
+        if row[6] is None and row[1] is not None and row[1] != 'DECISION' and
+        row[2] is not None
+    ))
+    for nature, num in new_keys:
+        by_nature_num[(nature, num)] = new_texte(nature, num=num)
+    print('inserted %i rows in textes based on (nature, num)' % len(new_keys))
+
+    connect_by_nature_num()
+    connect_by_nor()
+    connect_by_titrefull_s()
+
+    n = 0
+    for nor, rows in group_by(3, connected=False):
+        if nor is None:
+            continue
+        nature = unique(r[1] for r in rows)
+        titrefull_s = unique(r[4] for r in rows)
+        if nature is not None and titrefull_s is not None and nor not in by_nor:
+            by_nor[nor] = new_texte(nature, nor=nor)
+            n += 1
+    print('inserted %i rows in textes based on nor' % n)
+    connect('nor', lambda row: by_nor.get(row[3]))
+
+    factorize_by(4, 'titrefull_s')
+    connect_by_titrefull_s()
+
+    n = 0
+    for titrefull_s, rows in group_by(4, connected=False):
+        if titrefull_s in by_titrefull_s:
+            continue
+        texte_id = new_texte(rows[0][1], titrefull_s=titrefull_s)
+        if titrefull_s is not None:
+            by_titrefull_s[titrefull_s] = texte_id
+        n += 1
+    print('inserted %i rows in textes based on titrefull_s' % n)
+    connect('titrefull_s', lambda row: by_titrefull_s.get(row[4]))
+
+    factorize_by(5, 'cid')
+
+    # Write the results into the DB, the unused rows of `textes` are inserted
+    # too so that the clean up step in `factorize` reports the same numbers
+    db.executemany("""
+        INSERT INTO textes (id, nature, num, nor, titrefull_s) VALUES (?, ?, ?, ?, ?)
+    """, ((texte_id,) + tuple(textes[texte_id])
+          for texte_id in sorted(set(textes) - old_textes)))
+    updates = []
+    for row in versions:
+        texte_id = uf.find(row[6]) if row[6] is not None else None
+        if texte_id != old_texte_ids[row[0]]:
+            updates.append((texte_id, row[0]))
+    db.executemany("UPDATE textes_versions SET texte_id = ? WHERE id = ?", updates)
+
+
+ENGINES = {
+    'sql': factorize_in_sql,
+    'union-find': factorize_in_memory,
+}
+
+
+def factorize(db, scope='', engine='sql'):
+    """Connects the rows of `textes_versions` that don't have a `texte_id` yet.
+
+    `scope` is either empty or the condition returned by `in_scope()`, which
+    limits the work to some of the rows, the other rows mustn't share any key
+    with them (see `get_scope`).
+
+    `engine` is a key of the `ENGINES` dict.
+    """
+    first_new_id = (db.one("SELECT max(id) FROM textes") or 0) + 1
+
+    ENGINES[engine](db, scope)
 
     xml = etree.XMLParser(remove_blank_text=True)
     q = db.all("""
         SELECT s.id, s.versions, v.texte_id
           FROM textes_structs s
           JOIN textes_versions v ON v.id = s.id
-    """)
+               {0}
+    """.format(in_scope('v.id') if scope else ''))
     for version_id, versions, texte_id in q:
         xml.feed('<VERSIONS>')
         xml.feed(versions)
@@ -215,12 +473,13 @@ def main(db):
     # Clean up factorized texts
     db.run("""
         DELETE FROM textes
-         WHERE NOT EXISTS (
+         WHERE id >= ?
+           AND NOT EXISTS (
                    SELECT *
                      FROM textes_versions
                     WHERE texte_id = textes.id
                )
-    """)
+    """, (first_new_id if scope else 0,))
     print('deleted %i unused rows from textes' % db.changes())
 
     left = db.one("SELECT count(*) FROM textes_versions WHERE texte_id IS NULL")
@@ -228,20 +487,237 @@ def main(db):
         print("Fail: %i rows haven't been connected" % left)
     else:
         # SQLite doesn't implement DROP COLUMN so we just nullify them instead
-        db.run("UPDATE textes SET nor = NULL, titrefull_s = NULL")
+        db.run("""
+            UPDATE textes
+               SET nor = NULL, titrefull_s = NULL
+             WHERE nor IS NOT NULL OR titrefull_s IS NOT NULL
+        """)
         print("done")
 
     n = db.one("SELECT count(*) FROM textes")
     print("Il y a désormais %i textes dans la base." % n)
 
 
+def load_keys(db, table):
+    """Returns a dict `id → keys`, see `KEY_COLUMNS`.
+    """
+    return {row[0]: tuple(row[1:]) for row in db.all("""
+        SELECT id, {0}
+          FROM {1}
+    """.format(', '.join(KEY_COLUMNS), table))}
+
+
+def iter_links(keys):
+    """Yields the values through which a row can be connected to other rows.
+    """
+    texte_id, nature, num, nor, titrefull_s, cid = keys
+    if texte_id is not None:
+        yield 'texte_id', texte_id
+    if num is not None:
+        yield 'num', nature, num
+    if nor is not None:
+        yield 'nor', nor
+    yield 'titrefull_s', titrefull_s
+    yield 'cid', cid
+
+
+def get_scope(db):
+    """Returns the IDs of the rows that have to be factorized again.
+
+    The rows of `textes_versions` are compared to the snapshot saved by the
+    last incremental factorization. The rows that are new, deleted, modified
+    or not connected are selected, along with the rows they share a key with
+    (`texte_id`, `(nature, num)`, `nor`, `titrefull_s` or `cid`), now or at the
+    time of the snapshot, transitively. Since factorization never connects rows
+    that don't share a key, factorizing the selected rows from scratch gives the
+    same result as factorizing the whole table from scratch.
+
+    Returns `None` if there is no snapshot.
+    """
+    old = load_keys(db, 'factorize_snapshot')
+    new = load_keys(db, 'textes_versions')
+    if not old and new:
+        return None
+    changed = [
+        row_id for row_id in set(old) | set(new)
+        if old.get(row_id) != new.get(row_id) or new[row_id][0] is None
+    ]
+    if not changed:
+        return set()
+    index = {}
+    for rows in (old, new):
+        for row_id, keys in rows.items():
+            for link in iter_links(keys):
+                index.setdefault(link, set()).add(row_id)
+    scope = set()
+    seen_links = set()
+    queue = changed
+    while queue:
+        row_id = queue.pop()
+        if row_id in scope:
+            continue
+        scope.add(row_id)
+        for keys in (old.get(row_id), new.get(row_id)):
+            if keys is None:
+                continue
+            for link in iter_links(keys):
+                if link in seen_links:
+                    continue
+                seen_links.add(link)
+                queue.extend(index[link] - scope)
+    return scope
+
+
+def save_snapshot(db, scope=''):
+    db.run("DELETE FROM factorize_snapshot WHERE 1 {0}".format(scope))
+    db.run("""
+        INSERT INTO factorize_snapshot (id, {0})
+             SELECT id, {0}
+               FROM textes_versions
+              WHERE 1 {1}
+    """.format(', '.join(KEY_COLUMNS), scope))
+
+
+def reuse_texte_ids(db, old_textes, old_texte_ids):
+    """Gives their previous IDs back to the textes created by an incremental
+    factorization.
+
+    `old_textes` is the set of the IDs of the textes that were connected to
+    the rows in scope, and `old_texte_ids` is a dict `textes_versions.id →
+    texte_id` of those rows, both from before the factorization. An old ID
+    goes to the new texte that has the most of its rows, and each new texte
+    gets at most one old ID. The old textes are replaced or deleted.
+    """
+    counts = {}
+    for row_id, texte_id in db.all("""
+        SELECT id, texte_id FROM textes_versions WHERE 1 {0}
+    """.format(in_scope())):
+        old_texte_id = old_texte_ids.get(row_id)
+        if old_texte_id is not None and texte_id is not None:
+            key = (texte_id, old_texte_id)
+            counts[key] = counts.get(key, 0) + 1
+    reused = []
+    new_done, old_done = set(), set()
+    for (texte_id, old_texte_id), n in sorted(counts.items(), key=lambda t: (-t[1], t[0][1], t[0][0])):
+        if texte_id not in new_done and old_texte_id not in old_done:
+            new_done.add(texte_id)
+            old_done.add(old_texte_id)
+            reused.append((old_texte_id, texte_id))
+    db.executemany("DELETE FROM textes WHERE id = ?", ((i,) for i in sorted(old_textes)))
+    db.executemany("UPDATE textes SET id = ? WHERE id = ?", reused)
+    db.executemany("UPDATE textes_versions SET texte_id = ? WHERE texte_id = ?", reused)
+    print('reused the IDs of %i textes' % len(reused))
+
+
+def main(db, incremental=False, engine='sql'):
+    """Factorizes the texts.
+
+    By default the rows of `textes_versions` that don't have a `texte_id` yet
+    are connected, the existing connections aren't modified.
+
+    In incremental mode the result is the same as a factorization from scratch,
+    but only the rows that have changed since the last incremental
+    factorization, and the ones connected to them, are processed (see
+    `get_scope`). The existing textes keep their IDs. The first incremental
+    factorization takes the existing connections as its starting point, it only
+    processes the rows that aren't connected yet and the ones linked to them.
+
+    `engine` is a key of the `ENGINES` dict.
+    """
+    if not incremental:
+        factorize(db, engine=engine)
+        return
+    scope = get_scope(db)
+    if scope is None:
+        print("> There is no snapshot of a previous factorization, taking one of the current state")
+        save_snapshot(db)
+        scope = get_scope(db)
+    if not scope:
+        print("nothing to factorize, no row of textes_versions has changed")
+        return
+    print("> Factorizing %i rows of textes_versions" % len(scope))
+    db.run("CREATE TEMP TABLE factorize_scope (id char(20) primary key)")
+    db.executemany("INSERT INTO factorize_scope (id) VALUES (?)", ((i,) for i in scope))
+    old_texte_ids = dict(db.all("""
+        SELECT id, texte_id FROM textes_versions WHERE texte_id IS NOT NULL {0}
+    """.format(in_scope())))
+    old_textes = set(old_texte_ids.values())
+    old_textes.update(row[0] for row in db.all("""
+        SELECT texte_id FROM factorize_snapshot WHERE texte_id IS NOT NULL {0}
+    """.format(in_scope())))
+    # The old textes stay in the table until their IDs have been given back,
+    # so that the new ones get higher IDs, but their keys are cleared so that
+    # no row can be connected to them
+    db.executemany("""
+        UPDATE textes SET num = NULL, nor = NULL, titrefull_s = NULL WHERE id = ?
+    """, ((i,) for i in sorted(old_textes)))
+    db.run("UPDATE textes_versions SET texte_id = NULL WHERE 1 " + in_scope())
+    factorize(db, in_scope(), engine)
+    reuse_texte_ids(db, old_textes, old_texte_ids)
+    save_snapshot(db, in_scope())
+    db.run("DROP TABLE factorize_scope")
+
+
+def verify(db):
+    """Compares the `texte_id` assignment to the result of a factorization from scratch.
+
+    The factorization from scratch is done in a temporary in-memory DB. The
+    `texte_id` values don't have to be equal, the rows have to be grouped in
+    the same way.
+
+    Returns the number of rows of `textes_versions` that aren't grouped as
+    they should be.
+    """
+    print("> Factorizing from scratch in a temporary DB...")
+    columns = ('id', 'nature', 'num', 'nor', 'titrefull_s', 'dossier', 'cid', 'mtime')
+    scratch = connect_db(':memory:')
+    scratch.executemany("""
+        INSERT INTO textes_versions ({0}) VALUES ({1})
+    """.format(', '.join(columns), ', '.join('?' * len(columns))), db.all("""
+        SELECT {0} FROM textes_versions
+    """.format(', '.join(columns))))
+    factorize(scratch)
+    expected = dict(scratch.all("SELECT id, texte_id FROM textes_versions"))
+    actual = dict(db.all("SELECT id, texte_id FROM textes_versions"))
+    scratch.close()
+    # Two rows must have the same `texte_id` in `db` if and only if they have
+    # the same `texte_id` in `scratch`
+    actual_groups, expected_groups = {}, {}
+    for row_id, texte_id in actual.items():
+        actual_groups.setdefault(texte_id, set()).add(expected[row_id])
+        expected_groups.setdefault(expected[row_id], set()).add(texte_id)
+    wrong = sorted(
+        row_id for row_id, texte_id in actual.items()
+        if texte_id is None or len(actual_groups[texte_id]) > 1 or
+        len(expected_groups[expected[row_id]]) > 1
+    )
+    for row_id in wrong[:20]:
+        print("Erreur: %s est connecté au texte %s, alors qu'une factorisation complète "
+              "donne le texte %s" % (row_id, actual[row_id], expected[row_id]))
+    if len(wrong) > 20:
+        print("...")
+    print("%i rows of textes_versions out of %i aren't factorized as they should be" %
+          (len(wrong), len(actual)))
+    return len(wrong)
+
+
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('db')
     p.add_argument('--from-scratch')
+    p.add_argument('--incremental', default=False, action='store_true',
+                   help="only process the rows that have changed since the last incremental run, "
+                        "the result is the same as a factorization from scratch")
+    p.add_argument('--engine', choices=sorted(ENGINES), default='sql',
+                   help="'union-find' loads the keys in memory and writes the results in bulk")
+    p.add_argument('--verify', default=False, action='store_true',
+                   help="compare the current factorization to a factorization from scratch, "
+                        "without modifying the DB")
     args = p.parse_args()
 
     db = connect_db(args.db)
+    if args.verify:
+        raise SystemExit(1 if verify(db) else 0)
     try:
         with db:
             if args.from_scratch:
@@ -253,6 +729,6 @@ if __name__ == '__main__':
                 print("> Normalisation des titres...")
                 normalize(db)
                 print("> Factorisation des textes...")
-            main(db)
+            main(db, incremental=args.incremental, engine=args.engine)
     except KeyboardInterrupt:
         pass
@@ -7,25 +7,31 @@ This module handles the HTML provided in LEGI.
 from __future__ import division, print_function, unicode_literals
 
 from argparse import ArgumentParser
-from collections import namedtuple
+from collections import OrderedDict, deque
 from difflib import ndiff
+from hashlib import sha1
 import json
+from multiprocessing import Pool
 import re
+from sqlite3 import Binary
+import traceback
 from xml.parsers import expat
 
-from lxml import etree
-
 try:
     from tqdm import tqdm
 except ImportError:
     print('[warning] tqdm is not installed, the progress bar is disabled')
     tqdm = lambda x: x
 
-from .utils import connect_db, group_by_2, input, ascii_spaces_re
+from .utils import (
+    BatchInserter, BatchUpdater, connect_db, get_processed_until, group_by_2, input, iter_chunks,
+    set_processed_until,
+)
 
 
-# An immutable type representing the opening of an HTML element
-StartTag = namedtuple('StartTag', 'tag void style dropped parent')
+# The version of the cleaning rules, it has to be incremented when a change
+# modifies the output of `clean_html`, see `CleaningCache`
+CLEANER_VERSION = 1
 
 # String of ascii whitespace
 ASCII_SPACES = ' \t\n\r\f\v'
@@ -59,12 +65,12 @@ DEFAULT_STYLE = {
     'valign': 'baseline',
 }
 
+# What can be done with the `size` attribute of `font` elements, see `set_font_size_policy`
+FONT_SIZE_POLICIES = ('drop', 'keep-small', 'preserve')
+
 # Set of elements that should not be dropped even if they're completely empty
 KEEP_EMPTY = {'body', 'br', 'hr', 'td', 'th'}
 
-# A fake StartTag which holds the default styles
-INVISIBLE_ROOT_TAG = StartTag(None, None, DEFAULT_STYLE, True, None)
-
 # Set of attributes that should always be dropped
 USELESS_ATTRIBUTES = {'charoff', 'face', 'id'}
 
@@ -108,14 +114,51 @@ def quoteattr(s, table=ESCAPE_ATTR_TABLE):
 
 bad_space_re = re.compile(r"[dl]['’] \w| [,.]", re.I | re.U)
 
+# Matches the whitespace that has to be replaced by a single space, i.e. any
+# run of ascii whitespace except a single space
+collapsible_spaces_re = re.compile(r'[ \t\n\r\f\v]{2,}|[\t\n\r\f\v]')
+
+
+def has_bad_space(text):
+    """Quick check done before running `bad_space_re`.
+    """
+    return "' " in text or "’ " in text or ' ,' in text or ' .' in text
+
 
 def drop_bad_space(m):
     return m.group(0).replace(' ', '')
 
 
-def is_start_of(s, tag):
-    x = tag.__len__()
-    return s[0] == '<' and s[1:x+1] == tag and s[x+1] in ' >' and s[-2] != '/'
+class Element(object):
+    """An open HTML element, see `HTMLCleaner`.
+
+    Only the styles set by the element itself are stored in `styles`, the
+    inherited ones are looked up in the chain of parents (see `get_style`).
+    `start_tag` is the string added to the output, `None` if the element has
+    been dropped.
+    """
+
+    __slots__ = ('tag', 'void', 'styles', 'collapse_spaces', 'start_tag', 'parent')
+
+    def __init__(self, tag, void, styles, collapse_spaces, start_tag, parent):
+        self.tag = tag
+        self.void = void
+        self.styles = styles
+        self.collapse_spaces = collapse_spaces
+        self.start_tag = start_tag
+        self.parent = parent
+
+    def get_style(self, k):
+        element = self
+        while element is not None:
+            styles = element.styles
+            if styles and k in styles:
+                return styles[k]
+            element = element.parent
+
+
+# A fake Element which holds the default styles
+INVISIBLE_ROOT_ELEMENT = Element(None, None, DEFAULT_STYLE, True, None, None)
 
 
 class HTMLCleaner(object):
@@ -124,21 +167,27 @@ class HTMLCleaner(object):
     Doc: http://lxml.de/parsing.html#the-target-parser-interface
     """
 
+    __slots__ = (
+        'at_segment_start', 'current_element', 'drop_line_breaks', 'last_trimmable_node',
+        'out', 'text_chunks', 'text_is_blank',
+    )
+
     def __init__(self):
         self.at_segment_start = True
         self.drop_line_breaks = True
         self.last_trimmable_node = None
         self.out = []
-        self.current_tag = INVISIBLE_ROOT_TAG
+        self.current_element = INVISIBLE_ROOT_ELEMENT
         self.text_chunks = []
+        # Whether the queued text chunks only contain whitespace
+        self.text_is_blank = True
 
     def start(self, tag, attrs):
         # Add start tag to stack and output
         void = tag in VOID_ELEMENTS
         attrs_str = ''
-        parent = self.current_tag
-        parent_styles = parent.style
-        new_styles = {}
+        parent = self.current_element
+        new_styles = None
         if attrs:
             is_list_tag = tag in {'ul', 'ol'}
             for k, v in group_by_2(attrs):
@@ -159,7 +208,7 @@ class HTMLCleaner(object):
                     else:
                         v = COLORS_MAP.get(v, v)
                 # Skip redundant styles
-                parent_style = parent_styles.get(k)
+                parent_style = parent.get_style(k)
                 if parent_style == v:
                     continue
                 if parent_style:
@@ -168,55 +217,63 @@ class HTMLCleaner(object):
                         # Skip 0 (invalid) and 4 through 7 (enlarged text)
                         if size == 0 or size > 3:
                             continue
+                    if new_styles is None:
+                        new_styles = {}
                     new_styles[k] = v
                 # Add to output
                 attrs_str += ' %s=%s' % (k, quoteattr(v))
-        if tag == 'pre':
-            new_styles['.collapse-spaces'] = False
-        styles = dict(parent_styles, **new_styles) if new_styles else parent_styles
-        if self.drop_line_breaks and ''.join(self.text_chunks).strip(ASCII_SPACES):
+        if self.drop_line_breaks and not self.text_is_blank:
             self.drop_line_breaks = False
         dropped = (
             not attrs_str and tag in USELESS_WITHOUT_ATTRIBUTES or
             tag == 'br' and self.drop_line_breaks
         )
-        start_tag = StartTag(tag, void, styles, dropped, parent)
+        start_tag = None if dropped else '<' + tag + attrs_str + ('/>' if void else '>')
+        collapse_spaces = parent.collapse_spaces and tag != 'pre'
+        element = Element(tag, void, new_styles, collapse_spaces, start_tag, parent)
         if not dropped:
             # Process queued text chunks
             if self.text_chunks:
-                self.handle_text(next_tag=start_tag)
+                self.handle_text(next_element=element)
             # Add start tag to output
-            self.out.append('<' + tag + attrs_str + ('/>' if void else '>'))
-        self.current_tag = start_tag
+            self.out.append(start_tag)
+        self.current_element = element
 
     def end(self, tag):
-        start_tag = self.current_tag
+        element = self.current_element
         # Don't add an end tag if the start tag was self-closed or skipped
-        if start_tag.void or start_tag.dropped:
-            self.current_tag = start_tag.parent
+        start_tag = element.start_tag
+        if element.void or start_tag is None:
+            self.current_element = element.parent
             return
         # Clean up empty elements
         collapsed = False
-        if is_start_of(self.out[-1], tag):
-            if not ''.join(self.text_chunks).strip(ASCII_SPACES):
-                tag_has_attributes = self.out[-1].__len__() > tag.__len__() + 2
+        out = self.out
+        # The last output string can only be a start tag if it's the one of
+        # this element, since the children have been closed already
+        if out[-1] is start_tag:
+            if self.text_is_blank:
+                tag_has_attributes = start_tag.__len__() > tag.__len__() + 2
                 if tag_has_attributes or tag in KEEP_EMPTY:
                     # Drop the whitespace chunks, if any
                     self.text_chunks = []
                     # Collapse the element
-                    self.out[-1] = self.out[-1][:-1] + '/>'
+                    out[-1] = start_tag[:-1] + '/>'
                     collapsed = True
                 else:
                     # Drop the element entirely
-                    self.out.pop()
-                    if self.out and self.out[-1][0] != '<':
+                    out.pop()
+                    if out and out[-1][0] != '<':
                         # Previous output element was a text node, put it back
                         # in the chunks queue
-                        self.text_chunks.insert(0, unescape(self.out.pop()))
+                        text = unescape(out.pop())
+                        self.text_chunks.insert(0, text)
+                        if self.text_is_blank and text.strip(ASCII_SPACES):
+                            self.text_is_blank = False
                         # Reset last_trimmable_node (we don't need to restore
                         # its previous value)
                         self.last_trimmable_node = None
-                    self.current_tag = start_tag.parent
+                    self.current_element = element.parent
                     return
         # Process queued text chunks
         if self.text_chunks:
@@ -226,32 +283,35 @@ class HTMLCleaner(object):
             # Drop tail space
             if self.last_trimmable_node:
                 i, self.last_trimmable_node = self.last_trimmable_node, None
-                self.out[i] = self.out[i][:-1]
+                out[i] = out[i][:-1]
             # Enable dropping the next space
             self.at_segment_start = True
-        # Update current_tag
-        self.current_tag = start_tag.parent
+        # Update current_element
+        self.current_element = element.parent
         # Add end tag to output
         if not collapsed:
-            self.out.append('</%s>' % tag)
+            out.append('</%s>' % tag)
 
     def data(self, text):
         # We can't always get a single string for a text node, so we store
         # chunks in a list and assemble them when we're ready
         self.text_chunks.append(text)
+        if self.text_is_blank and text.strip(ASCII_SPACES):
+            self.text_is_blank = False
 
-    def handle_text(self, next_tag=None):
-        text = ''.join(self.text_chunks)
+    def handle_text(self, next_element=None):
+        text = ''.join(self.text_chunks) if self.text_chunks.__len__() > 1 else self.text_chunks[0]
         self.text_chunks = []
+        self.text_is_blank = True
         if not text:
             return
         # Collapse spaces, unless we're inside a <pre>
         # https://www.w3.org/TR/css-text-3/#white-space-processing
-        if self.current_tag.style['.collapse-spaces']:
-            text = ascii_spaces_re.sub(' ', text)
+        if self.current_element.collapse_spaces:
+            text = collapsible_spaces_re.sub(' ', text)
             # Handle spaces around closing tags
             i = self.last_trimmable_node
-            if i and not next_tag and self.out[i - 1][:2] == '</':
+            if i and not next_element and self.out[i - 1][:2] == '</':
                 # `</i> foo </b>bar` → `</i> foo</b> bar`
                 trimmed = self.out[i][:-1]
                 if trimmed:
@@ -268,9 +328,10 @@ class HTMLCleaner(object):
                 if not text:
                     return
             # French-specific dropping of bad spaces, e.g. "l' article" → "l'article"
-            text = bad_space_re.sub(drop_bad_space, text)
+            if has_bad_space(text):
+                text = bad_space_re.sub(drop_bad_space, text)
             # Are we about to open a new non-inline element?
-            if next_tag and next_tag.tag in TRIM_AROUND_ELEMENTS:
+            if next_element and next_element.tag in TRIM_AROUND_ELEMENTS:
                 self.at_segment_start = True
                 # Drop tail space
                 if text[-1] == ' ':
@@ -323,79 +384,341 @@ def clean_html(html, cleaner=HTMLCleaner()):
 strip_re = re.compile(r"<.+?>|[ \t\n\r\f\v]+", re.S)
 
 
-def clean_all_html_in_db(db, check=True):
-    stats = {'cleaned': 0, 'delta': 0, 'total': 0}
+# The columns that contain HTML, by table
+HTML_COLUMNS = [
+    ('articles', ('bloc_textuel', 'nota')),
+    ('textes_versions', ('visas', 'signataires', 'tp', 'nota', 'abro', 'rect')),
+]
+
+
+def clean_fragment(html, check=True):
+    """Cleans an HTML fragment and, if `check` is true, checks the result.
+
+    Returns a tuple `(html_c, content_lost, html_c_2, error)`:
+
+    - `html_c` is the cleaned HTML
+    - `content_lost` is true if some text content was lost
+    - `html_c_2` is the result of cleaning `html_c` a second time
+    - `error` is the traceback of the exception raised by the second cleaning
+
+    The checks are only done if cleaning modified the fragment.
+    """
+    html_c = clean_html(html)
+    if not check or html_c == html:
+        return html_c, False, html_c, None
+    # Check that no meaningfull text content was lost
+    content_lost = strip_re.sub('', html) != strip_re.sub('', html_c)
+    # Check that cleaning a second time does not alter the result
+    try:
+        html_c_2 = clean_html(html_c)
+    except Exception:
+        return html_c, content_lost, None, traceback.format_exc()
+    return html_c, content_lost, html_c_2, None
 
-    def clean_row(table, row):
-        row_id = row.pop('id')
-        update = {}
-        for col, html in row.items():
-            stats['total'] += 1
-            if not html:
-                continue
-            html_c = clean_html(html)
+
+def clean_fragments(job):
+    """Wraps `clean_fragment` for use in a `multiprocessing.Pool`.
+
+    Each process uses its own `HTMLCleaner`: the default one of `clean_html`.
+    """
+    fragments, check = job
+    try:
+        return [clean_fragment(html, check) for html in fragments], None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def log_checks(col, row_id, html, result):
+    """Prints the results of the checks done by `clean_fragment`.
+    """
+    html_c, content_lost, html_c_2, error = result
+    # Check lengths
+    if html_c.__len__() > html.__len__():
+        print()
+        print("=" * 70)
+        print((
+            "Warning: cleaning column '%s' of row '%s' increased the "
+            "length from %i to %i. Diff:"
+        ) % (col, row_id, len(html), len(html_c)))
+        print(diff_html(html, html_c))
+    # Check that no meaningfull text content was lost
+    if content_lost:
+        html_s, html_c_s = strip_re.sub('', html), strip_re.sub('', html_c)
+        print()
+        print("=" * 70)
+        print("Cleaning column '%s' of row '%s' resulted in content loss. Diff:" %
+              (col, row_id))
+        print(*ndiff([html_s], [html_c_s], None, None), sep='\n')
+    # Check that cleaning a second time does not alter the result
+    if error:
+        print()
+        print("Cleaning a second time failed for column '%s' of row '%s'. Diff:" %
+              (col, row_id))
+        print(diff_html(html, html_c))
+        raise Exception(error)
+    if html_c_2 != html_c:
+        print()
+        print("=" * 70)
+        print("Inconsistent output for column '%s' of row '%s'." % (col, row_id))
+        print("*" * 5, "Original data:", "*" * 5)
+        print(html)
+        print("*" * 5, "Second run diff:", "*" * 5)
+        print(diff_html(html_c, html_c_2))
+
+
+class CleaningCache(object):
+    """Maps the digests of raw HTML fragments to the results of `clean_fragment`.
+
+    The entries are tuples `(html_c, checked)`, `html_c` is `None` if cleaning
+    didn't modify the fragment, `checked` is true if the result passed the
+    checks. Only the last `max_size` entries used are kept in memory.
+
+    If `db` is given the entries are also saved in its `html_cleaning_cache`
+    table, which is emptied when the font size policy changes.
+    """
+
+    def __init__(self, max_size=100000, db=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.db = db
+        self.hits = 0
+        self.misses = 0
+        if db:
+            policy = '%s:%s' % (CLEANER_VERSION, get_font_size_policy())
+            if db.one("SELECT value FROM db_meta WHERE key = 'html_cleaning_cache'") != policy:
+                db.run("DELETE FROM html_cleaning_cache")
+                db.insert('db_meta', dict(key='html_cleaning_cache', value=policy), replace=True)
+            self.writer = BatchInserter(db)
+
+    @staticmethod
+    def digest(html):
+        return sha1(html.encode('utf8')).digest()
+
+    def get(self, key, check=True):
+        """Returns the entry of `key`, or `None` if it's missing or hasn't been checked.
+
+        Hits and misses are counted.
+        """
+        entry = self.peek(key)
+        if entry is None and self.db:
+            entry = self.db.one("""
+                SELECT cleaned, checked FROM html_cleaning_cache WHERE digest = ?
+            """, (key,))
+            if entry is not None:
+                self.set(key, entry[0], entry[1], save=False)
+        if entry is None or check and not entry[1]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def peek(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def set(self, key, html_c, checked, save=True):
+        self.entries.pop(key, None)
+        self.entries[key] = (html_c, checked)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if save and self.db:
+            self.writer.insert('html_cleaning_cache', dict(
+                digest=Binary(key), cleaned=html_c, checked=checked,
+            ), replace=True)
+
+    def flush(self):
+        if self.db:
+            self.writer.flush()
+
+    def get_hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+def get_font_size_policy():
+    if 'size' in USELESS_ATTRIBUTES:
+        return 'drop'
+    if 'size' not in DEFAULT_STYLE:
+        return 'preserve'
+    return 'keep-small'
+
+
+def set_font_size_policy(policy):
+    """Sets what to do with the `size` attribute of `font` elements.
+    """
+    if policy not in FONT_SIZE_POLICIES:
+        raise ValueError("unknown font size policy %r" % policy)
+    if policy == 'drop':
+        USELESS_ATTRIBUTES.add('size')
+    else:
+        USELESS_ATTRIBUTES.discard('size')
+    if policy == 'preserve':
+        DEFAULT_STYLE.pop('size', None)
+    else:
+        DEFAULT_STYLE['size'] = '3'
+
+
+def clean_all_html_in_db(db, check=True, workers=1, batch_size=100, cache_size=100000,
+                         persist_cache=False, since=None):
+    """Cleans the HTML columns of all the rows of `articles` and `textes_versions`.
+
+    If `since` is given, only the rows that have changed after that date are
+    cleaned (see `get_processed_until`).
+
+    Identical fragments are only cleaned once, as long as they stay in the
+    cache (see `CleaningCache`).
+
+    When `workers > 1` the fragments are sent in batches to a pool of
+    processes, there are at most two pending batches per worker at any given
+    time. The results are written in a single process, and the output is the
+    same as when the fragments are cleaned serially.
+    """
+    stats = {'cleaned': 0, 'delta': 0, 'total': 0}
+    cache = CleaningCache(cache_size, db if persist_cache else None)
+    writer = BatchUpdater(db)
+    pool = None
+    if workers > 1:
+        pool = Pool(workers, set_font_size_policy, (get_font_size_policy(),))
+
+    # The digests of the fragments that are being cleaned
+    in_flight = set()
+
+    def submit(rows, columns):
+        # Only the fragments that aren't in the cache are sent to the workers,
+        # and only once
+        misses = OrderedDict()
+        for row in rows:
+            for col in columns:
+                html = row[col]
+                if not html:
+                    continue
+                key = cache.digest(html)
+                if key in misses or key in in_flight:
+                    cache.hits += 1
+                elif cache.get(key, check) is None:
+                    misses[key] = html
+        in_flight.update(misses)
+        job = (list(misses.values()), check)
+        if pool:
+            return rows, misses, pool.apply_async(clean_fragments, (job,))
+        return rows, misses, clean_fragments(job)
+
+    def write(table, columns, rows, misses, results):
+        if pool:
+            results = results.get()
+        results, error = results
+        if error:
+            raise Exception("failed to clean the HTML of a row of %s:\n%s" % (table, error))
+        in_flight.difference_update(misses)
+        results = dict(zip(misses, results))
+        for key, html in misses.items():
+            html_c, content_lost, html_c_2, error = results[key]
             if html_c == html:
-                continue
-            update[col] = html_c
-            stats['cleaned'] += 1
-            delta = html_c.__len__() - html.__len__()
-            stats['delta'] += delta
-            if not check:
-                continue
-            # Check lengths
-            if delta > 0:
-                print()
-                print("=" * 70)
-                print((
-                    "Warning: cleaning column '%s' of row '%s' increased the "
-                    "length from %i to %i. Diff:"
-                ) % (col, row_id, len(html), len(html_c)))
-                print(diff_html(html, html_c))
-            # Check that no meaningfull text content was lost
-            html_s, html_c_s = strip_re.sub('', html), strip_re.sub('', html_c)
-            if html_s != html_c_s:
-                print()
-                print("=" * 70)
-                print("Cleaning column '%s' of row '%s' resulted in content loss. Diff:" %
-                      (col, row_id))
-                print(*ndiff([html_s], [html_c_s], None, None), sep='\n')
-            # Check that cleaning a second time does not alter the result
-            try:
-                html_c_2 = clean_html(html_c)
-            except Exception:
-                print()
-                print("Cleaning a second time failed for column '%s' of row '%s'. Diff:" %
-                      (col, row_id))
-                print(diff_html(html, html_c))
-                raise
-            if html_c_2 != html_c:
-                print()
-                print("=" * 70)
-                print("Inconsistent output for column '%s' of row '%s'." % (col, row_id))
-                print("*" * 5, "Original data:", "*" * 5)
-                print(html)
-                print("*" * 5, "Second run diff:", "*" * 5)
-                print(diff_html(html_c, html_c_2))
-        if update:
-            db.update(table, dict(id=row_id), update)
-
-    # Articles
-    print("Cleaning articles...")
-    q = db.all("SELECT id, bloc_textuel, nota FROM articles", to_dict=True)
-    for row in tqdm(q):
-        clean_row('articles', row)
-    # Textes
-    print("Cleaning textes_versions...")
-    q = db.all("""
-        SELECT id, visas, signataires, tp, nota, abro, rect
-          FROM textes_versions
-    """, to_dict=True)
-    for row in tqdm(q):
-        clean_row('textes_versions', row)
+                cache.set(key, None, True)
+            else:
+                checked = check and not (content_lost or error or html_c_2 != html_c)
+                cache.set(key, html_c, checked)
+        for row in rows:
+            row_id = row['id']
+            update = {}
+            for col in columns:
+                stats['total'] += 1
+                html = row[col]
+                if not html:
+                    continue
+                key = cache.digest(html)
+                result = results.get(key)
+                if result is None:
+                    entry = cache.peek(key)
+                    if entry is None or check and not entry[1]:
+                        # The entry has been evicted from the cache already, or
+                        # the checks have to be run again to report the problems
+                        result = clean_fragment(html, check)
+                    else:
+                        html_c = html if entry[0] is None else entry[0]
+                        result = (html_c, False, html_c, None)
+                html_c = result[0]
+                if html_c == html:
+                    continue
+                update[col] = html_c
+                stats['cleaned'] += 1
+                stats['delta'] += html_c.__len__() - html.__len__()
+                if check:
+                    log_checks(col, row_id, html, result)
+            if update:
+                writer.update(table, row_id, update)
+
+    try:
+        for table, columns in HTML_COLUMNS:
+            print("Cleaning %s..." % table)
+            if since is None:
+                q = db.all("""
+                    SELECT id, {0}
+                      FROM {1}
+                """.format(', '.join(columns), table), to_dict=True)
+            else:
+                q = db.all("""
+                    SELECT id, {0}
+                      FROM {1}
+                     WHERE id IN (
+                               SELECT id
+                                 FROM changes_log
+                                WHERE archive_date > ?
+                                  AND tbl = ?
+                           )
+                """.format(', '.join(columns), table), (since, table), to_dict=True)
+            pending = deque()
+            for rows in iter_chunks(tqdm(q), batch_size):
+                pending.append(submit(rows, columns))
+                if len(pending) > workers * 2:
+                    write(table, columns, *pending.popleft())
+            while pending:
+                write(table, columns, *pending.popleft())
+            writer.flush()
+        cache.flush()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
 
     # Print stats
     print("Done.")
     print("Cleaned %(cleaned)i HTML fragments, out of %(total)i. Char delta = %(delta)i." % stats)
+    print("Cache: %i hits, %i misses, hit ratio = %.1f%%." %
+          (cache.hits, cache.misses, cache.get_hit_ratio() * 100))
+
+
+def clean_new_html_in_db(db, **kw):
+    """Cleans the HTML of the rows that have changed since the last cleaning.
+
+    The font size policy saved in the DB by the first cleaning is applied.
+    Nothing is done if the HTML of the DB has never been cleaned, since it's
+    a "destructive" operation which has to be requested explicitly (`python -m
+    legi.html clean`).
+
+    The keyword arguments are passed to `clean_all_html_in_db`.
+    """
+    policy = db.one("SELECT value FROM db_meta WHERE key = 'html_font_size'")
+    if policy is None:
+        print("> The HTML of this DB has never been cleaned, skipping.")
+        return
+    since = get_processed_until(db, 'html')
+    if since is None:
+        print("> Cleaning the HTML of the whole DB...")
+    else:
+        print("> Cleaning the HTML of the rows that have changed since %s..." % since)
+    previous_policy = get_font_size_policy()
+    set_font_size_policy(policy)
+    kw.setdefault('persist_cache', db.one("""
+        SELECT 1 FROM db_meta WHERE key = 'html_cleaning_cache'
+    """) is not None)
+    try:
+        clean_all_html_in_db(db, since=since, **kw)
+    finally:
+        set_font_size_policy(previous_policy)
+    set_processed_until(db, 'html')
 
 
 def split_html_into_lines(html):
@@ -415,6 +738,9 @@ def diff_html(html_a, html_b):
 
 class StatsCollector(object):
     """Collects stats about the HTML tags and attributes used in LEGI
+
+    The attributes are expected as a flat list of names and values, like the
+    ones given by expat when `ordered_attributes` is enabled.
     """
 
     def __init__(self):
@@ -427,7 +753,8 @@ class StatsCollector(object):
             tag_stats = self.stats[tag] = {'count': 0, 'attrs': {}}
         tag_stats['count'] += 1
         tag_stats_attrs = tag_stats['attrs']
-        for attr in attrs.items():
+        for i in range(0, len(attrs), 2):
+            attr = (attrs[i], attrs[i+1])
             if attr[0] == 'id':
                 attr = attr[0]
             elif attr[1].lstrip('-').isdigit():
@@ -441,8 +768,8 @@ class StatsCollector(object):
             except KeyError:
                 tag_stats_attrs[attr] = 1
 
-    def comment(self):
-        self.start('<!--', ())
+    def comment(self, text):
+        self.start('<!--', [])
 
     def close(self):
         r = self.stats
@@ -450,63 +777,165 @@ class StatsCollector(object):
         return r
 
 
-def analyze(db):
-    parser = etree.XMLParser(target=StatsCollector())
-    parser.feed('<root>')
-    # Articles
-    q = db.all("""
-        SELECT id, bloc_textuel, nota
-          FROM articles
-    """)
-    for article_id, bloc_textuel, nota in q:
-        if bloc_textuel:
-            parser.feed(bloc_textuel)
-        if nota:
-            parser.feed(nota)
-    # Textes
+def merge_stats(stats, other):
+    """Adds the counts of `other` to `stats`, see `StatsCollector`.
+    """
+    for tag, other_tag_stats in other.items():
+        tag_stats = stats.get(tag)
+        if tag_stats is None:
+            stats[tag] = other_tag_stats
+            continue
+        tag_stats['count'] += other_tag_stats['count']
+        tag_stats_attrs = tag_stats['attrs']
+        for attr, n in other_tag_stats['attrs'].items():
+            tag_stats_attrs[attr] = tag_stats_attrs.get(attr, 0) + n
+    return stats
+
+
+def analyze_shard(db, job):
+    """Collects the stats of the HTML fragments of a range of rows.
+
+    `job` is a tuple `(table, columns, first_rowid, last_rowid, sample)`. If
+    `sample` isn't `None`, only that fraction of the rows is analyzed, always
+    the same ones.
+    """
+    table, columns, first_rowid, last_rowid, sample = job
+    sample_condition = ''
+    if sample is not None:
+        # Pseudo-random but reproducible selection of the rows
+        sample_condition = "AND (rowid * 2654435761) % 1000000 < {0}".format(
+            int(sample * 1000000)
+        )
     q = db.all("""
-        SELECT id, visas, signataires, tp, nota, abro, rect
-          FROM textes_versions
-    """)
+        SELECT {0}
+          FROM {1}
+         WHERE rowid BETWEEN ? AND ?
+           {2}
+    """.format(', '.join(columns), table, sample_condition), (first_rowid, last_rowid))
+    collector = StatsCollector()
+    p = expat.ParserCreate()
+    p.ordered_attributes = True
+    p.StartElementHandler = collector.start
+    p.CommentHandler = collector.comment
+    p.Parse('<root>')
     for row in q:
-        for text in row[1:]:
-            if text:
-                parser.feed(text)
-    # Result
-    parser.feed('</root>')
-    stats = parser.close()
+        for html in row:
+            if html:
+                p.Parse(html)
+    p.Parse('</root>', 1)
+    stats = collector.close()
     if stats['root']['count'] == 1:
         del stats['root']
     else:
         stats['root']['count'] -= 1
+    return stats
+
+
+# The connection of a worker process to the DB, see `init_analyze_worker`
+worker_db = None
+
+
+def init_analyze_worker(address):
+    global worker_db
+    worker_db = connect_db(address, create_schema=False, update_schema=False)
+
+
+def analyze_shard_in_worker(job):
+    return analyze_shard(worker_db, job)
+
+
+def analyze(db, workers=1, sample=None, shard_size=10000):
+    """Prints stats about the HTML tags and attributes used in the DB.
+
+    The tables are split into ranges of `shard_size` rowids, which are
+    analyzed in `workers` processes. If `sample` isn't `None`, only that
+    fraction of the rows is analyzed.
+    """
+    if workers > 1 and db.address == ':memory:':
+        raise ValueError("an in-memory DB can't be analyzed in several processes")
+    jobs = []
+    for table, columns in HTML_COLUMNS:
+        first, last = db.one("SELECT min(rowid), max(rowid) FROM {0}".format(table))
+        if first is None:
+            continue
+        for start in range(first, last + 1, shard_size):
+            jobs.append((table, columns, start, start + shard_size - 1, sample))
+    if sample is not None:
+        print("> Analyzing a sample of %s%% of the rows" % (sample * 100))
+    stats = {}
+    if workers > 1:
+        pool = Pool(workers, init_analyze_worker, (db.address,))
+        try:
+            for shard_stats in tqdm(pool.imap_unordered(analyze_shard_in_worker, jobs)):
+                merge_stats(stats, shard_stats)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for job in tqdm(jobs):
+            merge_stats(stats, analyze_shard(db, job))
     print(json.dumps(stats, indent=4, sort_keys=True))
 
 
+def parse_ratio(s):
+    """Parses a ratio like `0.1` or `10%`.
+    """
+    r = float(s[:-1]) / 100 if s[-1:] == '%' else float(s)
+    if not 0 < r <= 1:
+        raise ValueError("%r isn't a ratio between 0 and 1" % s)
+    return r
+
+
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('command', choices=['analyze', 'clean'])
     p.add_argument('db')
-    p.add_argument('--font-size', default='keep-small', choices=['drop', 'keep-small', 'preserve'],
-                   help="what to do with the `size` attribute of `font` elements")
+    p.add_argument('--font-size', choices=FONT_SIZE_POLICIES,
+                   help="what to do with the `size` attribute of `font` elements "
+                        "(default: the policy of the previous cleaning, or `keep-small`)")
+    p.add_argument('--incremental', default=False, action='store_true',
+                   help="only clean the rows that have changed since the last cleaning, "
+                        "without asking for confirmation")
     p.add_argument('--skip-checks', default=False, action='store_true',
                    help="skips checking the result of HTML cleaning")
+    p.add_argument('--workers', type=int, default=1,
+                   help="number of processes used to analyze or clean the HTML "
+                        "(the DB writes stay in a single process)")
+    p.add_argument('--sample', type=parse_ratio,
+                   help="only analyze a fraction of the rows, e.g. `1%%`")
+    p.add_argument('--cache-size', type=int, default=100000,
+                   help="maximum number of cleaned HTML fragments kept in memory, identical "
+                        "fragments are only cleaned once")
+    p.add_argument('--persist-cache', default=False, action='store_true',
+                   help="save the cleaned HTML fragments in the DB, to reuse them in the next runs")
     args = p.parse_args()
 
-    if args.font_size == 'drop':
-        USELESS_ATTRIBUTES.add('size')
-    elif args.font_size == 'preserve':
-        DEFAULT_STYLE.pop('size')
-
     db = connect_db(args.db)
+    saved_font_size = db.one("SELECT value FROM db_meta WHERE key = 'html_font_size'")
+    if args.incremental and args.font_size and args.font_size != saved_font_size:
+        p.error("the HTML of this DB has been cleaned with --font-size=%s" % saved_font_size)
+    set_font_size_policy(args.font_size or saved_font_size or 'keep-small')
+
     try:
         with db:
             if args.command == 'analyze':
-                analyze(db)
+                analyze(db, workers=args.workers, sample=args.sample)
+            elif args.command == 'clean' and args.incremental:
+                clean_new_html_in_db(
+                    db, check=(not args.skip_checks), workers=args.workers,
+                    cache_size=args.cache_size,
+                )
             elif args.command == 'clean':
-                clean_all_html_in_db(db, check=(not args.skip_checks))
+                clean_all_html_in_db(
+                    db, check=(not args.skip_checks), workers=args.workers,
+                    cache_size=args.cache_size, persist_cache=args.persist_cache,
+                )
                 save = input('Save changes? (y/N) ')
                 if save.lower() != 'y':
                     raise KeyboardInterrupt
                 db.insert('db_meta', dict(key='raw', value=False), replace=True)
+                db.insert('db_meta', dict(key='html_font_size', value=get_font_size_policy()),
+                          replace=True)
+                set_processed_until(db, 'html')
     except KeyboardInterrupt:
         pass
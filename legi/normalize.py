@@ -12,12 +12,18 @@ import json
 
 from .titles import NATURE_MAP_R_SD, gen_titre, normalize_title, parse_titre
 from .utils import (
-    connect_db, filter_nonalnum, nonword_re, strip_down, strip_prefix,
-    upper_words_percentage,
+    connect_db, filter_nonalnum, get_processed_until, nonword_re, set_processed_until,
+    strip_down, strip_prefix, upper_words_percentage,
 )
 
 
-def main(db):
+def main(db, full=False):
+    """Normalizes the titles of the texts.
+
+    By default only the rows of `textes_versions` that have changed since the
+    last normalization are processed, unless it has never been done. Pass
+    `full=True` to process all the rows.
+    """
 
     TEXTES_VERSIONS_BRUTES_BITS = {
         'nature': 1,
@@ -37,10 +43,24 @@ def main(db):
 
     updates = {}
     orig_values = {}
-    q = db.all("""
-        SELECT id, titre, titrefull, titrefull_s, nature, num, date_texte, autorite
-          FROM textes_versions
-    """)
+    since = None if full else get_processed_until(db, 'normalize')
+    if since is None:
+        q = db.all("""
+            SELECT id, titre, titrefull, titrefull_s, nature, num, date_texte, autorite
+              FROM textes_versions
+        """)
+    else:
+        print('Normalizing the rows that have changed since %s' % since)
+        q = db.all("""
+            SELECT id, titre, titrefull, titrefull_s, nature, num, date_texte, autorite
+              FROM textes_versions
+             WHERE id IN (
+                       SELECT id
+                         FROM changes_log
+                        WHERE archive_date > ?
+                          AND tbl = 'textes_versions'
+                   )
+        """, (since,))
     for row in q:
         text_id, titre_o, titrefull_o, titrefull_s_o, nature_o, num, date_texte, autorite = row
         titre, titrefull, nature = titre_o, titrefull_o, nature_o
@@ -195,15 +215,19 @@ def main(db):
     print('Done. Updated %i values: %s' %
           (sum(update_counts.values()), json.dumps(update_counts, indent=4)))
 
+    set_processed_until(db, 'normalize')
+
 
 if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('db')
+    p.add_argument('--full', default=False, action='store_true',
+                   help="process all the rows, not just the ones that have changed since the last run")
     args = p.parse_args()
 
     db = connect_db(args.db)
     try:
         with db:
-            main(db)
+            main(db, full=args.full)
     except KeyboardInterrupt:
         pass
@@ -31,3 +31,52 @@ CREATE VIEW textes_versions_brutes_view AS
 
 -- migration #3
 !RECREATE!
+
+-- migration #4
+UPDATE duplicate_files SET data = pack_json(data) WHERE typeof(data) = 'text';
+
+-- migration #5
+CREATE TABLE changes_log
+( archive_date   text       not null
+, tbl            text       not null
+, id             char(20)   not null
+, cid            char(20)   not null
+, UNIQUE (archive_date, tbl, id, cid)
+);
+
+-- migration #6
+CREATE TABLE factorize_snapshot
+( id            char(20)   unique not null
+, texte_id      int
+, nature        text
+, num           text
+, nor           char(12)
+, titrefull_s   text
+, cid           char(20)   not null
+);
+
+-- migration #7
+CREATE TABLE html_cleaning_cache
+( digest    blob   primary key not null
+, cleaned   text
+, checked   int    not null
+);
+
+-- migration #8
+CREATE INDEX IF NOT EXISTS sommaires_element_idx ON sommaires (element);
+
+-- migration #9
+CREATE TABLE anomalies
+( id           char(20)   not null   -- the entity the anomaly is reported on
+, path         text       not null
+, check_name   text       not null
+, args         text       not null   -- JSON array of the parts of the message
+);
+
+CREATE INDEX anomalies_id_idx ON anomalies (id);
+-- The previous versions didn't store the anomalies, the next detection has to be a full one
+DELETE FROM db_meta WHERE key = 'anomalies_processed_until';
+
+-- migration #10
+CREATE INDEX IF NOT EXISTS textes_versions_date_fin ON textes_versions (date_fin);
+CREATE INDEX IF NOT EXISTS articles_date_fin_idx ON articles (date_fin);
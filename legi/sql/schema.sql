@@ -4,7 +4,7 @@ CREATE TABLE db_meta
 , value   blob
 );
 
-INSERT INTO db_meta (key, value) VALUES ('schema_version', 3);
+INSERT INTO db_meta (key, value) VALUES ('schema_version', 10);
 
 CREATE TABLE textes
 ( id            integer    primary key not null
@@ -16,15 +16,17 @@ CREATE TABLE textes
 );
 
 CREATE TABLE textes_structs
-( id         char(20)   unique not null
+( id         char(20)   not null
 , versions   text
 , dossier    text       not null
 , cid        char(20)   not null
 , mtime      int        not null
 );
 
+CREATE UNIQUE INDEX textes_structs_id_idx ON textes_structs (id);
+
 CREATE TABLE textes_versions
-( id                      char(20)   unique not null
+( id                      char(20)   not null
 , nature                  text
 , titre                   text
 , titrefull               text
@@ -55,11 +57,13 @@ CREATE TABLE textes_versions
 , texte_id                int        references textes
 );
 
+CREATE UNIQUE INDEX textes_versions_id_idx ON textes_versions (id);
 CREATE INDEX textes_versions_titrefull_s ON textes_versions (titrefull_s);
 CREATE INDEX textes_versions_texte_id ON textes_versions (texte_id);
+CREATE INDEX textes_versions_date_fin ON textes_versions (date_fin);
 
 CREATE TABLE sections
-( id            char(20)   unique not null
+( id            char(20)   not null
 , titre_ta      text
 , commentaire   text
 , parent        char(20)   -- REFERENCES sections(id)
@@ -68,8 +72,10 @@ CREATE TABLE sections
 , mtime         int        not null
 );
 
+CREATE UNIQUE INDEX sections_id_idx ON sections (id);
+
 CREATE TABLE articles
-( id             char(20)   unique not null
+( id             char(20)   not null
 , section        char(20)   -- REFERENCES sections(id)
 , num            text
 , etat           text
@@ -83,6 +89,9 @@ CREATE TABLE articles
 , mtime          int        not null
 );
 
+CREATE UNIQUE INDEX articles_id_idx ON articles (id);
+CREATE INDEX articles_date_fin_idx ON articles (date_fin);
+
 CREATE TABLE sommaires
 ( cid        char(20)   not null
 , parent     char(20)   -- REFERENCES sections
@@ -96,6 +105,7 @@ CREATE TABLE sommaires
 );
 
 CREATE INDEX sommaires_cid_idx ON sommaires (cid);
+CREATE INDEX sommaires_element_idx ON sommaires (element);
 
 CREATE TABLE liens
 ( src_id      char(20)   not null
@@ -116,13 +126,21 @@ CREATE TABLE duplicate_files
 , cid             char(20)   not null
 , dossier         text       not null
 , mtime           int        not null
-, data            text       not null
+, data            blob       not null
 , other_cid       char(20)   not null
 , other_dossier   text       not null
 , other_mtime     int        not null
 , UNIQUE (id, sous_dossier, cid, dossier)
 );
 
+CREATE TABLE changes_log
+( archive_date   text       not null
+, tbl            text       not null
+, id             char(20)   not null
+, cid            char(20)   not null
+, UNIQUE (archive_date, tbl, id, cid)
+);
+
 CREATE TABLE textes_versions_brutes
 ( id           char(20)   unique not null
 , bits         int        not null
@@ -137,6 +155,34 @@ CREATE TABLE textes_versions_brutes
 , mtime        int        not null
 );
 
+-- The keys of textes_versions at the time of the last incremental factorization
+CREATE TABLE factorize_snapshot
+( id            char(20)   unique not null
+, texte_id      int
+, nature        text
+, num           text
+, nor           char(12)
+, titrefull_s   text
+, cid           char(20)   not null
+);
+
+-- The results of HTML cleaning, by digest of the original HTML, see legi.html
+CREATE TABLE html_cleaning_cache
+( digest    blob   primary key not null
+, cleaned   text   -- NULL if cleaning doesn't modify the HTML
+, checked   int    not null
+);
+
+-- The anomalies detected at the last update, see legi.anomalies
+CREATE TABLE anomalies
+( id           char(20)   not null   -- the entity the anomaly is reported on
+, path         text       not null
+, check_name   text       not null
+, args         text       not null   -- JSON array of the parts of the message
+);
+
+CREATE INDEX anomalies_id_idx ON anomalies (id);
+
 CREATE VIEW textes_versions_brutes_view AS
     SELECT a.dossier, a.cid, a.id,
            (CASE WHEN b.bits & 1 > 0 THEN b.nature ELSE a.nature END) AS nature,
@@ -5,14 +5,34 @@ Extracts LEGI tar archives into an SQLite DB
 from __future__ import division, print_function, unicode_literals
 
 from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
 from fnmatch import fnmatch
+import gzip
 import json
+from multiprocessing import Pool
 import os
 import re
+import shutil
+from sqlite3 import IntegrityError
+import tempfile
+from threading import Event, Thread
+import traceback
 
 import libarchive
 from lxml import etree
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+
 try:
     from tqdm import tqdm
 except ImportError:
@@ -20,7 +40,10 @@ except ImportError:
     tqdm = lambda x: x
 
 from .anomalies import detect_anomalies
-from .utils import connect_db, partition
+from .utils import (
+    NULL_PHASE, BatchInserter, Profiler, connect_db, get_schema_indexes, pack_data, partition,
+    purge_changes_log, unpack_data,
+)
 
 
 def count(d, k, c):
@@ -33,10 +56,43 @@ def count(d, k, c):
 
 
 def innerHTML(e):
+    if len(e) == 0:
+        # Fast path for elements that only contain text, the result is the
+        # same as what `etree.tostring` would produce
+        text = e.text
+        if not text:
+            return ''
+        if '&' in text or '<' in text or '>' in text or '\r' in text:
+            text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            text = text.replace('\r', '&#13;')
+        return text
     r = etree.tostring(e, encoding='unicode', with_tail=False)
     return r[r.find('>')+1:-len(e.tag)-3]
 
 
+def find_child(e, *tags):
+    """Returns the element at the path `tags` under `e`, or `None`.
+
+    Equivalent to `e.find('/'.join(tags))`, without the overhead of lxml's
+    `ElementPath` implementation.
+    """
+    for tag in tags:
+        for e in e.iterchildren(tag):
+            break
+        else:
+            return None
+    return e
+
+
+def find_last_descendant(e, tag):
+    """Equivalent to `(e.findall('.//' + tag) or [None])[-1]`, but faster.
+    """
+    r = None
+    for r in e.iterdescendants(tag):
+        pass
+    return r
+
+
 def scrape_tags(attrs, root, wanted_tags, unwrap=False):
     attrs.update(
         (e.tag.lower(), (innerHTML(e[0]) if unwrap else innerHTML(e)) or None)
@@ -44,139 +100,859 @@ def scrape_tags(attrs, root, wanted_tags, unwrap=False):
     )
 
 
-def suppress(get_table, db, liste_suppression):
-    counts = {}
+def suppress(get_table, db, liste_suppression, mtime_index=None, archive_date=None):
+    """Deletes the files listed in `liste_suppression_legi.dat` from the DB.
+
+    The paths are loaded into a temporary table and applied as a set, see
+    `suppress_in_bulk`. The result of a path can depend on the ones that precede
+    it when they share an ID (e.g. a deleted file is replaced by one of its
+    duplicates, which is also in the list), so those paths are applied one by
+    one, in order.
+    """
+    paths = []
     for path in liste_suppression:
         parts = path.split('/')
         assert parts[0] == 'legi'
-        text_cid = parts[11]
         text_id = parts[-1]
         assert len(text_id) == 20
-        table = get_table(parts)
+        paths.append((get_table(parts), parts[3], parts[11], text_id))
+    ids = Counter(path[3] for path in paths)
+    in_bulk, one_by_one = partition(paths, lambda path: ids[path[3]] == 1)
+    counts = {}
+    if in_bulk:
+        suppress_in_bulk(db, in_bulk, counts, mtime_index, archive_date)
+    for table, dossier, cid, id in one_by_one:
+        suppress_file(db, table, dossier, cid, id, counts, mtime_index, archive_date)
+    total = sum(counts.values())
+    print("made", total, "changes in the database based on liste_suppression_legi.dat:",
+          json.dumps(counts, indent=4, sort_keys=True))
+
+
+def log_removed_elements(db, archive_date, condition, params=()):
+    """Records in `changes_log` the elements of the `sommaires` rows that match
+    `condition` and are about to be deleted.
+
+    They're logged under the `sommaires` pseudo-table, because removing an
+    article or a section from a summary can turn it into an orphan, see
+    `legi.anomalies.get_scope`.
+    """
+    db.run("""
+        INSERT OR REPLACE INTO changes_log (archive_date, tbl, id, cid)
+             SELECT ?, 'sommaires', element, cid
+               FROM sommaires
+              WHERE {0}
+    """.format(condition), (archive_date,) + tuple(params))
+
+
+def suppress_file(db, table, dossier, text_cid, text_id, counts, mtime_index=None,
+                  archive_date=None):
+    db.run("""
+        DELETE FROM {0}
+         WHERE dossier = ?
+           AND cid = ?
+           AND id = ?
+    """.format(table), (dossier, text_cid, text_id))
+    changes = db.changes()
+    if changes:
+        count(counts, 'delete from ' + table, changes)
+        if mtime_index is not None:
+            mtime_index.delete(table, text_id)
+        if archive_date:
+            db.insert('changes_log', dict(
+                archive_date=archive_date, tbl=table, id=text_id, cid=text_cid,
+            ), replace=True)
+        # Also delete derivative data
+        if table in ('articles', 'textes_versions'):
+            db.run("""
+                DELETE FROM liens
+                 WHERE src_id = ? AND NOT _reversed
+                    OR dst_id = ? AND _reversed
+            """, (text_id, text_id))
+            count(counts, 'delete from liens', db.changes())
+        elif table == 'sections':
+            if archive_date:
+                log_removed_elements(db, archive_date, """
+                    cid = ? AND parent = ? AND _source = 'section_ta_liens'
+                """, (text_cid, text_id))
+            db.run("""
+                DELETE FROM sommaires
+                 WHERE cid = ?
+                   AND parent = ?
+                   AND _source = 'section_ta_liens'
+            """, (text_cid, text_id))
+            count(counts, 'delete from sommaires', db.changes())
+        elif table == 'textes_structs':
+            if archive_date:
+                log_removed_elements(db, archive_date, """
+                    cid = ? AND _source = 'struct/' || ?
+                """, (text_cid, text_id))
+            db.run("""
+                DELETE FROM sommaires
+                 WHERE cid = ?
+                   AND _source = 'struct/' || ?
+            """, (text_cid, text_id))
+            count(counts, 'delete from sommaires', db.changes())
+        # And delete the associated row in textes_versions_brutes if it exists
+        if table == 'textes_versions':
+            db.run("DELETE FROM textes_versions_brutes WHERE id = ?", (text_id,))
+            count(counts, 'delete from textes_versions_brutes', db.changes())
+        # If the file had an older duplicate that hasn't been deleted then
+        # we have to fall back to that, otherwise we'd be missing data
+        older_file = db.one("""
+            SELECT *
+              FROM duplicate_files
+             WHERE id = ?
+          ORDER BY mtime DESC
+             LIMIT 1
+        """, (text_id,), to_dict=True)
+        if older_file:
+            db.run("""
+                DELETE FROM duplicate_files
+                 WHERE dossier = ?
+                   AND cid = ?
+                   AND id = ?
+            """, (older_file['dossier'], older_file['cid'], older_file['id']))
+            count(counts, 'delete from duplicate_files', db.changes())
+            restore_duplicate(db.insert, older_file, counts, mtime_index, archive_date)
+    else:
+        # Remove the file from the duplicates table if it was in there
         db.run("""
-            DELETE FROM {0}
+            DELETE FROM duplicate_files
              WHERE dossier = ?
                AND cid = ?
                AND id = ?
-        """.format(table), (parts[3], text_cid, text_id))
-        changes = db.changes()
-        if changes:
-            count(counts, 'delete from ' + table, changes)
-            # Also delete derivative data
-            if table in ('articles', 'textes_versions'):
-                db.run("""
-                    DELETE FROM liens
-                     WHERE src_id = ? AND NOT _reversed
-                        OR dst_id = ? AND _reversed
-                """, (text_id, text_id))
-                count(counts, 'delete from liens', db.changes())
-            elif table == 'sections':
-                db.run("""
-                    DELETE FROM sommaires
-                     WHERE cid = ?
-                       AND parent = ?
-                       AND _source = 'section_ta_liens'
-                """, (text_cid, text_id))
-                count(counts, 'delete from sommaires', db.changes())
-            elif table == 'textes_structs':
-                db.run("""
-                    DELETE FROM sommaires
-                     WHERE cid = ?
-                       AND _source = 'struct/' || ?
-                """, (text_cid, text_id))
-                count(counts, 'delete from sommaires', db.changes())
-            # And delete the associated row in textes_versions_brutes if it exists
-            if table == 'textes_versions':
-                db.run("DELETE FROM textes_versions_brutes WHERE id = ?", (text_id,))
-                count(counts, 'delete from textes_versions_brutes', db.changes())
-            # If the file had an older duplicate that hasn't been deleted then
-            # we have to fall back to that, otherwise we'd be missing data
-            older_file = db.one("""
-                SELECT *
-                  FROM duplicate_files
-                 WHERE id = ?
-              ORDER BY mtime DESC
-                 LIMIT 1
-            """, (text_id,), to_dict=True)
-            if older_file:
-                db.run("""
-                    DELETE FROM duplicate_files
-                     WHERE dossier = ?
-                       AND cid = ?
-                       AND id = ?
-                """, (older_file['dossier'], older_file['cid'], older_file['id']))
-                count(counts, 'delete from duplicate_files', db.changes())
-                for table, rows in json.loads(older_file['data']).items():
-                    if isinstance(rows, dict):
-                        rows['id'] = older_file['id']
-                        rows['cid'] = older_file['cid']
-                        rows['dossier'] = older_file['dossier']
-                        rows['mtime'] = older_file['mtime']
-                        rows = (rows,)
-                    for row in rows:
-                        db.insert(table, row)
-                    count(counts, 'insert into ' + table, len(rows))
-        else:
-            # Remove the file from the duplicates table if it was in there
+        """, (dossier, text_cid, text_id))
+        count(counts, 'delete from duplicate_files', db.changes())
+
+
+def suppress_in_bulk(db, paths, counts, mtime_index=None, archive_date=None):
+    """Applies `suppress_file` to `paths` with one query per step.
+
+    The IDs in `paths` must be unique.
+    """
+    db.run("""
+        CREATE TEMP TABLE suppressed_files
+        ( tbl       text       not null
+        , dossier   text       not null
+        , cid       char(20)   not null
+        , id        char(20)   not null
+        , deleted   bool       not null default 0
+        )
+    """)
+    try:
+        db.executemany("""
+            INSERT INTO suppressed_files (tbl, dossier, cid, id) VALUES (?, ?, ?, ?)
+        """, paths)
+        tables = sorted(set(path[0] for path in paths))
+        for table in tables:
+            db.run("""
+                UPDATE suppressed_files
+                   SET deleted = 1
+                 WHERE tbl = ?
+                   AND EXISTS (
+                           SELECT 1
+                             FROM {0} t
+                            WHERE t.id = suppressed_files.id
+                              AND t.dossier = suppressed_files.dossier
+                              AND t.cid = suppressed_files.cid
+                       )
+            """.format(table), (table,))
             db.run("""
+                DELETE FROM {0}
+                 WHERE id IN (SELECT id FROM suppressed_files WHERE tbl = ? AND deleted)
+            """.format(table), (table,))
+            count(counts, 'delete from ' + table, db.changes())
+        if mtime_index is not None:
+            for table, text_id in list(db.all("SELECT tbl, id FROM suppressed_files WHERE deleted")):
+                mtime_index.delete(table, text_id)
+        if archive_date:
+            db.run("""
+                INSERT OR REPLACE INTO changes_log (archive_date, tbl, id, cid)
+                     SELECT ?, tbl, id, cid
+                       FROM suppressed_files
+                      WHERE deleted
+            """, (archive_date,))
+        # Also delete derivative data
+        for column, reversed_ in (('src_id', 'NOT _reversed'), ('dst_id', '_reversed')):
+            db.run("""
+                DELETE FROM liens
+                 WHERE {0} IN (
+                           SELECT id
+                             FROM suppressed_files
+                            WHERE tbl IN ('articles', 'textes_versions')
+                              AND deleted
+                       )
+                   AND {1}
+            """.format(column, reversed_))
+            count(counts, 'delete from liens', db.changes())
+        for table, condition in (('sections', "so.parent = s.id AND so._source = 'section_ta_liens'"),
+                                 ('textes_structs', "so._source = 'struct/' || s.id")):
+            removed_rows = """
+                rowid IN (
+                    SELECT so.rowid
+                      FROM suppressed_files s
+                      JOIN sommaires so ON so.cid = s.cid AND {0}
+                     WHERE s.tbl = ?
+                       AND s.deleted
+                )
+            """.format(condition)
+            if archive_date:
+                log_removed_elements(db, archive_date, removed_rows, (table,))
+            db.run("DELETE FROM sommaires WHERE " + removed_rows, (table,))
+            count(counts, 'delete from sommaires', db.changes())
+        db.run("""
+            DELETE FROM textes_versions_brutes
+             WHERE id IN (SELECT id FROM suppressed_files WHERE tbl = 'textes_versions' AND deleted)
+        """)
+        count(counts, 'delete from textes_versions_brutes', db.changes())
+        # Fall back to the most recent duplicates of the deleted files
+        older_files = {}
+        for older_file in db.all("""
+            SELECT d.*
+              FROM duplicate_files d
+             WHERE d.id IN (SELECT id FROM suppressed_files WHERE deleted)
+          ORDER BY d.id, d.mtime DESC
+        """, to_dict=True):
+            older_files.setdefault(older_file['id'], older_file)
+        older_files = sorted(older_files.values(), key=lambda f: f['id'])
+        if older_files:
+            cursor = db.executemany("""
                 DELETE FROM duplicate_files
                  WHERE dossier = ?
                    AND cid = ?
                    AND id = ?
-            """, (parts[3], text_cid, text_id))
-            count(counts, 'delete from duplicate_files', db.changes())
-    total = sum(counts.values())
-    print("made", total, "changes in the database based on liste_suppression_legi.dat:",
-          json.dumps(counts, indent=4, sort_keys=True))
+            """, [(f['dossier'], f['cid'], f['id']) for f in older_files])
+            count(counts, 'delete from duplicate_files', cursor.rowcount)
+            writer = BatchInserter(db)
+            for older_file in older_files:
+                restore_duplicate(writer.insert, older_file, counts, mtime_index, archive_date)
+            writer.flush()
+        # Remove the files that weren't in the main tables from the duplicates table
+        db.run("""
+            DELETE FROM duplicate_files
+             WHERE rowid IN (
+                       SELECT d.rowid
+                         FROM suppressed_files s
+                         JOIN duplicate_files d
+                           ON d.id = s.id AND d.dossier = s.dossier AND d.cid = s.cid
+                        WHERE NOT s.deleted
+                   )
+        """)
+        count(counts, 'delete from duplicate_files', db.changes())
+    finally:
+        db.run("DROP TABLE temp.suppressed_files")
 
 
-def process_archive(db, archive_path, process_links=True):
-
-    # Define some constants
-    ARTICLE_TAGS = set('NOTA BLOC_TEXTUEL'.split())
-    SECTION_TA_TAGS = set('TITRE_TA COMMENTAIRE'.split())
-    TEXTELR_TAGS = set('VERSIONS'.split())
-    TEXTE_VERSION_TAGS = set('VISAS SIGNATAIRES TP NOTA ABRO RECT'.split())
-    META_ARTICLE_TAGS = set('NUM ETAT DATE_DEBUT DATE_FIN TYPE'.split())
-    META_CHRONICLE_TAGS = set("""
-        NUM NUM_SEQUENCE NOR DATE_PUBLI DATE_TEXTE DERNIERE_MODIFICATION
-        ORIGINE_PUBLI PAGE_DEB_PUBLI PAGE_FIN_PUBLI
-    """.split())
-    META_VERSION_TAGS = set(
-        'TITRE TITREFULL ETAT DATE_DEBUT DATE_FIN AUTORITE MINISTERE'.split()
-    )
-    SOUS_DOSSIER_MAP = {
-        'articles': 'article',
-        'sections': 'section_ta',
-        'textes_structs': 'texte/struct',
-        'textes_versions': 'texte/version',
-    }
-    TABLES_MAP = {'ARTI': 'articles', 'SCTA': 'sections', 'TEXT': 'textes_'}
-    TYPELIEN_MAP = {
-        "ABROGATION": "ABROGE",
-        "ANNULATION": "ANNULE",
-        "CODIFICATION": "CODIFIE",
-        "CONCORDANCE": "CONCORDE",
-        "CREATION": "CREE",
-        "DEPLACE": "DEPLACEMENT",
-        "DISJOINT": "DISJONCTION",
-        "MODIFICATION": "MODIFIE",
-        "PEREMPTION": "PERIME",
-        "RATIFICATION": "RATIFIE",
-        "TRANSFERE": "TRANSFERT",
-    }
-    TYPELIEN_MAP.update([(v, k) for k, v in TYPELIEN_MAP.items()])
+def restore_duplicate(insert, older_file, counts, mtime_index=None, archive_date=None):
+    for table, rows in unpack_data(older_file['data']).items():
+        if isinstance(rows, dict):
+            rows['id'] = older_file['id']
+            rows['cid'] = older_file['cid']
+            rows['dossier'] = older_file['dossier']
+            rows['mtime'] = older_file['mtime']
+            rows = (rows,)
+        for row in rows:
+            insert(table, row)
+        count(counts, 'insert into ' + table, len(rows))
+        if table in MtimeIndex.TABLES:
+            row = rows[0]
+            if mtime_index is not None:
+                mtime_index.set(table, row['id'], row['mtime'], row['dossier'], row['cid'])
+            if archive_date:
+                insert('changes_log', dict(
+                    archive_date=archive_date, tbl=table, id=row['id'], cid=row['cid'],
+                ), replace=True)
 
-    # Define some shortcuts
+
+# Define some constants
+ARTICLE_TAGS = set('NOTA BLOC_TEXTUEL'.split())
+SECTION_TA_TAGS = set('TITRE_TA COMMENTAIRE'.split())
+TEXTELR_TAGS = set('VERSIONS'.split())
+TEXTE_VERSION_TAGS = set('VISAS SIGNATAIRES TP NOTA ABRO RECT'.split())
+META_ARTICLE_TAGS = set('NUM ETAT DATE_DEBUT DATE_FIN TYPE'.split())
+META_CHRONICLE_TAGS = set("""
+    NUM NUM_SEQUENCE NOR DATE_PUBLI DATE_TEXTE DERNIERE_MODIFICATION
+    ORIGINE_PUBLI PAGE_DEB_PUBLI PAGE_FIN_PUBLI
+""".split())
+META_VERSION_TAGS = set(
+    'TITRE TITREFULL ETAT DATE_DEBUT DATE_FIN AUTORITE MINISTERE'.split()
+)
+SOUS_DOSSIER_MAP = {
+    'articles': 'article',
+    'sections': 'section_ta',
+    'textes_structs': 'texte/struct',
+    'textes_versions': 'texte/version',
+}
+TABLES_MAP = {'ARTI': 'articles', 'SCTA': 'sections', 'TEXT': 'textes_'}
+TYPELIEN_MAP = {
+    "ABROGATION": "ABROGE",
+    "ANNULATION": "ANNULE",
+    "CODIFICATION": "CODIFIE",
+    "CONCORDANCE": "CONCORDE",
+    "CREATION": "CREE",
+    "DEPLACE": "DEPLACEMENT",
+    "DISJOINT": "DISJONCTION",
+    "MODIFICATION": "MODIFIE",
+    "PEREMPTION": "PERIME",
+    "RATIFICATION": "RATIFIE",
+    "TRANSFERE": "TRANSFERT",
+}
+TYPELIEN_MAP.update([(v, k) for k, v in TYPELIEN_MAP.items()])
+
+# The pragmas used in bulk load mode
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'cache_size': '-1048576',  # 1GiB
+    'temp_store': 'MEMORY',
+}
+
+# Markers used in place of a `prev_row`
+RECHECK = object()
+SKIP = object()
+
+# Marker yielded in place of an entry when a checkpoint should be saved
+CHECKPOINT = object()
+
+
+def get_table(parts):
+    table = TABLES_MAP[parts[-1][4:8]]
+    if table == 'textes_':
+        table += parts[13] + 's'
+    return table
+
+
+def split_path(path):
+    """Splits the path of a file in a LEGI archive.
+
+    The daily archives have an additional top-level directory, it is dropped.
+    """
+    parts = path.split('/')
+    if parts[1] == 'legi':
+        parts = parts[1:]
+    return parts
+
+
+def get_file_info(parts):
+    """Returns `(table, dossier, cid, id)` for the XML file at `parts`.
+    """
+    return get_table(parts), parts[3], parts[11], parts[-1][:-4]
+
+
+def iter_files(archive, stop_after=None):
+    """Yields the entries of the archive that aren't directories.
+
+    If `stop_after` is provided, the iteration stops after the file at that
+    position, the rest of the archive isn't decompressed.
+    """
+    position = 0
+    for entry in tqdm(archive):
+        if entry.pathname[-1] == '/':
+            continue
+        yield entry
+        if position == stop_after:
+            return
+        position += 1
+
+
+def read_files(archive_path, stop_after=None):
+    """Yields `(pathname, mtime, read)` tuples for the files of the archive.
+
+    `read` is a function that returns the content of the file, it has to be
+    called before moving on to the next file.
+    """
+    with libarchive.file_reader(archive_path) as archive:
+        for entry in iter_files(archive, stop_after):
+            yield entry.pathname, entry.mtime, lambda: b''.join(entry.get_blocks())
+
+
+def read_files_in_thread(archive_path, stop_after=None, batch_size=64, queue_size=64):
+    """Same as `read_files`, but the archive is decompressed in another thread.
+
+    The reader thread sends the files in batches through a bounded queue, so
+    that the decompression of the archive overlaps with the parsing of the
+    files and the writes to the DB (libarchive and lxml release the GIL).
+    """
+    queue = Queue(queue_size)
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read():
+        try:
+            batch = []
+            with libarchive.file_reader(archive_path) as archive:
+                for entry in iter_files(archive, stop_after):
+                    batch.append((entry.pathname, entry.mtime, b''.join(entry.get_blocks())))
+                    if len(batch) == batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+            if batch:
+                put(batch)
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    thread = Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch = queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            for pathname, mtime, data in batch:
+                yield pathname, mtime, lambda: data
+    finally:
+        stop.set()
+        thread.join()
+
+
+def preparse_archive(archive_path, spool_path, process_links=True):
+    """Decompresses and parses all the files of an archive in advance.
+
+    This is meant to run in a background process while the previous archive is
+    being written into the DB. The results are stored in the file at
+    `spool_path`, as a stream of pickled `(pathname, mtime, data)` tuples: the
+    `data` of an XML file is the pickled return value of `parse_in_worker`, the
+    other files are stored as is. See `read_preparsed_files`.
+    """
+    init_worker()
+    with open(spool_path + '.tmp', 'wb') as f:
+        with libarchive.file_reader(archive_path) as archive:
+            for entry in archive:
+                pathname = entry.pathname
+                if pathname[-1] == '/':
+                    continue
+                data = b''.join(entry.get_blocks())
+                parts = split_path(pathname)
+                if parts[-1] != 'liste_suppression_legi.dat' and parts[2].startswith('code_et_TNC_'):
+                    table, dossier, text_cid, text_id = get_file_info(parts)
+                    job = (data, table, text_id, text_cid, process_links)
+                    data = pickle.dumps(parse_in_worker(job), pickle.HIGHEST_PROTOCOL)
+                pickle.dump((pathname, entry.mtime, data), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(spool_path + '.tmp', spool_path)
+
+
+def read_preparsed_files(spool_path, stop_after=None):
+    """Same as `read_files`, but for a file written by `preparse_archive`.
+
+    Use `load_preparsed_result` to get the parsed data of an XML file.
+    """
+    with open(spool_path, 'rb') as f:
+        position = 0
+        while True:
+            try:
+                pathname, mtime, data = pickle.load(f)
+            except EOFError:
+                return
+            yield pathname, mtime, lambda: data
+            if position == stop_after:
+                return
+            position += 1
+
+
+def load_preparsed_result(data, text_id):
+    result, error = pickle.loads(data)
+    if error:
+        raise Exception("failed to parse %s in the background process:\n%s" % (text_id, error))
+    return result
+
+
+def get_checkpoint(db):
+    """Returns the last checkpoint of an interrupted import, or `None`.
+
+    See the `checkpoint_interval` argument of `process_archive`.
+    """
+    checkpoint = db.one("SELECT value FROM db_meta WHERE key = 'checkpoint'")
+    return json.loads(checkpoint) if checkpoint else None
+
+
+def get_archive_index_path(archive_path):
+    return archive_path + '.index.gz'
+
+
+def read_archive_index(archive_path):
+    """Returns the `(pathname, mtime)` list of the files in the archive, or `None`.
+
+    The index is ignored if the archive has changed since it was written.
+    """
+    index_path = get_archive_index_path(archive_path)
+    if not os.path.exists(index_path):
+        return None
+    st = os.stat(archive_path)
+    with gzip.open(index_path, 'rb') as f:
+        if f.readline().decode('ascii') != '# %i %i\n' % (st.st_size, st.st_mtime):
+            print("> Ignoring outdated archive index", index_path)
+            return None
+        files = []
+        for line in f:
+            mtime, path = line.decode('utf8').rstrip('\n').split('\t', 1)
+            files.append((path, int(mtime)))
+    return files
+
+
+def write_archive_index(archive_path, files):
+    """Stores the `(pathname, mtime)` list of the files in the archive next to it.
+
+    The first line contains the size and mtime of the archive, they're used to
+    detect outdated indexes.
+    """
+    index_path = get_archive_index_path(archive_path)
+    st = os.stat(archive_path)
+    try:
+        with gzip.open(index_path + '.tmp', 'wb') as f:
+            f.write(('# %i %i\n' % (st.st_size, st.st_mtime)).encode('ascii'))
+            for path, mtime in files:
+                f.write(('%i\t%s\n' % (mtime, path)).encode('utf8'))
+        os.rename(index_path + '.tmp', index_path)
+    except (IOError, OSError) as e:
+        print("> Failed to write the archive index %s: %s" % (index_path, e))
+
+
+def parse_xml(xml, data, table, text_id, text_cid, process_links=True):
+    """Extracts the data we want from one XML file of a LEGI archive.
+
+    Returns a tuple `(tag, attrs, liens, sommaires)`. This function doesn't
+    touch the DB, so it can run in a worker process.
+    """
     attr = etree._Element.get
+
+    xml.feed(data)
+    root = xml.close()
+    tag = root.tag
+    meta = find_child(root, 'META')
+
+    # Check the ID
+    if tag == 'SECTION_TA':
+        assert find_child(root, 'ID').text == text_id
+    else:
+        meta_commun = find_child(meta, 'META_COMMUN')
+        assert find_child(meta_commun, 'ID').text == text_id
+        nature = find_child(meta_commun, 'NATURE').text
+
+    # Extract the data we want
+    attrs = {}
+    liens = ()
+    sommaires = ()
+    if tag == 'ARTICLE':
+        assert nature == 'Article'
+        assert table == 'articles'
+        contexte = find_child(root, 'CONTEXTE', 'TEXTE')
+        assert attr(contexte, 'cid') == text_cid
+        section = find_last_descendant(contexte, 'TITRE_TM')
+        if section is not None:
+            attrs['section'] = attr(section, 'id')
+        meta_article = find_child(meta, 'META_SPEC', 'META_ARTICLE')
+        scrape_tags(attrs, meta_article, META_ARTICLE_TAGS)
+        scrape_tags(attrs, root, ARTICLE_TAGS, unwrap=True)
+    elif tag == 'SECTION_TA':
+        assert table == 'sections'
+        scrape_tags(attrs, root, SECTION_TA_TAGS)
+        section_id = text_id
+        contexte = find_child(root, 'CONTEXTE', 'TEXTE')
+        assert attr(contexte, 'cid') == text_cid
+        parent = find_last_descendant(contexte, 'TITRE_TM')
+        if parent is not None:
+            attrs['parent'] = attr(parent, 'id')
+        sommaires = [
+            {
+                'cid': text_cid,
+                'parent': section_id,
+                'element': attr(lien, 'id'),
+                'debut': attr(lien, 'debut'),
+                'fin': attr(lien, 'fin'),
+                'etat': attr(lien, 'etat'),
+                'num': attr(lien, 'num'),
+                'position': i,
+                '_source': 'section_ta_liens',
+            }
+            for i, lien in enumerate(find_child(root, 'STRUCTURE_TA'))
+        ]
+    elif tag == 'TEXTELR':
+        assert table == 'textes_structs'
+        scrape_tags(attrs, root, TEXTELR_TAGS)
+        sommaires = [
+            {
+                'cid': text_cid,
+                'element': attr(lien, 'id'),
+                'debut': attr(lien, 'debut'),
+                'fin': attr(lien, 'fin'),
+                'etat': attr(lien, 'etat'),
+                'position': i,
+                '_source': 'struct/' + text_id,
+            }
+            for i, lien in enumerate(find_child(root, 'STRUCT'))
+        ]
+    elif tag == 'TEXTE_VERSION':
+        assert table == 'textes_versions'
+        attrs['nature'] = nature
+        meta_spec = find_child(meta, 'META_SPEC')
+        meta_chronicle = find_child(meta_spec, 'META_TEXTE_CHRONICLE')
+        assert find_child(meta_chronicle, 'CID').text == text_cid
+        scrape_tags(attrs, meta_chronicle, META_CHRONICLE_TAGS)
+        meta_version = find_child(meta_spec, 'META_TEXTE_VERSION')
+        scrape_tags(attrs, meta_version, META_VERSION_TAGS)
+        scrape_tags(attrs, root, TEXTE_VERSION_TAGS, unwrap=True)
+    else:
+        raise Exception('unexpected tag: '+tag)
+
+    if process_links and tag in ('ARTICLE', 'TEXTE_VERSION'):
+        e = root if tag == 'ARTICLE' else meta_version
+        liens_tags = find_child(e, 'LIENS')
+        if liens_tags is not None:
+            liens = []
+            for lien in liens_tags:
+                typelien, sens = attr(lien, 'typelien'), attr(lien, 'sens')
+                src_id, dst_id = text_id, attr(lien, 'id')
+                if sens == 'cible':
+                    assert dst_id
+                    src_id, dst_id = dst_id, src_id
+                    dst_cid = dst_titre = ''
+                    typelien = TYPELIEN_MAP.get(typelien, typelien+'_R')
+                    _reversed = True
+                else:
+                    dst_cid = attr(lien, 'cidtexte')
+                    dst_titre = lien.text
+                    _reversed = False
+                liens.append({
+                    'src_id': src_id,
+                    'dst_cid': dst_cid,
+                    'dst_id': dst_id,
+                    'dst_titre': dst_titre,
+                    'typelien': typelien,
+                    '_reversed': _reversed,
+                })
+
+    return tag, attrs, liens, sommaires
+
+
+class MtimeIndex(object):
+    """An in-memory map of `id → (mtime, dossier, cid)` for the tables that
+    hold the files of the archives.
+
+    It's loaded with a single scan of each table, and allows `process_archive`
+    to decide whether a file should be skipped without querying the DB.
+
+    To keep the memory footprint low the data is stored in sorted arrays of
+    integers: the IDs are encoded as numbers, and the `dossier` and `cid`
+    strings are replaced by indexes into a list of unique strings. The
+    modifications are stored in a dict which is checked first, and merged into
+    the arrays when it becomes too big.
+
+    The encoded IDs and the mtimes don't fit in 32 bits, and Python 2 doesn't
+    have a 64-bit integer typecode (`'q'`), so they're stored as doubles, which
+    represent integers exactly up to 2**53.
+    """
+
+    TABLES = ('articles', 'sections', 'textes_structs', 'textes_versions')
+    MERGE_THRESHOLD = 100000
+
+    def __init__(self, db):
+        self.prefixes = {}
+        self.strings = []
+        self.string_ids = {}
+        self.bases = {}
+        self.overlays = {}
+        for table in self.TABLES:
+            self.overlays[table] = {}
+            base = self.bases[table] = self.new_base()
+            rows = db.all("SELECT id, mtime, dossier, cid FROM {0}".format(table))
+            for row_id, mtime, dossier, cid in rows:
+                key = self.encode_id(row_id)
+                if key is None:
+                    self.overlays[table][row_id] = (mtime, dossier, cid)
+                    continue
+                self.append(base, key, mtime, dossier, cid)
+            self.bases[table] = self.sort(base)
+
+    @staticmethod
+    def new_base():
+        return (array('d'), array('d'), array('l'), array('l'))
+
+    def append(self, base, key, mtime, dossier, cid):
+        keys, mtimes, dossiers, cids = base
+        keys.append(key)
+        mtimes.append(mtime)
+        dossiers.append(self.get_string_id(dossier))
+        cids.append(self.get_string_id(cid))
+
+    @staticmethod
+    def sort(base):
+        keys = base[0]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        return tuple(array(a.typecode, [a[i] for i in order]) for a in base)
+
+    def encode_id(self, row_id):
+        """Returns an integer that uniquely identifies `row_id`, or `None`.
+
+        LEGI IDs are made of an 8 letters prefix (e.g. `LEGIARTI`) and 12 digits.
+        """
+        digits = row_id[8:]
+        if len(digits) != 12 or not digits.isdigit():
+            return None
+        prefix = row_id[:8]
+        prefix_id = self.prefixes.get(prefix)
+        if prefix_id is None:
+            prefix_id = self.prefixes[prefix] = len(self.prefixes)
+        return prefix_id * 10**12 + int(digits)
+
+    def get_string_id(self, s):
+        try:
+            return self.string_ids[s]
+        except KeyError:
+            i = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+            return i
+
+    def get(self, table, row_id):
+        try:
+            return self.overlays[table][row_id]
+        except KeyError:
+            pass
+        key = self.encode_id(row_id)
+        if key is None:
+            return None
+        keys, mtimes, dossiers, cids = self.bases[table]
+        i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return None
+        strings = self.strings
+        return (int(mtimes[i]), strings[dossiers[i]], strings[cids[i]])
+
+    def set(self, table, row_id, mtime, dossier, cid):
+        overlay = self.overlays[table]
+        overlay[row_id] = (mtime, dossier, cid)
+        if len(overlay) > max(self.MERGE_THRESHOLD, len(self.bases[table][0]) // 2):
+            self.merge(table)
+
+    def delete(self, table, row_id):
+        self.overlays[table][row_id] = None
+
+    def merge(self, table):
+        """Moves the modifications of `table` from the dict into the arrays.
+        """
+        overlay, kept = self.overlays[table], {}
+        updates = {}
+        for row_id, value in overlay.items():
+            key = self.encode_id(row_id)
+            if key is None:
+                kept[row_id] = value
+            else:
+                updates[key] = value
+        old_base, base = self.bases[table], self.new_base()
+        strings = self.strings
+        for key, mtime, dossier, cid in zip(*old_base):
+            key, mtime = int(key), int(mtime)
+            if key not in updates:
+                self.append(base, key, mtime, strings[dossier], strings[cid])
+        for key, value in updates.items():
+            if value is not None:
+                self.append(base, key, *value)
+        self.bases[table] = self.sort(base)
+        self.overlays[table] = kept
+
+
+# The XML parser of a worker process, see `init_worker`
+worker_xml = None
+
+
+def init_worker():
+    global worker_xml
+    worker_xml = etree.XMLParser(remove_blank_text=True)
+
+
+def parse_in_worker(job):
+    """Wraps `parse_xml` for use in a `multiprocessing.Pool`.
+
+    Exceptions are returned instead of raised, because the writer has to
+    decide whether they're relevant: the file may end up being skipped.
+    """
+    try:
+        return parse_xml(worker_xml, *job), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def drop_schema_indexes(db):
+    """Drops the indexes defined in `schema.sql`, see `create_schema_indexes`.
+    """
+    for name, table, columns, unique, sql in get_schema_indexes():
+        db.run("DROP INDEX IF EXISTS " + name)
+
+
+def create_schema_indexes(db):
+    """Creates the indexes defined in `schema.sql`, if they don't exist yet.
+
+    If a unique index can't be created, the duplicate values are printed.
+    """
+    for name, table, columns, unique, sql in get_schema_indexes():
+        print("> Creating index %s..." % name)
+        try:
+            db.run(sql.replace(' INDEX ', ' INDEX IF NOT EXISTS ', 1))
+        except IntegrityError:
+            duplicates = list(db.all("""
+                SELECT {1}, count(*)
+                  FROM {0}
+              GROUP BY {1}
+                HAVING count(*) > 1
+                 LIMIT 100
+            """.format(table, columns)))
+            print("!> The uniqueness check failed, these values of `%s` appear more than once:" %
+                  columns, *duplicates, sep='\n    ')
+            raise
+
+
+def process_archive(db, archive_path, process_links=True, workers=1, batch_size=1000,
+                    mtime_index=None, use_archive_index=False, bulk_load=False,
+                    checkpoint_interval=0, resume=None, read_ahead=False, profiler=None,
+                    preparsed=None, archive_date=None):
+    """Imports the files of the archive at `archive_path` into the DB.
+
+    If `checkpoint_interval` is set, the changes are committed every
+    `checkpoint_interval` files, along with the information needed to resume
+    the import from that point (see `get_checkpoint`). To resume an interrupted
+    import, the last checkpoint is passed as the `resume` argument.
+
+    If `read_ahead` is true, the archive is decompressed in a separate thread,
+    see `read_files_in_thread`.
+
+    If `preparsed` is provided, it's the path of the file written by
+    `preparse_archive` for this archive, the files are read from it instead of
+    the archive and don't have to be parsed again.
+
+    If `archive_date` is provided, the rows that are inserted, modified or
+    deleted are recorded in the `changes_log` table under that date, so that the
+    modules which post-process the DB can limit their work to them. The elements
+    removed from the summaries are also recorded, see `log_removed_elements`.
+
+    If an enabled `Profiler` is passed, the time spent in each phase of the
+    import is measured, and the results are printed at the end.
+    """
+
+    # Define some shortcuts
     insert = db.insert
     update = db.update
-
-    def get_table(parts):
-        table = TABLES_MAP[parts[-1][4:8]]
-        if table == 'textes_':
-            table += parts[13] + 's'
-        return table
+    writer = BatchInserter(db, batch_size)
+    if mtime_index is None:
+        mtime_index = MtimeIndex(db)
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    read_phase = profiler.phase('read')
+    lookup_phase = profiler.phase('lookup')
+    parse_phase = profiler.phase('parse')
+    duplicates_phase = profiler.phase('duplicates')
+    write_phase = profiler.phase('write')
 
     counts = {}
     def count_one(k):
@@ -185,43 +961,168 @@ def process_archive(db, archive_path, process_links=True):
         except KeyError:
             counts[k] = 1
 
-    skipped = 0
+    skipped = [0]
     unknown_folders = {}
     liste_suppression = []
-    xml = etree.XMLParser(remove_blank_text=True)
-    with libarchive.file_reader(archive_path) as archive:
-        for entry in tqdm(archive):
-            path = entry.pathname
-            if path[-1] == '/':
-                continue
-            parts = path.split('/')
+    in_flight = {}
+    deferred = deferred_ids = None
+    if bulk_load:
+        with profiler.phase('indexes'):
+            drop_schema_indexes(db)
+        deferred, deferred_ids = [], set()
+
+    archive_name = os.path.basename(archive_path)
+    start = 0
+    resume_deferred = ()
+    if resume:
+        assert resume['archive'] == archive_name
+        start = resume['position']
+        counts.update(resume['counts'])
+        skipped[0] = resume['skipped']
+        unknown_folders.update(resume['unknown_folders'])
+        resume_deferred = set(resume['deferred'])
+        print("resuming from file #%i of the archive" % start)
+    checkpoint_position = [start]
+
+    def save_checkpoint():
+        """Commits the changes made so far, along with the state of the import.
+
+        The files before `checkpoint_position` have all been processed, except
+        the ones that have been set aside in bulk load mode: their positions are
+        saved so that they can be read again.
+        """
+        with write_phase:
+            writer.flush()
+        with profiler.phase('checkpoint'):
+            checkpoint = {
+                'archive': archive_name,
+                'position': checkpoint_position[0],
+                'counts': counts,
+                'skipped': skipped[0],
+                'unknown_folders': unknown_folders,
+                'deferred': [entry[0] for entry in deferred] if bulk_load else [],
+                'bulk_load': bulk_load,
+            }
+            insert('db_meta', dict(key='checkpoint', value=json.dumps(checkpoint)), replace=True)
+            db.commit()
+
+    def get_prev_row(table, text_id, dossier, text_cid, mtime):
+        with lookup_phase:
+            prev_row = mtime_index.get(table, text_id)
+        if prev_row:
+            prev_mtime, prev_dossier, prev_cid = prev_row
+            if prev_mtime == mtime and prev_dossier == dossier and prev_cid == text_cid:
+                return SKIP
+        return prev_row
+
+    def count_unknown_folder(parts):
+        # https://github.com/Legilibre/legi.py/issues/23
+        try:
+            unknown_folders[parts[2]] += 1
+        except KeyError:
+            unknown_folders[parts[2]] = 1
+
+    def iter_entries(reader):
+        """Yields the files of the archive that need to be processed.
+
+        `reader` is the iterator returned by `read_files`, `read_files_in_thread`
+        or `read_preparsed_files`.
+
+        When `workers > 1` the files are read ahead of the writer, so the
+        `prev_row` of a file whose ID is still "in flight" (read but not
+        written yet) has to be looked up again later by the writer.
+
+        The content of a file is only read if it's needed, skipping a file
+        only requires its path and mtime.
+
+        Every `checkpoint_interval` files the `CHECKPOINT` marker is yielded,
+        at that point all the files before `checkpoint_position` have been
+        read.
+        """
+        for position, (path, mtime, read) in enumerate(profiler.iterate(reader, 'read')):
+            profiler.count('files')
+            if checkpoint_interval and position > start and position % checkpoint_interval == 0:
+                checkpoint_position[0] = position
+                yield CHECKPOINT
+            if archive_files is not None:
+                archive_files.append((path, mtime))
+            parts = split_path(path)
             if parts[-1] == 'liste_suppression_legi.dat':
-                liste_suppression += b''.join(entry.get_blocks()).decode('ascii').split()
+                liste_suppression.extend(read().decode('ascii').split())
+                continue
+            # When resuming, the files before the checkpoint have already been
+            # processed, except the ones that were set aside in bulk load mode
+            if position < start and position not in resume_deferred:
                 continue
-            if parts[1] == 'legi':
-                path = path[len(parts[0])+1:]
-                parts = parts[1:]
             if not parts[2].startswith('code_et_TNC_'):
-                # https://github.com/Legilibre/legi.py/issues/23
-                try:
-                    unknown_folders[parts[2]] += 1
-                except KeyError:
-                    unknown_folders[parts[2]] = 1
+                count_unknown_folder(parts)
                 continue
-            dossier = parts[3]
-            text_cid = parts[11]
-            text_id = parts[-1][:-4]
-            mtime = entry.mtime
-
-            # Skip the file if it hasn't changed, store it if it's a duplicate
-            duplicate = False
-            table = get_table(parts)
-            prev_row = db.one("""
-                SELECT mtime, dossier, cid
-                  FROM {0}
-                 WHERE id = ?
-            """.format(table), (text_id,))
-            if prev_row:
+            table, dossier, text_cid, text_id = get_file_info(parts)
+
+            # Skip the file if it hasn't changed
+            if text_id in in_flight:
+                prev_row = RECHECK
+            else:
+                prev_row = get_prev_row(table, text_id, dossier, text_cid, mtime)
+                if prev_row is SKIP:
+                    skipped[0] += 1
+                    continue
+
+            with read_phase:
+                data = read()
+            profiler.count('bytes', len(data))
+            yield (position, table, dossier, text_cid, text_id, mtime, prev_row, data)
+
+    def find_last_needed_file(files):
+        """Returns the position of the last file that has to be read, or -1.
+
+        A file has to be read if it has changed, or if its ID appears more than
+        once in the archive (in that case its `prev_row` depends on the other
+        files). The files that follow the last needed one don't have to be
+        decompressed.
+        """
+        files = [(split_path(path), mtime) for path, mtime in files]
+        ids = Counter(parts[-1] for parts, mtime in files)
+        last_needed = -1
+        for position, (parts, mtime) in enumerate(files):
+            if parts[-1] == 'liste_suppression_legi.dat':
+                last_needed = position
+            elif parts[2].startswith('code_et_TNC_'):
+                table, dossier, text_cid, text_id = get_file_info(parts)
+                if ids[parts[-1]] > 1:
+                    last_needed = position
+                elif get_prev_row(table, text_id, dossier, text_cid, mtime) is not SKIP:
+                    last_needed = position
+        return last_needed
+
+    def process_entry(position, table, dossier, text_cid, text_id, mtime, prev_row, parse):
+        """Writes the data of one file into the DB.
+
+        `parse` is a function which returns the result of `parse_xml`, it's
+        only called if the data is actually needed.
+        """
+        if prev_row is RECHECK:
+            prev_row = get_prev_row(table, text_id, dossier, text_cid, mtime)
+            if prev_row is SKIP:
+                skipped[0] += 1
+                return
+
+        # In bulk load mode the DB has no indexes, so the files that require
+        # reading or modifying existing rows are set aside until the end
+        if deferred is not None and (prev_row or text_id in deferred_ids):
+            deferred_ids.add(text_id)
+            with parse_phase:
+                result = parse()
+            deferred.append((position, table, dossier, text_cid, text_id, mtime, result))
+            return
+
+        # Store the file if it's a duplicate
+        duplicate = False
+        if prev_row:
+            # The buffered rows have to be in the DB before we read or modify it
+            with write_phase:
+                writer.flush()
+            with duplicates_phase:
                 prev_mtime, prev_dossier, prev_cid = prev_row
                 if prev_dossier != dossier or prev_cid != text_cid:
                     if prev_mtime >= mtime:
@@ -262,123 +1163,18 @@ def process_archive(db, archive_path, process_links=True):
                             'cid': prev_cid,
                             'dossier': prev_dossier,
                             'mtime': prev_mtime,
-                            'data': json.dumps(data),
+                            'data': pack_data(data),
                             'other_cid': text_cid,
                             'other_dossier': dossier,
                             'other_mtime': mtime,
                         }, replace=True)
                         count_one('upsert into duplicate_files')
-                elif prev_mtime == mtime:
-                    skipped += 1
-                    continue
 
-            xml.feed(b''.join(entry.get_blocks()))
-            root = xml.close()
-            tag = root.tag
-            meta = root.find('META')
+        with parse_phase:
+            tag, attrs, liens, sommaires = parse()
 
-            # Check the ID
-            if tag == 'SECTION_TA':
-                assert root.find('ID').text == text_id
-            else:
-                meta_commun = meta.find('META_COMMUN')
-                assert meta_commun.find('ID').text == text_id
-                nature = meta_commun.find('NATURE').text
-
-            # Extract the data we want
-            attrs = {}
-            liens = ()
-            sommaires = ()
-            if tag == 'ARTICLE':
-                assert nature == 'Article'
-                assert table == 'articles'
-                contexte = root.find('CONTEXTE/TEXTE')
-                assert attr(contexte, 'cid') == text_cid
-                sections = contexte.findall('.//TITRE_TM')
-                if sections:
-                    attrs['section'] = attr(sections[-1], 'id')
-                meta_article = meta.find('META_SPEC/META_ARTICLE')
-                scrape_tags(attrs, meta_article, META_ARTICLE_TAGS)
-                scrape_tags(attrs, root, ARTICLE_TAGS, unwrap=True)
-            elif tag == 'SECTION_TA':
-                assert table == 'sections'
-                scrape_tags(attrs, root, SECTION_TA_TAGS)
-                section_id = text_id
-                contexte = root.find('CONTEXTE/TEXTE')
-                assert attr(contexte, 'cid') == text_cid
-                parents = contexte.findall('.//TITRE_TM')
-                if parents:
-                    attrs['parent'] = attr(parents[-1], 'id')
-                sommaires = [
-                    {
-                        'cid': text_cid,
-                        'parent': section_id,
-                        'element': attr(lien, 'id'),
-                        'debut': attr(lien, 'debut'),
-                        'fin': attr(lien, 'fin'),
-                        'etat': attr(lien, 'etat'),
-                        'num': attr(lien, 'num'),
-                        'position': i,
-                        '_source': 'section_ta_liens',
-                    }
-                    for i, lien in enumerate(root.find('STRUCTURE_TA'))
-                ]
-            elif tag == 'TEXTELR':
-                assert table == 'textes_structs'
-                scrape_tags(attrs, root, TEXTELR_TAGS)
-                sommaires = [
-                    {
-                        'cid': text_cid,
-                        'element': attr(lien, 'id'),
-                        'debut': attr(lien, 'debut'),
-                        'fin': attr(lien, 'fin'),
-                        'etat': attr(lien, 'etat'),
-                        'position': i,
-                        '_source': 'struct/' + text_id,
-                    }
-                    for i, lien in enumerate(root.find('STRUCT'))
-                ]
-            elif tag == 'TEXTE_VERSION':
-                assert table == 'textes_versions'
-                attrs['nature'] = nature
-                meta_spec = meta.find('META_SPEC')
-                meta_chronicle = meta_spec.find('META_TEXTE_CHRONICLE')
-                assert meta_chronicle.find('CID').text == text_cid
-                scrape_tags(attrs, meta_chronicle, META_CHRONICLE_TAGS)
-                meta_version = meta_spec.find('META_TEXTE_VERSION')
-                scrape_tags(attrs, meta_version, META_VERSION_TAGS)
-                scrape_tags(attrs, root, TEXTE_VERSION_TAGS, unwrap=True)
-            else:
-                raise Exception('unexpected tag: '+tag)
-
-            if process_links and tag in ('ARTICLE', 'TEXTE_VERSION'):
-                e = root if tag == 'ARTICLE' else meta_version
-                liens_tags = e.find('LIENS')
-                if liens_tags is not None:
-                    liens = []
-                    for lien in liens_tags:
-                        typelien, sens = attr(lien, 'typelien'), attr(lien, 'sens')
-                        src_id, dst_id = text_id, attr(lien, 'id')
-                        if sens == 'cible':
-                            assert dst_id
-                            src_id, dst_id = dst_id, src_id
-                            dst_cid = dst_titre = ''
-                            typelien = TYPELIEN_MAP.get(typelien, typelien+'_R')
-                            _reversed = True
-                        else:
-                            dst_cid = attr(lien, 'cidtexte')
-                            dst_titre = lien.text
-                            _reversed = False
-                        liens.append({
-                            'src_id': src_id,
-                            'dst_cid': dst_cid,
-                            'dst_id': dst_id,
-                            'dst_titre': dst_titre,
-                            'typelien': typelien,
-                            '_reversed': _reversed,
-                        })
-
-            if duplicate:
+        if duplicate:
+            with duplicates_phase:
                 data = {table: attrs}
                 if liens:
                     data['liens'] = liens
@@ -390,14 +1186,15 @@ def process_archive(db, archive_path, process_links=True):
                     'cid': text_cid,
                     'dossier': dossier,
                     'mtime': mtime,
-                    'data': json.dumps(data),
+                    'data': pack_data(data),
                     'other_cid': prev_cid,
                     'other_dossier': prev_dossier,
                     'other_mtime': prev_mtime,
                 }, replace=True)
                 count_one('upsert into duplicate_files')
-                continue
+            return
 
+        with write_phase:
             attrs['dossier'] = dossier
             attrs['cid'] = text_cid
             attrs['mtime'] = mtime
@@ -405,14 +1202,22 @@ def process_archive(db, archive_path, process_links=True):
             if prev_row:
                 # Delete the associated rows
                 if tag == 'SECTION_TA':
+                    if archive_date:
+                        log_removed_elements(db, archive_date, """
+                            cid = ? AND parent = ? AND _source = 'section_ta_liens'
+                        """, (text_cid, text_id))
                     db.run("""
                         DELETE FROM sommaires
                          WHERE cid = ?
                            AND parent = ?
                            AND _source = 'section_ta_liens'
-                    """, (text_cid, section_id))
+                    """, (text_cid, text_id))
                     count(counts, 'delete from sommaires', db.changes())
                 elif tag == 'TEXTELR':
+                    if archive_date:
+                        log_removed_elements(db, archive_date, """
+                            cid = ? AND _source = ?
+                        """, (text_cid, 'struct/' + text_id))
                     db.run("""
                         DELETE FROM sommaires
                          WHERE cid = ?
@@ -435,16 +1240,90 @@ def process_archive(db, archive_path, process_links=True):
             else:
                 count_one('insert into '+table)
                 attrs['id'] = text_id
-                insert(table, attrs)
+                writer.insert(table, attrs)
+            mtime_index.set(table, text_id, mtime, dossier, text_cid)
+            if archive_date:
+                writer.insert('changes_log', dict(
+                    archive_date=archive_date, tbl=table, id=text_id, cid=text_cid,
+                ), replace=True)
 
             # Insert the associated rows
             for lien in liens:
-                db.insert('liens', lien)
+                writer.insert('liens', lien)
             count(counts, 'insert into liens', len(liens))
             for sommaire in sommaires:
-                db.insert('sommaires', sommaire)
+                writer.insert('sommaires', sommaire)
             count(counts, 'insert into sommaires', len(sommaires))
 
+    # Use the index of the archive's files if we have one
+    archive_files = None
+    files = last_needed = None
+    if use_archive_index:
+        with profiler.phase('archive_index'):
+            files = read_archive_index(archive_path)
+            if files is not None:
+                last_needed = find_last_needed_file(files)
+        if files is None:
+            archive_files = []
+        else:
+            print("the archive index says that %i files out of %i have to be read" %
+                  (last_needed + 1, len(files)))
+
+    if last_needed != -1:
+        if preparsed:
+            reader = read_preparsed_files(preparsed, stop_after=last_needed)
+        elif read_ahead:
+            reader = read_files_in_thread(archive_path, stop_after=last_needed)
+        else:
+            reader = read_files(archive_path, stop_after=last_needed)
+        try:
+            entries = iter_entries(reader)
+            if workers > 1 and not preparsed:
+                process_in_parallel(entries, process_entry, in_flight, workers, process_links,
+                                    save_checkpoint=save_checkpoint,
+                                    wait_phase=profiler.phase('wait_for_workers'))
+            else:
+                xml = etree.XMLParser(remove_blank_text=True)
+                for entry in entries:
+                    if entry is CHECKPOINT:
+                        save_checkpoint()
+                        continue
+                    position, table, dossier, text_cid, text_id, mtime, prev_row, data = entry
+                    if preparsed:
+                        parse = lambda: load_preparsed_result(data, text_id)
+                    else:
+                        parse = lambda: parse_xml(xml, data, table, text_id, text_cid, process_links)
+                    process_entry(position, table, dossier, text_cid, text_id, mtime, prev_row, parse)
+        finally:
+            reader.close()
+    with write_phase:
+        writer.flush()
+    if files is not None:
+        # Account for the files that didn't have to be read
+        for path, mtime in files[max(last_needed + 1, start):]:
+            parts = split_path(path)
+            if parts[2].startswith('code_et_TNC_'):
+                skipped[0] += 1
+            else:
+                count_unknown_folder(parts)
+    if archive_files is not None:
+        write_archive_index(archive_path, archive_files)
+
+    if bulk_load:
+        with profiler.phase('indexes'):
+            create_schema_indexes(db)
+        # Now that the DB has its indexes we can process the deferred files
+        entries, deferred = deferred, None
+        if entries:
+            print("processing %i files that were set aside during the bulk load" % len(entries))
+        for position, table, dossier, text_cid, text_id, mtime, result in entries:
+            process_entry(position, table, dossier, text_cid, text_id, mtime, RECHECK,
+                          lambda: result)
+        with write_phase:
+            writer.flush()
+
+    skipped = skipped[0]
+
     print("made", sum(counts.values()), "changes in the database:",
           json.dumps(counts, indent=4, sort_keys=True))
 
@@ -456,7 +1335,80 @@ def process_archive(db, archive_path, process_links=True):
             print("skipped", x, "files in unknown folder `%s`" % d)
 
     if liste_suppression:
-        suppress(get_table, db, liste_suppression)
+        with profiler.phase('suppress'):
+            suppress(get_table, db, liste_suppression, mtime_index, archive_date)
+
+    if checkpoint_interval or resume:
+        db.run("DELETE FROM db_meta WHERE key = 'checkpoint'")
+
+    if profiler.enabled:
+        profiler.stop()
+        print("profile of the import:", json.dumps(profiler.to_dict(), indent=4, sort_keys=True))
+
+
+def process_in_parallel(entries, process_entry, in_flight, workers, process_links,
+                        batch_size=256, save_checkpoint=None, wait_phase=NULL_PHASE):
+    """Parses files in `workers` processes, and writes the results in order.
+
+    The files are sent to the pool in batches, there are at most two pending
+    batches per worker at any given time. When a `CHECKPOINT` marker is
+    received, all the pending batches are written before `save_checkpoint` is
+    called.
+
+    The time spent waiting for the workers is measured by `wait_phase`, see
+    `Profiler`.
+    """
+    pending = deque()
+
+    def submit(batch):
+        jobs = [(data, table, text_id, text_cid, process_links)
+                for position, table, dossier, text_cid, text_id, mtime, prev_row, data in batch]
+        pending.append((batch, pool.map_async(parse_in_worker, jobs)))
+
+    def write_oldest_batch():
+        batch, async_result = pending.popleft()
+        with wait_phase:
+            results = async_result.get()
+        for entry, (result, error) in zip(batch, results):
+            position, table, dossier, text_cid, text_id, mtime, prev_row, data = entry
+            def parse():
+                if error:
+                    raise Exception("failed to parse %s in a worker process:\n%s" % (text_id, error))
+                return result
+            process_entry(position, table, dossier, text_cid, text_id, mtime, prev_row, parse)
+            n = in_flight[text_id] - 1
+            if n:
+                in_flight[text_id] = n
+            else:
+                del in_flight[text_id]
+
+    pool = Pool(workers, init_worker)
+    try:
+        batch = []
+        for entry in entries:
+            if entry is CHECKPOINT:
+                if batch:
+                    submit(batch)
+                    batch = []
+                while pending:
+                    write_oldest_batch()
+                save_checkpoint()
+                continue
+            batch.append(entry)
+            text_id = entry[4]
+            in_flight[text_id] = in_flight.get(text_id, 0) + 1
+            if len(batch) == batch_size:
+                submit(batch)
+                batch = []
+                if len(pending) > workers * 2:
+                    write_oldest_batch()
+        if batch:
+            submit(batch)
+        while pending:
+            write_oldest_batch()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def main():
@@ -471,6 +1423,30 @@ def main():
     p.add_argument('--raw', default=False, action='store_true')
     p.add_argument('--skip-links', default=False, action='store_true',
                    help="if set, all link metadata will be ignored (the `liens` table will be empty)")
+    p.add_argument('--workers', type=int, default=1,
+                   help="number of processes used to parse the XML files, clean the HTML and detect "
+                        "the anomalies (the DB writes stay in a single process)")
+    p.add_argument('--batch-size', type=int, default=1000,
+                   help="number of rows buffered per table before they're written with `executemany`")
+    p.add_argument('--bulk-load', default=False, action='store_true',
+                   help="speed up the first import into an empty DB by creating the indexes at the end, "
+                        "and by disabling the journal and fsyncs (if the import fails the DB is unusable)")
+    p.add_argument('--archive-index', default=False, action='store_true',
+                   help="store the list of files of each archive next to it (`.index.gz` suffix), "
+                        "and use it to avoid decompressing archives beyond their last changed file")
+    p.add_argument('--read-ahead', default=False, action='store_true',
+                   help="decompress the archives in a separate thread, while the files are parsed "
+                        "and written into the DB (useful if several cores are available)")
+    p.add_argument('--prefetch', default=False, action='store_true',
+                   help="decompress and parse the next daily archive in a background process "
+                        "while the current one is being written into the DB")
+    p.add_argument('--profile', default=False, action='store_true',
+                   help="measure and print the time spent in each phase of the import of an archive")
+    p.add_argument('--profile-json', metavar='PATH',
+                   help="append the measurements of `--profile` to a file, one JSON object per line")
+    p.add_argument('--checkpoint', type=int, default=0, metavar='N',
+                   help="commit every N files of an archive, so that an interrupted import "
+                        "can be resumed instead of restarted")
     args = p.parse_args()
 
     if not os.path.isdir(args.anomalies_dir):
@@ -501,13 +1477,19 @@ def main():
 
     # Look for new archives in the given directory
     print("> last_update is", last_update)
-    archive_re = re.compile(r'(.+_)?legi(?P<global>_global)?_(?P<date>[0-9]{8}-[0-9]{6})\..+', flags=re.IGNORECASE)
+    # The pattern is anchored to the tarball suffix, so that the files written
+    # next to the archives (e.g. `.index.gz`, see `get_archive_index_path`)
+    # aren't mistaken for archives
+    archive_re = re.compile(
+        r'(.+_)?legi(?P<global>_global)?_(?P<date>[0-9]{8}-[0-9]{6})\.tar\.[a-z0-9]+$',
+        flags=re.IGNORECASE,
+    )
     skipped = 0
     archives = sorted([
         (m.group('date'), bool(m.group('global')), m.group(0)) for m in [
             archive_re.match(fn) for fn in os.listdir(args.directory)
             if fnmatch(fn.lower(), '*legi_*.tar.*')
-        ]
+        ] if m
     ])
     most_recent_global = [t[0] for t in archives if t[1]][-1]
     if last_update and most_recent_global > last_update:
@@ -515,36 +1497,135 @@ def main():
         db.close()
         os.rename(db.address, db.address + '.back')
         db = connect_db(args.db, pragmas=args.pragma)
+        last_update = None
     archives, skipped = partition(
         archives, lambda t: t[0] >= most_recent_global and t[0] > (last_update or '')
     )
     if skipped:
         print("> Skipped %i old archives" % len(skipped))
 
-    # Process the new archives
-    for archive_date, is_global, archive_name in archives:
-        print("> Processing %s..." % archive_name)
-        with db:
-            process_archive(db, args.directory + '/' + archive_name, not args.skip_links)
-            if last_update:
-                db.run("UPDATE db_meta SET value = ? WHERE key = 'last_update'", (archive_date,))
-            else:
-                db.run("INSERT INTO db_meta VALUES ('last_update', ?)", (archive_date,))
-        last_update = archive_date
-        print('last_update is now set to', last_update)
+    # Check that an interrupted import can be resumed
+    checkpoint = get_checkpoint(db)
+    if checkpoint:
+        if not archives or archives[0][2] != checkpoint['archive']:
+            print("!> The import of %s has been interrupted, but that archive isn't the next one "
+                  "to process." % checkpoint['archive'])
+            raise SystemExit(1)
+        print("> Resuming the interrupted import of %s" % checkpoint['archive'])
+
+    # Check that the bulk load mode can be used
+    if checkpoint and checkpoint['bulk_load']:
+        # The indexes have been dropped, the bulk load has to be finished
+        args.bulk_load = True
+    elif args.bulk_load and (last_update or db.one("SELECT 1 FROM articles LIMIT 1")):
+        print("!> Can't honor --bulk-load option, the DB isn't empty.")
+        raise SystemExit(1)
+
+    # Prepare the parsing of the daily archives in the background
+    pool = spool_dir = None
+    preparsing = {}
+    if args.prefetch and len(archives) > 1:
+        pool = Pool(1)
+        spool_dir = tempfile.mkdtemp(prefix='legi-prefetch-')
+
+    def prefetch(i):
+        if pool is None or i >= len(archives) or archives[i][1]:
+            return
+        archive_name = archives[i][2]
+        spool_path = os.path.join(spool_dir, archive_name + '.pickle')
+        preparsing[archive_name] = spool_path, pool.apply_async(preparse_archive, (
+            args.directory + '/' + archive_name, spool_path, not args.skip_links,
+        ))
 
-        # Detect anomalies if requested
-        if args.anomalies:
-            fpath = args.anomalies_dir + '/anomalies-' + last_update + '.txt'
-            with open(fpath, 'w') as f:
-                n_anomalies = detect_anomalies(db, f)
-            print("logged", n_anomalies, "anomalies in", fpath)
+    def get_preparsed(archive_name):
+        if archive_name not in preparsing:
+            return None
+        spool_path, async_result = preparsing.pop(archive_name)
+        try:
+            async_result.get()
+        except Exception:
+            print("> Parsing %s in the background failed:" % archive_name)
+            traceback.print_exc()
+            return None
+        return spool_path
+
+    try:
+        mtime_index = None
+        for i, (archive_date, is_global, archive_name) in enumerate(archives):
+            # The next archive is parsed while this one is being processed
+            prefetch(i + 1)
+            if mtime_index is None:
+                print("> Loading the mtime index...")
+                mtime_index = MtimeIndex(db)
+            print("> Processing %s..." % archive_name)
+            preparsed = get_preparsed(archive_name)
+            profiler = Profiler(enabled=args.profile or bool(args.profile_json))
+            bulk_load = args.bulk_load and not last_update
+            if bulk_load:
+                pragmas = BULK_LOAD_PRAGMAS
+                if args.checkpoint:
+                    # Without a journal an interrupted transaction corrupts the DB,
+                    # there wouldn't be anything left to resume
+                    pragmas = {k: v for k, v in pragmas.items() if k != 'journal_mode'}
+                # Some pragmas can't be changed inside a transaction
+                db.commit()
+                old_pragmas = {k: db.one("PRAGMA " + k) for k in pragmas}
+                for k, v in pragmas.items():
+                    db.run("PRAGMA %s = %s" % (k, v))
+            with db:
+                process_archive(
+                    db, args.directory + '/' + archive_name, not args.skip_links,
+                    workers=args.workers, batch_size=args.batch_size, mtime_index=mtime_index,
+                    use_archive_index=args.archive_index, bulk_load=bulk_load,
+                    checkpoint_interval=args.checkpoint, resume=checkpoint,
+                    read_ahead=args.read_ahead, profiler=profiler, preparsed=preparsed,
+                    # The changes made by the first import don't need to be logged,
+                    # the whole DB has to be post-processed anyway
+                    archive_date=archive_date if last_update else None,
+                )
+                checkpoint = None
+                if last_update:
+                    db.run("UPDATE db_meta SET value = ? WHERE key = 'last_update'", (archive_date,))
+                else:
+                    db.run("INSERT INTO db_meta VALUES ('last_update', ?)", (archive_date,))
+            if bulk_load:
+                for k, v in old_pragmas.items():
+                    db.run("PRAGMA %s = %s" % (k, v))
+            if preparsed:
+                os.remove(preparsed)
+            last_update = archive_date
+            print('last_update is now set to', last_update)
+
+            if args.profile_json:
+                report = dict(profiler.to_dict(), archive=archive_name)
+                with open(args.profile_json, 'a') as f:
+                    f.write(json.dumps(report, sort_keys=True) + '\n')
+
+            # Detect anomalies if requested
+            if args.anomalies:
+                fpath = args.anomalies_dir + '/anomalies-' + last_update + '.txt'
+                delta_fpath = args.anomalies_dir + '/anomalies-' + last_update + '.jsonl.gz'
+                index_fpath = args.anomalies_dir + '/anomalies-index.jsonl'
+                with db, open(fpath, 'w') as f, gzip.open(delta_fpath, 'wb') as delta, open(index_fpath, 'ab') as index:
+                    n_anomalies = detect_anomalies(db, f, workers=args.workers, delta=delta, index=index)
+                print("logged", n_anomalies, "anomalies in", fpath)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(spool_dir)
 
     if not args.raw:
         from .normalize import main as normalize
         normalize(db)
         from .factorize import main as factorize
-        factorize(db)
+        factorize(db, incremental=True)
+        from .html import clean_new_html_in_db
+        with db:
+            clean_new_html_in_db(db, workers=args.workers)
+
+    with db:
+        purge_changes_log(db)
 
 
 if __name__ == '__main__':
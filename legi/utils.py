@@ -9,13 +9,17 @@ except ImportError:
 
 from collections import namedtuple
 from contextlib import contextmanager
-from itertools import chain, repeat
+from datetime import datetime, timedelta
+from itertools import chain, islice, repeat
+import json
 import os
 import os.path
 import re
-from sqlite3 import Connection, IntegrityError, OperationalError, ProgrammingError, Row
+from sqlite3 import Binary, Connection, IntegrityError, OperationalError, ProgrammingError, Row
+import time
 import traceback
 from unicodedata import combining, normalize
+import zlib
 
 
 PY2 = str is bytes
@@ -27,6 +31,8 @@ IGNORE = object()
 NIL = object()
 ROOT = os.path.dirname(__file__) + '/'
 
+perf_counter = getattr(time, 'perf_counter', time.time)
+
 
 @contextmanager
 def patch_object(obj, attr, value):
@@ -93,6 +99,9 @@ def connect_db(address, row_factory=None, create_schema=True, update_schema=True
     db.one = one
     db.changes = lambda: one("SELECT changes()")
 
+    # Used by the migrations
+    db.create_function('pack_json', 1, lambda s: pack_data(json.loads(s)))
+
     if create_schema:
         try:
             db.run("SELECT 1 FROM db_meta LIMIT 1")
@@ -129,6 +138,273 @@ def inserter(conn):
     return insert
 
 
+class BatchInserter(object):
+    """Buffers INSERTs and sends them to SQLite in batches with `executemany`.
+
+    Rows are grouped by table, column set and conflict clause. The rows of a
+    table are always written in the order they were added: when a row doesn't
+    fit in the current group of its table, that group is flushed first.
+
+    The buffered rows are invisible to queries until `flush` is called.
+    """
+
+    def __init__(self, conn, batch_size=1000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.groups = {}
+
+    def insert(self, table, attrs, replace=False):
+        keys = tuple(attrs)
+        group = self.groups.get(table)
+        if group and (group[0] != keys or group[1] != replace):
+            self.flush(table)
+            group = None
+        if not group:
+            group = self.groups[table] = (keys, replace, [])
+        rows = group[2]
+        rows.append(tuple(attrs.values()))
+        if len(rows) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table=None):
+        tables = [table] if table else list(self.groups)
+        for table in tables:
+            keys, replace, rows = self.groups.pop(table)
+            or_clause = 'OR REPLACE' if replace else ''
+            placeholders = ','.join(repeat('?', len(keys)))
+            conn = self.conn
+            total_changes = conn.total_changes
+            try:
+                conn.executemany("""
+                    INSERT {0} INTO {1} ({2}) VALUES ({3})
+                """.format(or_clause, table, ','.join(keys), placeholders), rows)
+            except IntegrityError:
+                # The rows that precede the offending one have been inserted
+                row = rows[conn.total_changes - total_changes]
+                print(table, *zip(keys, row), sep='\n    ')
+                raise
+
+
+class BatchUpdater(object):
+    """Buffers UPDATEs of single rows and sends them to SQLite in batches with `executemany`.
+
+    Rows are identified by their `id` column. Updates are grouped by table and
+    column set, a group is flushed when it reaches `batch_size` rows.
+
+    The buffered updates are invisible to queries until `flush` is called.
+    """
+
+    def __init__(self, conn, batch_size=1000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.groups = {}
+
+    def update(self, table, row_id, attrs):
+        key = (table, tuple(attrs))
+        rows = self.groups.setdefault(key, [])
+        rows.append(tuple(attrs.values()) + (row_id,))
+        if len(rows) >= self.batch_size:
+            self.flush(key)
+
+    def flush(self, key=None):
+        keys = [key] if key else list(self.groups)
+        for key in keys:
+            rows = self.groups.pop(key)
+            table, columns = key
+            self.conn.executemany("""
+                UPDATE {0} SET {1} WHERE id = ?
+            """.format(table, ', '.join(col + ' = ?' for col in columns)), rows)
+
+
+class Phase(object):
+    """Accumulates the time spent inside a `with` block, see `Profiler`.
+    """
+
+    __slots__ = ('calls', 'seconds', 'start')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.calls += 1
+        self.seconds += perf_counter() - self.start
+
+
+class NullPhase(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+class Profiler(object):
+    """Measures the time spent in the phases of a process.
+
+    `phase(name)` returns a context manager which measures the cumulative time
+    spent in the phase and the number of calls. The phases shouldn't be nested
+    in themselves. `count(name, n)` increments a counter, the counters are also
+    reported as rates per second.
+
+    If the profiler isn't enabled it doesn't measure anything, so it can be
+    used unconditionally.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+        self.counters = {}
+        self.start_time = perf_counter()
+        self.end_time = None
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        try:
+            return self.phases[name]
+        except KeyError:
+            phase = self.phases[name] = Phase()
+            return phase
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def iterate(self, iterable, name):
+        """Wraps `iterable`, the time spent getting its items is added to a phase.
+        """
+        if not self.enabled:
+            return iterable
+        phase = self.phase(name)
+
+        def wrapper():
+            iterator = iter(iterable)
+            while True:
+                with phase:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+
+        return wrapper()
+
+    def stop(self):
+        self.end_time = perf_counter()
+
+    def to_dict(self):
+        """Returns the measurements, the durations are in seconds.
+        """
+        duration = (self.end_time or perf_counter()) - self.start_time
+        return {
+            'duration': round(duration, 3),
+            'counters': dict(self.counters),
+            'rates': {
+                k + '_per_second': round(v / duration, 1) if duration else 0
+                for k, v in self.counters.items()
+            },
+            'phases': {
+                name: {'calls': phase.calls, 'seconds': round(phase.seconds, 3)}
+                for name, phase in self.phases.items()
+            },
+        }
+
+
+PACKED_DATA_V1 = b'\x01'
+
+
+def pack_data(obj):
+    """Serializes `obj` for the `duplicate_files.data` column.
+
+    The result is a version byte followed by zlib-compressed compact JSON.
+    """
+    data = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+    return Binary(PACKED_DATA_V1 + zlib.compress(data))
+
+
+def unpack_data(data):
+    """Deserializes the output of `pack_data`.
+
+    Older versions stored plain JSON text, it's still accepted.
+    """
+    if isinstance(data, _unicode):
+        return json.loads(data)
+    data = bytes(data)
+    version = data[:1]
+    if version == PACKED_DATA_V1:
+        return json.loads(zlib.decompress(data[1:]).decode('utf8'))
+    raise ValueError("unknown data format %r" % version)
+
+
+# The modules that use `changes_log` to process the DB incrementally
+CHANGES_LOG_CONSUMERS = ('normalize', 'html', 'anomalies')
+
+# The number of days of `changes_log` that are kept for a consumer that hasn't
+# processed the DB recently, see `purge_changes_log`
+CHANGES_LOG_RETENTION = 30
+
+
+def get_processed_until(db, consumer):
+    """Returns the `last_update` of the DB when `consumer` last processed it.
+
+    The rows that have changed since then are listed in the `changes_log` table,
+    with an `archive_date` greater than the returned value. If `None` is
+    returned, the whole DB has to be processed.
+    """
+    return db.one("SELECT value FROM db_meta WHERE key = ?", (consumer + '_processed_until',))
+
+
+def set_processed_until(db, consumer):
+    """Records that `consumer` has processed the DB, see `get_processed_until`.
+    """
+    last_update = db.one("SELECT value FROM db_meta WHERE key = 'last_update'")
+    if last_update is None:
+        return
+    db.insert('db_meta', dict(key=consumer + '_processed_until', value=last_update), replace=True)
+
+
+def purge_changes_log(db, retention=CHANGES_LOG_RETENTION):
+    """Deletes the rows of `changes_log` that aren't needed anymore.
+
+    A consumer that hasn't processed the DB yet will process all of it, so it
+    doesn't need any row of the log. A consumer that hasn't processed the DB
+    during the last `retention` days (for example `anomalies` when the
+    `--anomalies` option of tar2sqlite isn't used anymore) is reset, so that it
+    doesn't prevent the purge: its next run will process the whole DB.
+    """
+    last_update = db.one("SELECT value FROM db_meta WHERE key = 'last_update'")
+    oldest = None
+    if last_update:
+        oldest = datetime.strptime(last_update, '%Y%m%d-%H%M%S') - timedelta(days=retention)
+        oldest = oldest.strftime('%Y%m%d-%H%M%S')
+    dates = []
+    for consumer in CHANGES_LOG_CONSUMERS:
+        date = get_processed_until(db, consumer)
+        if date is None:
+            continue
+        if oldest and date < oldest:
+            print("> %s hasn't processed the DB since %s, its next run will be a full one" %
+                  (consumer, date))
+            db.run("DELETE FROM db_meta WHERE key = ?", (consumer + '_processed_until',))
+            continue
+        dates.append(date)
+    if dates:
+        db.run("DELETE FROM changes_log WHERE archive_date <= ?", (min(dates),))
+    else:
+        db.run("DELETE FROM changes_log")
+    return db.changes()
+
+
 def updater(conn):
 
     def dict2sql(d, joiner=', '):
@@ -162,6 +438,24 @@ def iter_results(q):
             yield row
 
 
+schema_index_re = re.compile(
+    r'^CREATE (UNIQUE )?INDEX (\w+) ON (\w+) \(([^)]+)\)[^;]*;$', re.M
+)
+
+
+def get_schema_indexes():
+    """Returns the indexes defined in `schema.sql`.
+
+    The return value is a list of `(name, table, columns, unique, sql)` tuples.
+    """
+    with open(ROOT + 'sql/schema.sql', 'r') as f:
+        schema = f.read()
+    return [
+        (m.group(2), m.group(3), m.group(4), bool(m.group(1)), m.group(0))
+        for m in schema_index_re.finditer(schema)
+    ]
+
+
 def run_migrations(db):
     v = db.one("SELECT value FROM db_meta WHERE key = 'schema_version'") or 0
     if v == 0:
@@ -261,3 +555,14 @@ def partition(l, predicate):
         else:
             b.append(e)
     return a, b
+
+
+def iter_chunks(iterable, size):
+    """Yields lists of `size` items (the last one can be shorter).
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
@@ -15,7 +15,7 @@ setup(
     author_email='changaco@changaco.oy.lc',
     url='https://github.com/Legilibre/legi.py',
     license='CC0',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['benchmarks', 'tests']),
     long_description="See https://github.com/Legilibre/legi.py",
     install_requires=open(join(dirname(__file__), 'requirements.txt')).read(),
     keywords='legi law france',
@@ -0,0 +1,65 @@
+# coding: utf8
+from __future__ import division, print_function, unicode_literals
+
+from legi.anomalies import CHECKS, get_scope
+from legi.utils import connect_db
+
+
+def get_query_plans(db, f):
+    """Calls `f` and returns the queries it sends to `db.all`, `db.one` and
+    `db.run`, along with their plans.
+
+    The plan of a query is taken just before it's run, since it can depend on
+    the queries that precede it (e.g. `CREATE TEMP TABLE`).
+    """
+    plans = []
+    methods = {name: getattr(db, name) for name in ('all', 'one', 'run')}
+
+    def wrap(method):
+        def wrapper(*a, **kw):
+            plans.append((a[0], list(db.execute("EXPLAIN QUERY PLAN " + a[0], *a[1:]))))
+            return method(*a, **kw)
+        return wrapper
+
+    for name, method in methods.items():
+        setattr(db, name, wrap(method))
+    try:
+        f()
+    finally:
+        for name, method in methods.items():
+            setattr(db, name, method)
+    return plans
+
+
+def get_scans(plan, ignored=()):
+    return [
+        (parent, detail) for _, parent, _, detail in plan
+        if detail.startswith('SCAN ') and detail.split()[1] not in ignored
+    ]
+
+
+def test_anomaly_checks_dont_do_nested_scans():
+    db = connect_db(':memory:')
+    db.insert('db_meta', dict(key='last_update', value='20180102-210000'))
+    noop = lambda *a: None
+
+    # A full detection scans each table at most once
+    plans = get_query_plans(db, lambda: [check(db, noop) for check in CHECKS])
+    assert len(plans) == 10
+    for query, plan in plans:
+        assert not any('AUTOMATIC' in row[3] for row in plan), (query, plan)
+        scans = get_scans(plan)
+        assert len(scans) <= 1, (query, plan)
+        # A scan inside a subquery would be repeated for each row of the outer loop
+        assert all(parent == 0 for parent, detail in scans), (query, plan)
+
+    # An incremental detection doesn't scan anything but the scope, including
+    # when it selects the entities in scope
+    plans = get_query_plans(db, lambda: [get_scope(db, '20180101-000000')] + [
+        check(db, noop, scope='anomalies_scope') for check in CHECKS
+    ])
+    assert len(plans) == 21
+    for query, plan in plans:
+        assert not any('AUTOMATIC' in row[3] for row in plan), (query, plan)
+        # `sc` is the alias of `anomalies_scope` in `get_scope`
+        assert not get_scans(plan, ignored=('anomalies_scope', 'sc')), (query, plan)
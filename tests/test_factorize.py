@@ -1,9 +1,214 @@
 from __future__ import division, print_function, unicode_literals
 
-from legi.factorize import main
+import pytest
+
+from legi.factorize import factorize, in_scope, main, verify
 from legi.utils import connect_db
 
 
 def test_factorize():
     db = connect_db(':memory:')
     main(db)
+
+
+ROWS = [
+    # id, nature, num, nor, titrefull_s, cid
+    ('A1', 'LOI', '2000-1', 'NOR0000001', 'loi a', 'C1'),
+    ('A2', 'LOI', '2000-1', None, 'loi a bis', 'C1'),
+    ('B1', 'DECRET', '2000-2', 'NOR0000002', 'decret b', 'C2'),
+    ('B2', 'DECRET', None, 'NOR0000002', 'decret b', 'C3'),
+    ('C1', 'ARRETE', None, None, 'arrete c', 'C4'),
+    ('C2', 'ARRETE', None, None, 'arrete c modifie', 'C4'),
+    ('D1', 'DECISION', '42', None, 'decision d', 'C5'),
+    ('D2', 'DECISION', '42', None, 'decision d bis', 'C6'),
+]
+
+
+def insert_rows(db, rows):
+    for row in rows:
+        db.insert('textes_versions', dict(
+            zip(('id', 'nature', 'num', 'nor', 'titrefull_s', 'cid'), row),
+            dossier='TNC_en_vigueur', mtime=0,
+        ))
+
+
+def modify_rows(db):
+    db.run("UPDATE textes_versions SET num = '2000-2', nature = 'DECRET' WHERE id = 'A2'")
+    db.run("DELETE FROM textes_versions WHERE id = 'B2'")
+    insert_rows(db, [('E1', 'LOI', '2000-1', None, 'loi e', 'C7')])
+    db.run("UPDATE textes_versions SET titrefull_s = 'arrete d', cid = 'C8' WHERE id = 'C2'")
+
+
+def get_groups(db):
+    groups = {}
+    for row_id, texte_id in db.all("SELECT id, texte_id FROM textes_versions"):
+        groups.setdefault(texte_id, set()).add(row_id)
+    return sorted(sorted(group) for group in groups.values())
+
+
+def test_incremental_factorize():
+    db = connect_db(':memory:')
+    insert_rows(db, ROWS)
+    main(db, incremental=True)
+    assert verify(db) == 0
+    assert get_groups(db) == [
+        ['A1', 'A2'], ['B1', 'B2'], ['C1', 'C2'], ['D1'], ['D2'],
+    ]
+    assert db.one("SELECT count(*) FROM factorize_snapshot") == len(ROWS)
+
+    # Nothing has changed
+    textes = list(db.all("SELECT * FROM textes ORDER BY id"))
+    main(db, incremental=True)
+    assert list(db.all("SELECT * FROM textes ORDER BY id")) == textes
+
+    # The legacy mode doesn't touch the rows that are already connected
+    modify_rows(db)
+    db.run("SAVEPOINT legacy")
+    main(db)
+    assert verify(db) > 0
+    db.run("ROLLBACK TO legacy")
+    db.run("RELEASE legacy")
+
+    # The incremental mode gives the same result as a factorization from scratch
+    d1_texte_id = db.one("SELECT texte_id FROM textes_versions WHERE id = 'D1'")
+    main(db, incremental=True)
+    assert verify(db) == 0
+    assert get_groups(db) == [
+        ['A1', 'E1'], ['A2', 'B1'], ['C1'], ['C2'], ['D1'], ['D2'],
+    ]
+    # The rows that aren't connected to the modified ones keep their texte_id
+    assert db.one("SELECT texte_id FROM textes_versions WHERE id = 'D1'") == d1_texte_id
+    assert db.one("SELECT count(*) FROM factorize_snapshot") == len(ROWS)
+
+
+def test_incremental_factorize_keeps_texte_ids():
+    db = connect_db(':memory:')
+    insert_rows(db, ROWS)
+    main(db)
+    texte_ids = dict(db.all("SELECT id, texte_id FROM textes_versions"))
+
+    # The first incremental run starts from the existing connections
+    main(db, incremental=True)
+    assert dict(db.all("SELECT id, texte_id FROM textes_versions")) == texte_ids
+    assert db.one("SELECT count(*) FROM factorize_snapshot") == len(ROWS)
+
+    # A refactorized group keeps its ID
+    insert_rows(db, [('A3', 'LOI', '2000-1', None, 'loi a ter', 'C9')])
+    main(db, incremental=True)
+    assert verify(db) == 0
+    texte_ids['A3'] = texte_ids['A1']
+    assert dict(db.all("SELECT id, texte_id FROM textes_versions")) == texte_ids
+    assert db.one("SELECT count(*) FROM textes") == len(set(texte_ids.values()))
+
+
+# The title groups overlap: the third one contains textes that have been
+# merged by the first two, so all the rows end up in the same texte
+OVERLAPPING_ROWS = [
+    ('R1', 'DECRET', '3', 'N3', 'c', 'C5'),
+    ('R3', 'DECRET', '2', 'N1', 'a', 'C1'),
+    ('R4', 'LOI', None, 'N3', 'd', 'C1'),
+    ('R5', 'DECRET', '2', None, 'c', 'C3'),
+    ('R6', 'LOI', '1', 'N2', 'a', 'C2'),
+    ('R8', 'DECRET', '1', 'N2', 'b', 'C4'),
+    ('R9', 'DECRET', '2', 'N1', 'a', 'C1'),
+    ('R10', 'DECRET', '3', 'N2', 'b', 'C2'),
+    ('R11', 'DECRET', '3', 'N1', 'c', 'C3'),
+    ('R12', 'LOI', '1', 'N2', 'd', 'C2'),
+    ('R13', 'DECRET', '1', None, 'b', 'C1'),
+]
+
+
+@pytest.mark.parametrize('scoped', [False, True])
+def test_overlapping_duplicates(scoped):
+    # The result used to depend on the query plan of `factorize_by`: the
+    # groups of duplicates were read while the textes were being merged, and
+    # reading them up front without following the merges wasn't transitive
+    db = connect_db(':memory:')
+    insert_rows(db, OVERLAPPING_ROWS)
+    scope = ''
+    if scoped:
+        db.run("CREATE TEMP TABLE factorize_scope (id char(20) primary key)")
+        db.run("INSERT INTO factorize_scope (id) SELECT id FROM textes_versions")
+        scope = in_scope()
+    factorize(db, scope)
+    assert verify(db) == 0
+    assert get_groups(db) == [sorted(r[0] for r in OVERLAPPING_ROWS)]
+
+
+@pytest.mark.parametrize('rows', [ROWS, OVERLAPPING_ROWS])
+def test_union_find_engine(capsys, rows):
+    dbs = {}
+    outputs = {}
+    for engine in ('sql', 'union-find'):
+        db = dbs[engine] = connect_db(':memory:')
+        insert_rows(db, rows)
+        capsys.readouterr()
+        main(db, engine=engine)
+        outputs[engine] = capsys.readouterr().out
+    assert outputs['union-find'] == outputs['sql']
+    for q in ("SELECT * FROM textes ORDER BY id",
+              "SELECT id, texte_id FROM textes_versions ORDER BY id"):
+        assert list(dbs['union-find'].all(q)) == list(dbs['sql'].all(q))
+    assert verify(dbs['union-find']) == 0
+
+
+def get_texte_ids(db):
+    return dict(db.all("SELECT id, texte_id FROM textes_versions"))
+
+
+@pytest.mark.parametrize('engine', ['sql', 'union-find'])
+def test_connect_by_nor(capsys, engine):
+    db = connect_db(':memory:')
+    insert_rows(db, [
+        ('X1', 'LOI', '2000-5', 'NOR0000005', 'loi x', 'C1'),
+        ('X2', 'LOI', None, 'NOR0000005', 'loi x modifiee', 'C2'),
+    ])
+    main(db, engine=engine)
+    assert 'connected 1 rows of textes_versions based on nor\n' in capsys.readouterr().out
+    texte_ids = get_texte_ids(db)
+    assert texte_ids['X1'] == texte_ids['X2']
+
+
+@pytest.mark.parametrize('engine', ['sql', 'union-find'])
+def test_ambiguous_titrefull_s(engine):
+    # When the title is used for the first time it's shared by two textes,
+    # this used to violate the unique index of the temporary table
+    db = connect_db(':memory:')
+    insert_rows(db, [
+        ('Y1', 'LOI', '2000-1', None, 'loi y', 'C1'),
+        ('Y2', 'LOI', '2000-2', None, 'loi y', 'C2'),
+        ('Y3', 'LOI', None, None, 'loi y', 'C3'),
+    ])
+    main(db, engine=engine)
+    assert len(set(get_texte_ids(db).values())) == 1
+
+
+@pytest.mark.parametrize('engine', ['sql', 'union-find'])
+def test_partially_merged_titrefull_s(engine):
+    # Z3 is merged with Z1 based on 'loi z', the merge based on 'loi z bis'
+    # has to follow it, and Z5 has to be connected to the resulting texte
+    # instead of violating the unique index of `textes.titrefull_s`
+    db = connect_db(':memory:')
+    insert_rows(db, [
+        ('Z1', 'LOI', '2000-1', None, 'loi z', 'C1'),
+        ('Z2', 'LOI', '2000-2', None, 'loi z', 'C2'),
+        ('Z3', 'LOI', '2000-2', None, 'loi z bis', 'C3'),
+        ('Z4', 'LOI', '2000-3', None, 'loi z bis', 'C4'),
+        ('Z5', 'DECISION', None, None, 'loi z bis', 'C5'),
+    ])
+    main(db, engine=engine)
+    texte_ids = get_texte_ids(db)
+    assert len(set(texte_ids.values())) == 1
+
+
+def test_incremental_union_find_engine():
+    db = connect_db(':memory:')
+    insert_rows(db, ROWS)
+    main(db, incremental=True, engine='union-find')
+    assert verify(db) == 0
+    modify_rows(db)
+    main(db, incremental=True, engine='union-find')
+    assert verify(db) == 0
+    assert get_groups(db) == [
+        ['A1', 'E1'], ['A2', 'B1'], ['C1'], ['C2'], ['D1'], ['D2'],
+    ]
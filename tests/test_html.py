@@ -1,7 +1,12 @@
 # coding: utf8
 from __future__ import division, print_function, unicode_literals
 
-from legi.html import clean_html
+import json
+
+from legi.html import (
+    analyze, clean_all_html_in_db, clean_html, clean_new_html_in_db, get_font_size_policy,
+)
+from legi.utils import connect_db, get_processed_until
 
 
 def test_clean_html_on_empty_string():
@@ -102,3 +107,138 @@ def test_clean_html_preserves_attribute_order():
     expected = '<h1 a="0" b="1" c="2" d="3" e="4">Titre</h1>'
     actual = clean_html(expected)
     assert actual == expected
+
+
+def test_clean_html_drops_inherited_styles():
+    unclean = (
+        '<font color="#FF0000"><b><font color="#ff0000" size="2">x <pre> a  b</pre></font></b></font>'
+        '<pre><b>  c  </b></pre>'
+    )
+    cleaned = clean_html(unclean)
+    expected = (
+        '<font color="#ff0000"><b><font size="2">x<pre> a  b</pre></font></b></font>'
+        '<pre><b>  c  </b></pre>'
+    )
+    assert cleaned == expected
+
+
+HTML_ROWS = [
+    '<p> Lorem <span>ipsum</span></p>',
+    '<p>Lorem ipsum</p>',
+    None,
+    '<p a=\'"\'> dolor  sit </p>',
+    '<h1 align="center">Titre <font>1</font></h1><p id="foo"></p>',
+    "L' <span>article 2</span>\n.",
+    '',
+]
+
+
+def insert_html_rows(db):
+    for i, html in enumerate(HTML_ROWS):
+        db.insert('articles', dict(
+            id='ARTICLE%i' % i, bloc_textuel=html, nota=HTML_ROWS[-i],
+            dossier='code_en_vigueur', cid='CID', mtime=0,
+        ))
+
+
+def test_clean_all_html_in_db_in_parallel(capsys):
+    tables = {}
+    outputs = {}
+    for workers in (1, 2):
+        db = connect_db(':memory:')
+        insert_html_rows(db)
+        capsys.readouterr()
+        clean_all_html_in_db(db, workers=workers, batch_size=2)
+        outputs[workers] = capsys.readouterr().out
+        tables[workers] = list(db.all("SELECT * FROM articles ORDER BY id"))
+    assert "Cleaned 8 HTML fragments, out of 14." in outputs[1]
+    assert "increased the length from 25 to 26" in outputs[1]
+    assert outputs[2] == outputs[1]
+    assert tables[2] == tables[1]
+    assert tables[1][0][8] == '<p>Lorem ipsum</p>'
+
+
+def test_clean_all_html_in_db_with_cache(capsys):
+    tables = {}
+    outputs = {}
+    for cache_size in (0, 100):
+        db = connect_db(':memory:')
+        insert_html_rows(db)
+        capsys.readouterr()
+        clean_all_html_in_db(db, batch_size=3, cache_size=cache_size)
+        outputs[cache_size] = capsys.readouterr().out.split('Cache: ')
+        tables[cache_size] = list(db.all("SELECT * FROM articles ORDER BY id"))
+    assert outputs[100][0] == outputs[0][0]
+    assert tables[100] == tables[0]
+    # Each fragment appears twice
+    assert outputs[100][1] == "5 hits, 5 misses, hit ratio = 50.0%.\n"
+
+
+def test_clean_all_html_in_db_with_persisted_cache(capsys):
+    db = connect_db(':memory:')
+    insert_html_rows(db)
+    clean_all_html_in_db(db, persist_cache=True)
+    assert db.one("SELECT count(*) FROM html_cleaning_cache") == 5
+    db.run("DELETE FROM articles")
+    insert_html_rows(db)
+    capsys.readouterr()
+    clean_all_html_in_db(db, persist_cache=True)
+    assert capsys.readouterr().out.endswith("10 hits, 0 misses, hit ratio = 100.0%.\n")
+
+
+def test_clean_new_html_in_db():
+    db = connect_db(':memory:')
+    insert_html_rows(db)
+    html = '<p> <font size="2">Lorem</font> </p>'
+    db.run("UPDATE articles SET bloc_textuel = ?", (html,))
+    db.insert('db_meta', dict(key='last_update', value='20180102-000000'))
+    # The HTML of the DB has never been cleaned
+    clean_new_html_in_db(db)
+    assert db.one("SELECT count(*) FROM articles WHERE bloc_textuel = ?", (html,)) == 7
+    # Only the rows that have changed since the last cleaning are cleaned
+    db.insert('db_meta', dict(key='html_font_size', value='drop'))
+    db.insert('db_meta', dict(key='html_processed_until', value='20180101-000000'))
+    for archive_date, article_id in [('20180101-000000', 'ARTICLE1'),
+                                     ('20180102-000000', 'ARTICLE2'),
+                                     ('20180102-000000', 'ARTICLE3')]:
+        db.insert('changes_log', dict(
+            archive_date=archive_date, tbl='articles', id=article_id, cid='CID',
+        ))
+    clean_new_html_in_db(db)
+    assert list(db.all("SELECT id, bloc_textuel FROM articles ORDER BY id")) == [
+        ('ARTICLE0', html),
+        ('ARTICLE1', html),
+        ('ARTICLE2', '<p>Lorem</p>'),
+        ('ARTICLE3', '<p>Lorem</p>'),
+        ('ARTICLE4', html),
+        ('ARTICLE5', html),
+        ('ARTICLE6', html),
+    ]
+    assert get_processed_until(db, 'html') == '20180102-000000'
+    assert get_font_size_policy() == 'keep-small'
+
+
+def test_analyze(capsys, tmpdir):
+    db = connect_db(str(tmpdir.join('db.sqlite')))
+    for i in range(10):
+        db.insert('articles', dict(
+            id='ARTICLE%i' % i, bloc_textuel='<p align="center">%i<br/></p><!-- x -->' % i,
+            nota='<p id="%i">Lorem</p>' % i if i % 2 else None,
+            dossier='code_en_vigueur', cid='CID', mtime=0,
+        ))
+    db.commit()
+    outputs = []
+    for workers in (1, 2):
+        capsys.readouterr()
+        analyze(db, workers=workers, shard_size=3)
+        outputs.append(json.loads(capsys.readouterr().out))
+    assert outputs[0] == outputs[1] == {
+        '<!--': {'attrs': {}, 'count': 10},
+        'br': {'attrs': {}, 'count': 10},
+        'p': {'attrs': {'align = center': 10, 'id': 5}, 'count': 15},
+    }
+    # Sampling
+    analyze(db, sample=0.5, shard_size=3)
+    out = capsys.readouterr().out
+    assert out.startswith("> Analyzing a sample of 50.0% of the rows\n")
+    assert 0 < json.loads(out.split('\n', 1)[1])['br']['count'] < 10
@@ -15,3 +15,14 @@ def test_innerHTML():
     assert innerHTML(el) == 'text'
     el = etree.fromstring('<root attr="value"> </root>')
     assert innerHTML(el) == ' '
+
+
+def test_innerHTML_of_text_only_elements():
+    # The fast path has to match the output of `etree.tostring`
+    for text in ('a & b', '<b>bold</b>', 'x > y', 'a\rb', 'l\'"été"', '\n'):
+        el = etree.Element('root')
+        el.text = text
+        r = etree.tostring(el, encoding='unicode')
+        assert innerHTML(el) == r[len('<root>'):-len('</root>')]
+    el = etree.fromstring('<root>a<br/>b &amp; c</root>')
+    assert innerHTML(el) == 'a<br/>b &amp; c'
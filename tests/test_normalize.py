@@ -2,7 +2,7 @@
 from __future__ import division, print_function, unicode_literals
 
 from legi.normalize import main
-from legi.utils import connect_db
+from legi.utils import connect_db, get_processed_until, purge_changes_log
 
 
 DATA = [
@@ -119,3 +119,34 @@ def test_normalize():
 
     assert data_brutes[5].bits == 4
     assert data_norm[5].titrefull == "Arrêté du 5 septembre 2002"
+
+
+def test_incremental_normalize():
+    db = connect_db(':memory:')
+    db.insert("db_meta", dict(key='last_update', value='20180101-000000'))
+    for row in DATA[:3]:
+        db.insert("textes_versions", row)
+    main(db)
+    assert get_processed_until(db, 'normalize') == '20180101-000000'
+
+    # Only the rows in the changes log are normalized
+    db.run("UPDATE db_meta SET value = '20180102-210000' WHERE key = 'last_update'")
+    for row in DATA[3:5]:
+        db.insert("textes_versions", row)
+        db.insert("changes_log", dict(
+            archive_date='20180102-210000', tbl='textes_versions', id=row['id'], cid=row['cid'],
+        ))
+    db.insert("textes_versions", DATA[5])
+    main(db)
+    titres = [r[0] for r in db.all("SELECT titrefull FROM textes_versions ORDER BY rowid")]
+    assert titres[3:] == [
+        "Code minier (nouveau)", "Arrêté du 18 décembre 2014 modifiant …", DATA[5]['titrefull'],
+    ]
+    assert db.one("SELECT count(*) FROM textes_versions_brutes") == 5
+
+    # A full normalization processes the other rows
+    main(db, full=True)
+    assert db.one("SELECT titrefull FROM textes_versions WHERE id = ?", (DATA[5]['id'],)) == \
+        "Arrêté du 5 septembre 2002"
+    assert get_processed_until(db, 'normalize') == '20180102-210000'
+    assert purge_changes_log(db) == 2
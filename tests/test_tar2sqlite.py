@@ -0,0 +1,684 @@
+# coding: utf8
+from __future__ import division, print_function, unicode_literals
+
+import io
+import json
+import os
+from sqlite3 import IntegrityError
+import tarfile
+
+from lxml import etree
+import pytest
+
+from legi.anomalies import CHECK_INDEXES, detect_anomalies
+from legi.tar2sqlite import (
+    SOUS_DOSSIER_MAP, MtimeIndex, create_schema_indexes, drop_schema_indexes, find_child,
+    find_last_descendant, get_checkpoint, get_table, main, preparse_archive, process_archive,
+    suppress, suppress_file,
+)
+from legi.utils import Profiler, connect_db, id_to_path
+
+
+TABLES = (
+    'articles', 'sections', 'textes_structs', 'textes_versions',
+    'liens', 'sommaires', 'duplicate_files', 'textes_versions_brutes',
+)
+
+CID = 'LEGITEXT000006070721'
+CID_2 = 'JORFTEXT000000878035'
+
+
+def article_xml(id, cid, num, etat='VIGUEUR', section='LEGISCTA000006089696', liens=''):
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<ARTICLE>
+<META>
+<META_COMMUN><ID>{id}</ID><ANCIEN_ID/><ORIGINE>LEGI</ORIGINE><NATURE>Article</NATURE></META_COMMUN>
+<META_SPEC>
+<META_ARTICLE>
+<NUM>{num}</NUM>
+<ETAT>{etat}</ETAT>
+<DATE_DEBUT>2002-01-01</DATE_DEBUT>
+<DATE_FIN>2999-01-01</DATE_FIN>
+<TYPE>AUTONOME</TYPE>
+</META_ARTICLE>
+</META_SPEC>
+</META>
+<CONTEXTE>
+<TEXTE cid="{cid}" nature="CODE">
+<TITRE_TXT c_titre_court="Code civil" id_txt="{cid}">Code civil</TITRE_TXT>
+<TM><TITRE_TM id="{section}">Titre préliminaire</TITRE_TM></TM>
+</TEXTE>
+</CONTEXTE>
+<NOTA><CONTENU/></NOTA>
+<BLOC_TEXTUEL>
+<CONTENU>Les lois &amp; les <i>décrets</i> <br/>
+<p align="left">entrent en vigueur.</p></CONTENU>
+</BLOC_TEXTUEL>
+<LIENS>{liens}</LIENS>
+</ARTICLE>
+'''.format(**locals())
+
+
+def section_xml(id, cid, elements):
+    liens = '\n'.join(
+        '<LIEN_ART debut="2002-01-01" etat="VIGUEUR" fin="2999-01-01" id="%s" num="%s" origine="LEGI"/>' % e
+        for e in elements
+    )
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<SECTION_TA>
+<ID>{id}</ID>
+<TITRE_TA>Titre préliminaire : De la publication des lois</TITRE_TA>
+<COMMENTAIRE/>
+<CONTEXTE>
+<TEXTE cid="{cid}"><TITRE_TXT id_txt="{cid}">Code civil</TITRE_TXT></TEXTE>
+</CONTEXTE>
+<STRUCTURE_TA>
+{liens}
+</STRUCTURE_TA>
+</SECTION_TA>
+'''.format(**locals())
+
+
+def struct_xml(id, elements):
+    liens = '\n'.join(
+        '<LIEN_SECTION_TA debut="2002-01-01" etat="VIGUEUR" fin="2999-01-01" id="%s" niv="1">Titre</LIEN_SECTION_TA>' % e
+        for e in elements
+    )
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<TEXTELR>
+<META>
+<META_COMMUN><ID>{id}</ID><NATURE>CODE</NATURE></META_COMMUN>
+</META>
+<VERSIONS>
+<VERSION etat="VIGUEUR"><LIEN_TXT debut="1803-03-15" fin="2999-01-01" id="{id}" num=""/></VERSION>
+</VERSIONS>
+<STRUCT>
+{liens}
+</STRUCT>
+</TEXTELR>
+'''.format(**locals())
+
+
+def version_xml(id, cid, titre='Code civil', nature='CODE'):
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<TEXTE_VERSION>
+<META>
+<META_COMMUN><ID>{id}</ID><NATURE>{nature}</NATURE></META_COMMUN>
+<META_SPEC>
+<META_TEXTE_CHRONICLE>
+<CID>{cid}</CID>
+<NUM/>
+<NUM_SEQUENCE>0</NUM_SEQUENCE>
+<NOR/>
+<DATE_PUBLI>2999-01-01</DATE_PUBLI>
+<DATE_TEXTE>2999-01-01</DATE_TEXTE>
+<DERNIERE_MODIFICATION>2018-01-01</DERNIERE_MODIFICATION>
+<ORIGINE_PUBLI/>
+<PAGE_DEB_PUBLI>0</PAGE_DEB_PUBLI>
+<PAGE_FIN_PUBLI>0</PAGE_FIN_PUBLI>
+</META_TEXTE_CHRONICLE>
+<META_TEXTE_VERSION>
+<TITRE>{titre}</TITRE>
+<TITREFULL>{titre}</TITREFULL>
+<ETAT>VIGUEUR</ETAT>
+<DATE_DEBUT>2018-01-01</DATE_DEBUT>
+<DATE_FIN>2999-01-01</DATE_FIN>
+<AUTORITE/>
+<MINISTERE/>
+<LIENS>
+<LIEN cidtexte="JORFTEXT000000000001" id="JORFTEXT000000000001" sens="source" typelien="CITATION">Loi</LIEN>
+<LIEN id="LEGIARTI000006419280" sens="cible" typelien="MODIFICATION"/>
+</LIENS>
+</META_TEXTE_VERSION>
+</META_SPEC>
+</META>
+<VISAS><CONTENU>Vu la Constitution ;</CONTENU></VISAS>
+<SIGNATAIRES><CONTENU/></SIGNATAIRES>
+<TP><CONTENU/></TP>
+<NOTA><CONTENU/></NOTA>
+<ABRO><CONTENU/></ABRO>
+<RECT><CONTENU/></RECT>
+</TEXTE_VERSION>
+'''.format(**locals())
+
+
+def file_path(dossier, cid, sous_dossier, id):
+    x = 'en' if dossier.endswith('_en_vigueur') else 'non'
+    if id[4:8] != 'TEXT':
+        id = id_to_path(id)
+    return '/'.join((
+        'legi/global/code_et_TNC_%s_vigueur' % x, dossier, id_to_path(cid), sous_dossier, id
+    ))
+
+
+LIEN_CITATION = (
+    '<LIEN cidtexte="JORFTEXT000000000002" id="JORFTEXT000000000002" sens="source" '
+    'typelien="CITATION">Loi n° 2000-1</LIEN>'
+)
+LIEN_CIBLE = '<LIEN id="LEGIARTI000006419999" sens="cible" typelien="CREATION"/>'
+
+ARTICLES = ['LEGIARTI0000064192%02i' % i for i in range(80)]
+SECTION = 'LEGISCTA000006089696'
+
+
+def global_archive_files():
+    files = [
+        (file_path('code_en_vigueur', CID, 'texte/struct', CID) + '.xml', 100,
+         struct_xml(CID, [SECTION])),
+        (file_path('code_en_vigueur', CID, 'texte/version', CID) + '.xml', 100,
+         version_xml(CID, CID)),
+        (file_path('code_en_vigueur', CID, 'section_ta', SECTION) + '.xml', 100,
+         section_xml(SECTION, CID, [(a, str(i)) for i, a in enumerate(ARTICLES)])),
+    ]
+    for i, article_id in enumerate(ARTICLES):
+        liens = LIEN_CITATION + (LIEN_CIBLE if i % 3 == 0 else '')
+        files.append((file_path('code_en_vigueur', CID, 'article', article_id) + '.xml', 100,
+                      article_xml(article_id, CID, str(i), liens=liens)))
+    # An older duplicate, it goes straight into `duplicate_files`
+    files.append((file_path('TNC_en_vigueur', CID_2, 'article', ARTICLES[1]) + '.xml', 50,
+                  article_xml(ARTICLES[1], CID_2, '1', etat='ABROGE', liens=LIEN_CITATION)))
+    # A newer duplicate, it replaces the row that's already in the DB
+    files.append((file_path('TNC_en_vigueur', CID_2, 'article', ARTICLES[2]) + '.xml', 150,
+                  article_xml(ARTICLES[2], CID_2, '2', etat='MODIFIE', liens=LIEN_CIBLE)))
+    # A file in an unknown folder
+    files.append(('legi/global/eli/foo.xml', 100, '<foo/>'))
+    return files
+
+
+def daily_archive_files(prefix='20180102-210000/'):
+    files = [
+        (prefix + path, mtime + 100, xml) for path, mtime, xml in global_archive_files()
+        if ARTICLES[5] in path or ARTICLES[6] in path
+    ] + [
+        (prefix + path, mtime, xml) for path, mtime, xml in global_archive_files()
+        if ARTICLES[7] in path
+    ]
+    suppressed = [
+        file_path('code_en_vigueur', CID, 'article', ARTICLES[2]),
+        file_path('code_en_vigueur', CID, 'article', ARTICLES[8]),
+    ]
+    files.append((
+        prefix + 'liste_suppression_legi.dat', 200, '\n'.join(suppressed) + '\n'
+    ))
+    return files
+
+
+def make_archive(path, files):
+    with tarfile.open(str(path), 'w:gz') as tar:
+        for name, mtime, content in files:
+            data = content.encode('utf8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            tar.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+def dump_db(db):
+    return {table: list(db.all("SELECT * FROM " + table)) for table in TABLES}
+
+
+@pytest.fixture
+def archives(tmpdir):
+    return [
+        make_archive(tmpdir.join('LEGI_20180101-000000.tar.gz'), global_archive_files()),
+        make_archive(tmpdir.join('legi_20180102-210000.tar.gz'), daily_archive_files()),
+    ]
+
+
+def import_archives(archives, **kw):
+    db = connect_db(':memory:')
+    for archive_path in archives:
+        with db:
+            process_archive(db, archive_path, **kw)
+    return db
+
+
+def test_process_archive(archives):
+    db = import_archives(archives)
+    assert db.one("SELECT count(*) FROM articles") == 79
+    assert db.one("SELECT count(*) FROM sommaires") == 81
+    assert db.one("SELECT etat FROM articles WHERE id = ?", (ARTICLES[1],)) == 'VIGUEUR'
+    assert db.one("SELECT cid FROM articles WHERE id = ?", (ARTICLES[2],)) == CID_2
+    assert db.one("SELECT count(*) FROM articles WHERE id = ?", (ARTICLES[8],)) == 0
+    assert db.one("SELECT mtime FROM articles WHERE id = ?", (ARTICLES[5],)) == 200
+    assert db.one("SELECT count(*) FROM liens WHERE dst_id = ?", (CID,)) == 1
+    duplicates = list(db.all("SELECT id, cid FROM duplicate_files ORDER BY id"))
+    assert duplicates == [(ARTICLES[1], CID_2)]
+
+
+def test_process_archive_logs_the_changes(archives):
+    db = connect_db(':memory:')
+    with db:
+        process_archive(db, archives[0])
+        process_archive(db, archives[1], archive_date='20180102-210000')
+    changes = list(db.all("SELECT * FROM changes_log ORDER BY id"))
+    # ARTICLES[7] hasn't changed, ARTICLES[8] has been deleted
+    assert changes == [
+        ('20180102-210000', 'articles', ARTICLES[i], CID) for i in (5, 6, 8)
+    ]
+
+
+def read_delta(delta):
+    lines = [json.loads(line) for line in delta.getvalue().decode('utf8').splitlines()]
+    return lines[0], lines[1:]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_incremental_anomaly_detection(archives, tmpdir, capsys, workers):
+    db = connect_db(str(tmpdir.join('db.sqlite')))
+    with db:
+        process_archive(db, archives[0])
+        db.insert('db_meta', dict(key='last_update', value='20180101-000000'))
+    index = io.BytesIO()
+    with db:
+        report, delta = io.StringIO(), io.BytesIO()
+        n_before = detect_anomalies(db, report, workers=workers, delta=delta, index=index)
+    header, changes = read_delta(delta)
+    assert header == {
+        'appeared': n_before, 'count': n_before, 'date': '20180101-000000',
+        'disappeared': 0, 'since': None,
+    }
+    assert read_delta(index) == (header, [])
+    # The anomalies are listed in the order of the checks, then by path
+    changes.sort(key=lambda c: (CHECK_INDEXES[c['check']], c['path'], json.dumps(c['args'])))
+    assert report.getvalue() == ''.join(
+        '%s: %s\n' % (c['path'], ''.join('{0}'.format(x) for x in c['args'])) for c in changes
+    )
+    # Remove the last ten articles from the section, and delete one of the others
+    prefix = '20180102-210000/'
+    files = daily_archive_files(prefix) + [(
+        prefix + file_path('code_en_vigueur', CID, 'section_ta', SECTION) + '.xml', 200,
+        section_xml(SECTION, CID, [(a, str(i)) for i, a in enumerate(ARTICLES[:70])]),
+    )]
+    archive = make_archive(tmpdir.join('legi_20180102-210000.tar.gz'), files)
+    with db:
+        process_archive(db, archive, archive_date='20180102-210000')
+        db.run("UPDATE db_meta SET value = '20180102-210000' WHERE key = 'last_update'")
+    removed = set(db.all("SELECT id FROM changes_log WHERE tbl = 'sommaires'"))
+    assert removed == set((a,) for a in ARTICLES)
+    capsys.readouterr()
+    incremental, delta = io.StringIO(), io.BytesIO()
+    with db:
+        n = detect_anomalies(db, incremental, workers=workers, delta=delta, index=index)
+    assert "anomalies of 82 entities" in capsys.readouterr().err
+    header, changes = read_delta(delta)
+    assert read_delta(index)[1] == [header]
+    assert header['since'] == '20180101-000000'
+    assert header['count'] == n == n_before + header['appeared'] - header['disappeared']
+    assert len(changes) == header['appeared'] + header['disappeared']
+    assert dict(change='+', check='orphans', id=ARTICLES[75], path=file_path(
+        'code_en_vigueur', CID, 'article', ARTICLES[75]
+    ) + '.xml', args=["article orphelin, il n'apparaît dans aucun texte"]) in changes
+    # The result is the same as a full detection
+    full, delta = io.StringIO(), io.BytesIO()
+    assert detect_anomalies(db, full, full=True, delta=delta) == n
+    assert read_delta(delta)[1] == []
+    assert incremental.getvalue() == full.getvalue() != report.getvalue()
+    assert full.getvalue().count('article orphelin') == 10
+    assert "l'article %s référencé en position 9 est introuvable" % ARTICLES[8] in full.getvalue()
+    # The anomalies of `element_sommaire` come before the ones of `orphans`,
+    # although the paths of the orphans sort first
+    assert full.getvalue().index('introuvable') < full.getvalue().index('article orphelin')
+    # Nothing has changed since the last detection
+    again = io.StringIO()
+    detect_anomalies(db, again, workers=workers)
+    assert "anomalies of 0 entities" in capsys.readouterr().err
+    assert again.getvalue() == full.getvalue()
+
+
+def test_process_archive_with_workers(archives):
+    serial = dump_db(import_archives(archives))
+    parallel = dump_db(import_archives(archives, workers=2))
+    assert parallel == serial
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_process_archive_with_a_reader_thread(archives, workers):
+    expected = dump_db(import_archives(archives))
+    actual = dump_db(import_archives(archives, workers=workers, read_ahead=True))
+    assert actual == expected
+
+
+@pytest.mark.parametrize('kw', [{}, {'workers': 2}, {'use_archive_index': True}])
+def test_process_archive_with_preparsed_files(archives, tmpdir, kw):
+    expected = dump_db(import_archives(archives))
+    if kw.get('use_archive_index'):
+        import_archives(archives, **kw)
+    db = connect_db(':memory:')
+    for archive_path in archives:
+        spool_path = str(tmpdir.join(os.path.basename(archive_path) + '.pickle'))
+        preparse_archive(archive_path, spool_path)
+        with db:
+            process_archive(db, archive_path, preparsed=spool_path, **kw)
+    assert dump_db(db) == expected
+
+
+def test_main_with_prefetch(tmpdir, monkeypatch):
+    directory = tmpdir.mkdir('archives')
+    make_archive(directory.join('legi_global_20180101-000000.tar.gz'), global_archive_files())
+    for date in ('20180102-210000', '20180103-210000'):
+        make_archive(directory.join('legi_%s.tar.gz' % date), daily_archive_files(date + '/'))
+    dumps = []
+    for options in ([], ['--prefetch']):
+        db_path = str(tmpdir.join('legi%i.sqlite' % len(dumps)))
+        argv = ['tar2sqlite', db_path, str(directory), '--raw'] + options
+        monkeypatch.setattr('sys.argv', argv)
+        main()
+        db = connect_db(db_path)
+        assert db.one("SELECT value FROM db_meta WHERE key = 'last_update'") == '20180103-210000'
+        dumps.append(dump_db(db))
+    assert dumps[1] == dumps[0]
+
+
+@pytest.mark.parametrize('options', [[], ['--archive-index']])
+def test_main_twice_over_the_same_directory(tmpdir, monkeypatch, options):
+    directory = tmpdir.mkdir('archives')
+    make_archive(directory.join('Freemium_legi_global_20180101-000000.tar.gz'),
+                 global_archive_files())
+    make_archive(directory.join('legi_20180102-210000.tar.gz'),
+                 daily_archive_files('20180102-210000/'))
+    db_path = str(tmpdir.join('legi.sqlite'))
+    # The first run creates the DB, the second one rebuilds it from scratch
+    argv = ['tar2sqlite', db_path, str(directory), '--raw'] + options
+    monkeypatch.setattr('sys.argv', argv)
+    main()
+    if options:
+        assert directory.join('legi_20180102-210000.tar.gz.index.gz').check()
+    expected = dump_db(connect_db(db_path))
+    os.remove(db_path)
+    main()
+    assert dump_db(connect_db(db_path)) == expected
+    # A run without the option isn't disturbed by the index files either
+    monkeypatch.setattr('sys.argv', argv[:4])
+    main()
+    assert dump_db(connect_db(db_path)) == expected
+
+
+@pytest.mark.parametrize('batch_size', [1, 7])
+def test_process_archive_with_various_batch_sizes(archives, batch_size):
+    expected = dump_db(import_archives(archives, batch_size=100000))
+    actual = dump_db(import_archives(archives, batch_size=batch_size))
+    assert actual == expected
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_process_archive_with_a_profiler(archives, capsys, workers):
+    expected = dump_db(import_archives(archives, workers=workers))
+    capsys.readouterr()
+    db = connect_db(':memory:')
+    profiler = Profiler()
+    with db:
+        process_archive(db, archives[0], workers=workers, profiler=profiler)
+    assert 'profile of the import:' in capsys.readouterr().out
+    report = profiler.to_dict()
+    assert report['counters']['files'] == 86
+    assert report['counters']['bytes'] > 0
+    expected_phases = {'read', 'lookup', 'parse', 'duplicates', 'write'}
+    if workers > 1:
+        expected_phases.add('wait_for_workers')
+    assert expected_phases.issubset(report['phases'])
+    with db:
+        process_archive(db, archives[1], workers=workers, profiler=Profiler())
+    assert dump_db(db) == expected
+
+
+def test_find_child():
+    root = etree.fromstring('<a><b><c>1</c><c>2<d><c>3</c></d></c></b><b/></a>')
+    assert find_child(root, 'b') is root[0]
+    assert find_child(root, 'b', 'c').text == '1'
+    assert find_child(root, 'b', 'x') is None
+    assert find_child(root, 'x', 'c') is None
+    assert find_last_descendant(root, 'c').text == '3'
+    assert find_last_descendant(root[1], 'c') is None
+
+
+def test_mtime_index(monkeypatch):
+    monkeypatch.setattr(MtimeIndex, 'MERGE_THRESHOLD', 2)
+    db = connect_db(':memory:')
+    for i, article_id in enumerate(ARTICLES[:3]):
+        db.insert('articles', dict(id=article_id, dossier='code_en_vigueur', cid=CID, mtime=i))
+    db.insert('articles', dict(id='foo', dossier='code_en_vigueur', cid=CID, mtime=9))
+    index = MtimeIndex(db)
+    assert index.get('articles', ARTICLES[1]) == (1, 'code_en_vigueur', CID)
+    assert index.get('articles', 'foo') == (9, 'code_en_vigueur', CID)
+    assert index.get('articles', ARTICLES[3]) is None
+    assert index.get('sections', ARTICLES[1]) is None
+    index.set('articles', ARTICLES[3], 3, 'TNC_en_vigueur', CID_2)
+    index.set('articles', ARTICLES[1], 4, 'TNC_en_vigueur', CID_2)
+    index.delete('articles', ARTICLES[0])
+    index.set('articles', ARTICLES[4], 5, 'code_en_vigueur', CID)
+    assert list(index.overlays['articles']) == ['foo']
+    assert index.get('articles', ARTICLES[0]) is None
+    assert index.get('articles', ARTICLES[1]) == (4, 'TNC_en_vigueur', CID_2)
+    assert index.get('articles', ARTICLES[3]) == (3, 'TNC_en_vigueur', CID_2)
+    assert index.get('articles', ARTICLES[4]) == (5, 'code_en_vigueur', CID)
+    # The typecodes exist in Python 2, and the values are stored exactly
+    assert set(a.typecode for a in index.bases['articles']) <= set('bBhHiIlLfd')
+    big_id = 'JORFARTI999999999999'
+    index.set('articles', big_id, 2**40 + 1, 'code_en_vigueur', CID)
+    index.merge('articles')
+    assert index.get('articles', big_id) == (2**40 + 1, 'code_en_vigueur', CID)
+    assert type(index.get('articles', big_id)[0]) is int
+
+
+def test_process_archive_with_a_shared_mtime_index(archives, monkeypatch):
+    monkeypatch.setattr(MtimeIndex, 'MERGE_THRESHOLD', 10)
+    expected = dump_db(import_archives(archives))
+    db = connect_db(':memory:')
+    mtime_index = MtimeIndex(db)
+    for archive_path in archives:
+        with db:
+            process_archive(db, archive_path, mtime_index=mtime_index)
+    assert dump_db(db) == expected
+    for table in MtimeIndex.TABLES:
+        for row_id, mtime, dossier, cid in db.all("SELECT id, mtime, dossier, cid FROM " + table):
+            assert mtime_index.get(table, row_id) == (mtime, dossier, cid)
+
+
+@pytest.mark.parametrize('paths', [
+    # Deleted files, with and without an older duplicate
+    [('articles', 'code_en_vigueur', CID, ARTICLES[1]),
+     ('articles', 'code_en_vigueur', CID, ARTICLES[3]),
+     ('sections', 'code_en_vigueur', CID, SECTION),
+     ('textes_versions', 'code_en_vigueur', CID, CID)],
+    # A file that is only in `duplicate_files`, and one that isn't anywhere
+    [('articles', 'TNC_en_vigueur', CID_2, ARTICLES[1]),
+     ('articles', 'TNC_non_vigueur', CID_2, ARTICLES[4])],
+    # Several paths with the same ID, the order matters
+    [('articles', 'code_en_vigueur', CID, ARTICLES[1]),
+     ('articles', 'TNC_en_vigueur', CID_2, ARTICLES[1]),
+     ('textes_structs', 'code_en_vigueur', CID, CID),
+     ('textes_versions', 'code_en_vigueur', CID, CID),
+     ('articles', 'code_en_vigueur', CID, ARTICLES[9])],
+    [('articles', 'TNC_en_vigueur', CID_2, ARTICLES[1]),
+     ('articles', 'code_en_vigueur', CID, ARTICLES[1])],
+])
+def test_suppress(archives, capsys, paths):
+    # The result is the same as suppressing the files one by one
+    liste_suppression = [file_path(*path[1:3] + (SOUS_DOSSIER_MAP[path[0]], path[3])) for path in paths]
+    expected_db = import_archives(archives[:1])
+    expected_index = MtimeIndex(expected_db)
+    expected_counts = {}
+    for path in paths:
+        suppress_file(expected_db, *path, counts=expected_counts, mtime_index=expected_index)
+    db = import_archives(archives[:1])
+    mtime_index = MtimeIndex(db)
+    capsys.readouterr()
+    suppress(get_table, db, liste_suppression, mtime_index)
+    out = capsys.readouterr().out
+    assert out.split(':', 1)[1].strip() == json.dumps(expected_counts, indent=4, sort_keys=True)
+    assert expected_counts
+    actual, expected = dump_db(db), dump_db(expected_db)
+    for table in TABLES:
+        assert sorted(actual[table], key=repr) == sorted(expected[table], key=repr)
+    for table in MtimeIndex.TABLES:
+        for row_id, mtime, dossier, cid in db.all("SELECT id, mtime, dossier, cid FROM " + table):
+            assert mtime_index.get(table, row_id) == (mtime, dossier, cid)
+        for path in paths:
+            assert mtime_index.get(table, path[3]) == expected_index.get(table, path[3])
+    assert db.one("SELECT count(*) FROM sqlite_temp_master") == 0
+
+
+def test_process_archive_with_an_archive_index(archives, tmpdir, capsys):
+    # The result is the same as without the index
+    expected_outputs = []
+    db = connect_db(':memory:')
+    for archive_path in archives:
+        with db:
+            process_archive(db, archive_path)
+        expected_outputs.append(capsys.readouterr().out)
+    expected = dump_db(db)
+    for i in range(2):
+        db = connect_db(':memory:')
+        for archive_path, expected_output in zip(archives, expected_outputs):
+            with db:
+                process_archive(db, archive_path, use_archive_index=True)
+            out = capsys.readouterr().out
+            assert os.path.exists(archive_path + '.index.gz')
+            if i == 1:
+                assert out.startswith('the archive index says that')
+                out = out.split('\n', 1)[1]
+            assert out == expected_output
+        assert dump_db(db) == expected
+
+    # Running again on the same DB doesn't require reading the archive
+    files = [f for f in global_archive_files() if '/article/' in f[0]][:50]
+    archive_path = make_archive(tmpdir.join('legi_20180103-210000.tar.gz'), files)
+    db = connect_db(':memory:')
+    with db:
+        process_archive(db, archive_path, use_archive_index=True)
+    expected = dump_db(db)
+    capsys.readouterr()
+    with db:
+        process_archive(db, archive_path, use_archive_index=True)
+    out = capsys.readouterr().out
+    assert 'the archive index says that 0 files out of 50 have to be read' in out
+    assert 'skipped 50 files' in out
+    assert dump_db(db) == expected
+
+    # Only the beginning of the archive is read if the rest hasn't changed
+    db.run("UPDATE articles SET mtime = 0 WHERE id = ?", (ARTICLES[3],))
+    with db:
+        process_archive(db, archive_path, use_archive_index=True)
+    out = capsys.readouterr().out
+    assert 'the archive index says that 4 files out of 50 have to be read' in out
+    assert 'skipped 49 files' in out
+    assert sorted(db.all("SELECT * FROM liens")) == sorted(expected['liens'])
+
+
+def test_process_archive_in_bulk_load_mode(archives):
+    expected = dump_db(import_archives(archives))
+    db = connect_db(':memory:')
+    with db:
+        process_archive(db, archives[0], bulk_load=True)
+    with db:
+        process_archive(db, archives[1])
+    actual = dump_db(db)
+    for table in TABLES:
+        assert sorted(actual[table], key=repr) == sorted(expected[table], key=repr)
+    indexes = set(r[0] for r in db.all("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    assert indexes.issuperset(('articles_id_idx', 'liens_src_idx', 'sommaires_cid_idx'))
+
+
+def test_bulk_load_mode_checks_uniqueness(archives, capsys):
+    db = connect_db(':memory:')
+    drop_schema_indexes(db)
+    row = dict(id=ARTICLES[0], dossier='code_en_vigueur', cid=CID, mtime=0)
+    db.insert('articles', row)
+    db.insert('articles', row)
+    with pytest.raises(IntegrityError):
+        create_schema_indexes(db)
+    assert ARTICLES[0] in capsys.readouterr().out
+
+
+def interrupt_import(db, archive_path, failing_id, monkeypatch, **kw):
+    """Imports the archive into the DB, but fails when `failing_id` is written.
+    """
+    original_set = MtimeIndex.set
+
+    def set(self, table, row_id, *args):
+        if row_id == failing_id:
+            raise KeyboardInterrupt
+        return original_set(self, table, row_id, *args)
+
+    with monkeypatch.context() as m:
+        m.setattr(MtimeIndex, 'set', set)
+        with pytest.raises(KeyboardInterrupt):
+            with db:
+                process_archive(db, archive_path, **kw)
+
+
+def resume_import(db, archives, capsys, **kw):
+    """Resumes the interrupted import of `archives[0]`, then imports the others.
+
+    Returns the output of the resumed import, without the first line.
+    """
+    capsys.readouterr()
+    for i, archive_path in enumerate(archives):
+        with db:
+            process_archive(db, archive_path, resume=get_checkpoint(db), **kw)
+        if i == 0:
+            out = capsys.readouterr().out
+            assert out.startswith('resuming from file #60 of the archive\n')
+    assert get_checkpoint(db) is None
+    return out.split('\n', 1)[1]
+
+
+@pytest.mark.parametrize('kw', [
+    {}, {'workers': 2}, {'use_archive_index': True}, {'read_ahead': True},
+])
+def test_process_archive_with_checkpoints(archives, capsys, monkeypatch, kw):
+    if kw.get('use_archive_index'):
+        import_archives(archives, **kw)
+    capsys.readouterr()
+    db = connect_db(':memory:')
+    with db:
+        process_archive(db, archives[0], **kw)
+    expected_output = capsys.readouterr().out
+    with db:
+        process_archive(db, archives[1], **kw)
+    expected = dump_db(db)
+
+    db = connect_db(':memory:')
+    interrupt_import(db, archives[0], ARTICLES[60], monkeypatch, checkpoint_interval=10, **kw)
+    checkpoint = get_checkpoint(db)
+    assert checkpoint['position'] == 60
+    assert db.one("SELECT count(*) FROM articles") == 57
+    out = resume_import(db, archives, capsys, checkpoint_interval=10, **kw)
+    if kw.get('use_archive_index'):
+        assert out.startswith('the archive index says that 85 files out of 86 have to be read')
+        out = out.split('\n', 1)[1]
+        expected_output = expected_output.split('\n', 1)[1]
+    assert out == expected_output
+    assert dump_db(db) == expected
+
+
+def test_process_archive_with_checkpoints_in_bulk_load_mode(tmpdir, capsys, monkeypatch):
+    # Move the duplicates before the interruption, so that they're set aside
+    files = global_archive_files()
+    files[20:20] = files[-3:-1]
+    del files[-3:-1]
+    archives = [
+        make_archive(tmpdir.join('LEGI_20180101-000000.tar.gz'), files),
+        make_archive(tmpdir.join('legi_20180102-210000.tar.gz'), daily_archive_files()),
+    ]
+    db = connect_db(':memory:')
+    for i, archive_path in enumerate(archives):
+        with db:
+            process_archive(db, archive_path, bulk_load=(i == 0))
+        if i == 0:
+            expected_output = capsys.readouterr().out
+    expected = dump_db(db)
+
+    db = connect_db(':memory:')
+    interrupt_import(db, archives[0], ARTICLES[60], monkeypatch,
+                     bulk_load=True, checkpoint_interval=10)
+    assert get_checkpoint(db)['deferred'] == [20, 21]
+    out = resume_import(db, archives[:1], capsys, bulk_load=True, checkpoint_interval=10)
+    assert out == expected_output
+    with db:
+        process_archive(db, archives[1])
+    actual = dump_db(db)
+    for table in TABLES:
+        assert sorted(actual[table], key=repr) == sorted(expected[table], key=repr)
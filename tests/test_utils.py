@@ -0,0 +1,114 @@
+from __future__ import division, print_function, unicode_literals
+
+import json
+import os
+from sqlite3 import IntegrityError
+
+import pytest
+
+from legi.utils import (
+    NULL_PHASE, BatchInserter, Profiler, connect_db, get_processed_until, pack_data,
+    purge_changes_log, unpack_data,
+)
+
+
+def test_batch_inserter_keeps_the_order_of_rows():
+    db = connect_db(':memory:')
+    writer = BatchInserter(db, batch_size=3)
+    for i in range(5):
+        writer.insert('sommaires', dict(cid='C', element='E%i' % i, position=i))
+        if i % 2:
+            writer.insert('sommaires', dict(cid='C', element='E%ib' % i))
+    writer.flush()
+    elements = [r[0] for r in db.all("SELECT element FROM sommaires ORDER BY rowid")]
+    assert elements == ['E0', 'E1', 'E1b', 'E2', 'E3', 'E3b', 'E4']
+
+
+def test_batch_inserter_reports_the_offending_row(capsys):
+    db = connect_db(':memory:')
+    writer = BatchInserter(db)
+    row = dict(dossier='code_en_vigueur', cid='C', mtime=0)
+    writer.insert('sections', dict(row, id='S1'))
+    writer.insert('sections', dict(row, id='S2'))
+    writer.insert('sections', dict(row, id='S1', titre_ta='duplicate'))
+    with pytest.raises(IntegrityError):
+        writer.flush()
+    out = capsys.readouterr().out
+    assert 'duplicate' in out
+
+
+def test_profiler():
+    profiler = Profiler()
+    for i in range(3):
+        with profiler.phase('a'):
+            pass
+    assert list(profiler.iterate(range(4), 'b')) == [0, 1, 2, 3]
+    profiler.count('files', 2)
+    profiler.count('files')
+    profiler.stop()
+    report = profiler.to_dict()
+    assert report['phases']['a']['calls'] == 3
+    assert report['phases']['b']['calls'] == 5
+    assert report['counters'] == {'files': 3}
+    assert set(report['rates']) == {'files_per_second'}
+
+
+def test_disabled_profiler():
+    profiler = Profiler(enabled=False)
+    assert profiler.phase('a') is NULL_PHASE
+    iterable = [1, 2]
+    assert profiler.iterate(iterable, 'b') is iterable
+    profiler.count('files')
+    assert profiler.to_dict()['phases'] == {}
+    assert profiler.to_dict()['counters'] == {}
+
+
+# The schema of the DB before migration #4
+SCHEMA_V3_PATH = os.path.join(os.path.dirname(__file__), 'schema_v3.sql')
+
+DUPLICATE_DATA = {
+    'articles': {'num': '1', 'etat': 'VIGUEUR', 'bloc_textuel': 'Les lois « françaises »'},
+    'liens': [{'src_id': 'LEGIARTI000006419201', 'typelien': 'CITATION', '_reversed': False}],
+}
+
+
+def test_pack_data():
+    packed = pack_data(DUPLICATE_DATA)
+    assert unpack_data(packed) == DUPLICATE_DATA
+    assert len(packed) < len(json.dumps(DUPLICATE_DATA))
+    # The JSON text stored by older versions is still readable
+    assert unpack_data(json.dumps(DUPLICATE_DATA)) == DUPLICATE_DATA
+    with pytest.raises(ValueError):
+        unpack_data(b'\xff' + bytes(packed)[1:])
+
+
+def test_duplicate_files_migration(tmpdir):
+    path = str(tmpdir.join('db.sqlite'))
+    # Create a DB as it was before migration #4
+    db = connect_db(path, create_schema=False, update_schema=False)
+    with open(SCHEMA_V3_PATH) as f:
+        db.executescript(f.read())
+    db.insert('duplicate_files', dict(
+        id='LEGIARTI000006419201', sous_dossier='article', cid='C', dossier='D', mtime=0,
+        data=json.dumps(DUPLICATE_DATA), other_cid='C2', other_dossier='D2', other_mtime=1,
+    ))
+    db.commit()
+    db.close()
+    db = connect_db(path)
+    assert db.one("SELECT typeof(data) FROM duplicate_files") == 'blob'
+    assert unpack_data(db.one("SELECT data FROM duplicate_files")) == DUPLICATE_DATA
+
+
+def test_purge_changes_log_resets_stale_consumers():
+    db = connect_db(':memory:')
+    db.insert('db_meta', dict(key='last_update', value='20180301-000000'))
+    db.insert('db_meta', dict(key='normalize_processed_until', value='20180301-000000'))
+    db.insert('db_meta', dict(key='anomalies_processed_until', value='20180101-000000'))
+    for archive_date in ('20180101-000000', '20180201-000000', '20180301-000000'):
+        db.insert('changes_log', dict(
+            archive_date=archive_date, tbl='articles', id='LEGIARTI', cid='LEGITEXT',
+        ))
+    # `anomalies` hasn't run for two months, it doesn't keep the log alive
+    assert purge_changes_log(db) == 3
+    assert get_processed_until(db, 'anomalies') is None
+    assert get_processed_until(db, 'normalize') == '20180301-000000'